@@ -2,9 +2,10 @@
 
 # For running on HTcondor
 # ASSUMES THAT THE DIRECTORY WITH SPECTRUM FILES EXISTS ON /hdfs
-# Args: <dir with spectrum files> <process ID for uniqueness>
+# Args: <dir with spectrum files> <process ID for uniqueness> [analyse_scans.py options]
 SPECTRDIR="$1"
 PID="$2"
+shift 2
 
 # Check if the directory on hdfs exists
 # -----------------------------------------------------------------------------
@@ -14,14 +15,13 @@ if [ ! -d $hdfsdir ]; then
     exit 1
 fi
 
-# Make a dir on the worker node with the same name, extract spectrum files there
+# The spectrum files are read straight out of spectr"$PID".tgz by
+# analyse_scans.py, so nothing is extracted here.
+# With --superiso/--nmssmcalc, it also reads superiso"$PID".tgz and
+# nmssmcalc"$PID".tgz from the same directory, if they exist.
 # -----------------------------------------------------------------------------
-if [ ! -d "$SPECTRDIR" ]; then
-    mkdir "$SPECTRDIR"
-fi
-tar -xzf $hdfsdir/spectr"$PID".tgz -C "$SPECTRDIR"
 
-# Check if superiso output exists. If so, untar.
+# Check if superiso output exists.
 # -----------------------------------------------------------------------------
 # If not, we will have to make them -
 # for legacy folders before SuperIso was implemented
@@ -46,7 +46,7 @@ tar -xzf $hdfsdir/spectr"$PID".tgz -C "$SPECTRDIR"
 #     tar -xvzf $hdfsdir/superiso"$PID".tgz -C "$SPECTRDIR"
 # fi
 
-# Check if nmssmcalc output exists. If so, untar.
+# Check if nmssmcalc output exists.
 # -----------------------------------------------------------------------------
 # if [ -e $hdfsdir/nmssmcalc"$PID".tgz ]; then
 #     tar -xvzf $hdfsdir/nmssmcalc"$PID".tgz -C "$SPECTRDIR"
@@ -56,14 +56,11 @@ ls
 
 # Run analysis script over files
 # -----------------------------------------------------------------------------
-python analyse_scans.py "$SPECTRDIR" --ID "$PID"
+python analyse_scans.py $hdfsdir/spectr"$PID".tgz --ID "$PID" "$@"
 
 # Copy files to hdfs
 # -----------------------------------------------------------------------------
-for f in *.csv; do
+shopt -s nullglob
+for f in *.csv *.h5 analysis_manifest*.json; do
     hadoop fs -copyFromLocal -f $f ${hdfsdir#/hdfs}/$(basename $f)
 done
-
-# Cleanup
-# -----------------------------------------------------------------------------
-rm -r $SPECTRDIR
@@ -0,0 +1,28 @@
+#!/bin/bash -e
+which gfortran
+# Build NMSSMTools, HiggsBounds & HiggsSignals once and save them as prebuilt
+# bundles, so scan jobs can just unpack them (see toolBundles.sh).
+# Tools that already have a bundle for this version, patch set & compiler
+# are skipped.
+# Run before the scan jobs, e.g. as the parent job in the scan DAG.
+echo "Running with parameters: $@"
+
+source ./toolBundles.sh
+
+# Args: [tool directory] [build function] [patch files...]
+build_bundle() {
+    local dir=$1
+    local build=$2
+    shift 2
+    local name=$(bundle_name "$dir" "$@")
+    if [[ -f "$BUNDLEDIR/$name.tar.gz" ]]; then
+        echo "Bundle $BUNDLEDIR/$name.tar.gz already exists"
+        return
+    fi
+    $build
+    save_bundle "$dir" "$name"
+}
+
+build_bundle NMSSMTools_${NTVER} build_nmssmtools $NTPATCHES
+build_bundle HiggsBounds-${HBVER} build_higgsbounds $HBPATCHES
+build_bundle HiggsSignals-${HSVER} build_higgssignals $HSPATCHES
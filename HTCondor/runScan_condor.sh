@@ -3,10 +3,16 @@ which gfortran
 # For running on HTCondor
 # TODO: use getopts
 echo "Running with parameters: $@"
-# parameters are: [job dir to put output] [batch number] [number of points]
+# parameters are: [job dir to put output] [batch number] [number of points] [number of cores, optional] [random seed, optional]
+# [sampler, optional] [total number of jobs, optional] [extra NMSSMScan.py options, optional]
 jobdir=$1
 batchNum=$2
 numPoints=$3
+numCores=${4:-1}
+seed=$5
+sampler=${6:-random}
+numJobs=${7:-1}
+scanOpts=$8
 
 # choose whether to run with extra programs
 doSuperIso=0
@@ -15,54 +21,24 @@ doHiggsBounds=1
 doHiggsSignals=1
 doSushi=0
 
-# Versions
-NTVER="4.9.3"
-HBVER="4.3.1"
-HSVER="1.4.0"
-
-# Setup NMSSMTools
-# -----------------------------------------------------------------------------
-tar xzf /hdfs/user/ra12451/NMSSM-Scan/zips/NMSSMTools_${NTVER}.tar.gz
-cd NMSSMTools_${NTVER}
-# patch bug in moving output files due to relpaths eurgh
-# patch run < ../NT.patch
-patch sources/micromegas/clean < ../NT_clean.patch
-make clean
-make init
-make
-cd ..
-
-# Setup HiggsBounds
+# Setup NMSSMTools, HiggsBounds & HiggsSignals
 # -----------------------------------------------------------------------------
+# Versions, patches & build steps are in toolBundles.sh. Each tool is unpacked
+# from a prebuilt bundle if there is one, otherwise built from source.
+source ./toolBundles.sh
+
+setup_tool NMSSMTools_${NTVER} build_nmssmtools $NTPATCHES
+
 HBOPT=""
 if [[ $doHiggsBounds == 1 ]]; then
-    tar xzf /hdfs/user/ra12451/NMSSM-Scan/zips/HiggsBounds-${HBVER}.tar.gz
+    setup_tool HiggsBounds-${HBVER} build_higgsbounds $HBPATCHES
     HBOPT="--HB $PWD/HiggsBounds-${HBVER}"
-    cd HiggsBounds-${HBVER}
-    make clean
-    # patch to remove spurious printout
-    # patch HiggsBounds.F90 < ../HB.patch
-    ./configure
-    make
-    cd ..
 fi
 
-# Setup Higgs Signals
-# -----------------------------------------------------------------------------
 HSOPT=""
 if [[ $doHiggsSignals == 1 ]]; then
-    tar xzf /hdfs/user/ra12451/NMSSM-Scan/zips/HiggsSignals-${HSVER}.tar.gz
+    setup_tool HiggsSignals-${HSVER} build_higgssignals $HSPATCHES
     HSOPT="--HS $PWD/HiggsSignals-${HSVER}"
-    cd HiggsSignals-${HSVER}
-    make clean
-    # patch to remove spurious printout
-    patch datatables.f90 < ../HS_datatables.patch
-    patch HiggsSignals_subroutines.F90 < ../HS_subroutines.patch
-    # patch to assign mass better
-    patch usefulbits_HS.f90 < ../HS_assignmass.patch
-    ./configure
-    make
-    cd ..
 fi
 
 # Setup NMSSMCALC
@@ -84,7 +60,7 @@ fi
 SUSHIOPT=""
 if [[ $doSushi == 1 ]]; then
     SUSHIOPT="--sushi"
-    tar xzf /hdfs/user/ra12451/NMSSM-Scan/zips/SusHi-1.5.0.tar.gz
+    tar xzf "$ZIPDIR/SusHi-1.5.0.tar.gz"
     cd SusHi-*
     ./configure
 
@@ -96,7 +72,36 @@ fi
 
 # Run NMSSMTools over parameter points
 # -----------------------------------------------------------------------------
-python NMSSMScan.py --card inp_*.dat -n $3 --param paramRange*.json --oDir . --NT NMSSMTools_${NTVER} $HBOPT $HSOPT $SUSHIOPT
+SEEDOPT=""
+if [[ -n $seed ]]; then
+    SEEDOPT="--seed $seed"
+fi
+# Resume from an earlier, evicted attempt at this job if there is one:
+# restore the spectra it saved, and its journal of finished points
+card=$(ls inp_*.dat)
+if [[ -f "$jobdir/journal${batchNum}.txt" ]]; then
+    echo "Resuming from $jobdir/journal${batchNum}.txt"
+    cp "$jobdir/journal${batchNum}.txt" "journal_${card%.dat}.txt"
+    # and the output CSVs from --analyse
+    for f in output${batchNum}.csv output_good${batchNum}.csv output_ma1Lt11${batchNum}.csv;
+    do
+        if [[ -f "$jobdir/$f" ]]; then
+            cp "$jobdir/$f" .
+        fi
+    done
+    for f in "$jobdir"/partial${batchNum}_*.tgz;
+    do
+        if [[ -f "$f" ]]; then
+            tar xzf "$f"
+        fi
+    done
+fi
+# In MCMC mode, the chains & their checkpoints instead
+if ls "$jobdir/mcmc${batchNum}"/mcmc_state_*.json 1> /dev/null 2>&1; then
+    echo "Resuming Markov chains from $jobdir/mcmc${batchNum}"
+    cp "$jobdir/mcmc${batchNum}"/mcmc_state_*.json "$jobdir/mcmc${batchNum}"/mcmc_chain_*.csv .
+fi
+python NMSSMScan.py --card $card -n $3 --param paramRange*.json --oDir . --NT NMSSMTools_${NTVER} $HBOPT $HSOPT $SUSHIOPT --jobs $numCores --batch $batchNum $SEEDOPT --sampler $sampler --nBatches $numJobs --flushDir "$jobdir" $scanOpts
 # ls
 
 # Setup SuperIso
@@ -119,32 +124,47 @@ fi
 
 # Save space - delete useless files
 # -----------------------------------------------------------------------------
-for f in $(grep -l "M_A1^2<1" spectr*.dat);
-do
-    echo "rm $f"
-    rm $f
-done
+# (spectra for unphysical points are already deleted by NMSSMScan.py)
+rm omega*
 
-for f in $(grep -l "M_H1^2<1" spectr*.dat);
-do
-    echo "rm $f"
-    rm $f
-done
+# Zip up files to transfer to HDFS
+# -----------------------------------------------------------------------------
+# (with --analyse, most spectra may have been parsed & deleted already)
+nfiles=`ls spectr*.dat 2> /dev/null | wc -l`
+if [[ $nfiles -gt 0 ]]; then
+    echo "Zipping up $nfiles files"
+    tar -cvzf "spectr${batchNum}.tgz" spectr*.dat
+    cp "spectr${batchNum}.tgz" "$jobdir"
+fi
+# Everything is in the full tarball now, so don't need the partial saves
+rm -f "$jobdir"/partial${batchNum}_*.tgz "$jobdir/journal${batchNum}.txt"
+# Parameter manifest, so points can be regenerated
+if ls params_*.npz 1> /dev/null 2>&1; then
+    cp params_*.npz "$jobdir/params${batchNum}.npz"
+fi
+# Markov chains, if running in MCMC mode
+if ls mcmc_chain_*.csv 1> /dev/null 2>&1; then
+    tar -cvzf "mcmc${batchNum}.tgz" mcmc_chain_*.csv
+    cp "mcmc${batchNum}.tgz" "$jobdir"
+    rm -rf "$jobdir/mcmc${batchNum}"
+fi
 
-for f in $(grep -l "M_HC^2<1" spectr*.dat);
+# Output CSVs, if points were parsed as they finished (--analyse)
+for f in output${batchNum}.csv output_good${batchNum}.csv output_ma1Lt11${batchNum}.csv;
 do
-    echo "rm $f"
-    rm $f
+    if [[ -f "$f" ]]; then
+        cp "$f" "$jobdir"
+    fi
 done
 
-rm omega*
-
-# Zip up files to transfer to HDFS
-# -----------------------------------------------------------------------------
-nfiles=`ls spectr*.dat | wc -l`
-echo "Zipping up $nfiles files"
-tar -cvzf "spectr${batchNum}.tgz" spectr*.dat
-cp "spectr${batchNum}.tgz" "$jobdir"
+# Per-point stage timings
+if ls timing_*.csv 1> /dev/null 2>&1; then
+    cp timing_*.csv "$jobdir/timing${batchNum}.csv"
+fi
+# Points from NMSSMTools scan mode
+if ls ntscan_*.csv 1> /dev/null 2>&1; then
+    cp ntscan_*.csv "$jobdir/ntscan${batchNum}.csv"
+fi
 
 # tar -cvzf "omega${batchNum}.tgz" omega*.dat
 # cp "omega${batchNum}.tgz" "$jobdir"
@@ -0,0 +1,135 @@
+#!/bin/bash
+# Functions to set up NMSSMTools, HiggsBounds & HiggsSignals, sourced by
+# runScan_condor.sh and buildToolBundles.sh.
+#
+# Compiling the tools takes far longer than unpacking them, so after a
+# source build the whole tool directory can be saved as a prebuilt bundle in
+# $BUNDLEDIR, alongside the source tarballs. Bundles are keyed by the tool
+# version, the patches applied and the compiler, so changing any of these
+# means a fresh build. Jobs unpack the bundle if there is one, and only build
+# from source if not.
+#
+# HiggsBounds & HiggsSignals store the absolute path of their directory at
+# build time (for their data tables), so when a bundle is unpacked somewhere
+# else, that path is replaced in any text files and `make` run again, which
+# only recompiles the few files affected.
+#
+# Patch files are expected in the current directory (as they are in a job).
+
+# Versions
+NTVER="4.9.3"
+HBVER="4.3.1"
+HSVER="1.4.0"
+
+# Source tarballs, and prebuilt bundles
+ZIPDIR="/hdfs/user/ra12451/NMSSM-Scan/zips"
+BUNDLEDIR="$ZIPDIR/bundles"
+
+# Patches applied to each tool - must match the build_* functions below
+NTPATCHES="NT_clean.patch"
+HBPATCHES=""
+HSPATCHES="HS_datatables.patch HS_subroutines.patch HS_assignmass.patch"
+
+# File in each bundle recording the directory it was built in
+BUILDDIR_FILE=".bundle_build_dir"
+
+
+# Print the bundle name for a tool.
+# Args: [tool directory name, e.g. NMSSMTools_4.9.3] [patch files...]
+bundle_name() {
+    local name=$1
+    shift
+    local hash=$( (for p in "$@"; do echo "$p"; cat "$p"; done
+                   gfortran --version | head -n 1
+                   uname -m) | sha1sum | cut -c1-12)
+    echo "${name}-${hash}"
+}
+
+build_nmssmtools() {
+    tar xzf "$ZIPDIR/NMSSMTools_${NTVER}.tar.gz"
+    cd NMSSMTools_${NTVER}
+    # patch bug in moving output files due to relpaths eurgh
+    # patch run < ../NT.patch
+    patch sources/micromegas/clean < ../NT_clean.patch
+    make clean
+    make init
+    make
+    cd ..
+}
+
+build_higgsbounds() {
+    tar xzf "$ZIPDIR/HiggsBounds-${HBVER}.tar.gz"
+    cd HiggsBounds-${HBVER}
+    make clean
+    # patch to remove spurious printout
+    # patch HiggsBounds.F90 < ../HB.patch
+    ./configure
+    make
+    cd ..
+}
+
+build_higgssignals() {
+    tar xzf "$ZIPDIR/HiggsSignals-${HSVER}.tar.gz"
+    cd HiggsSignals-${HSVER}
+    make clean
+    # patch to remove spurious printout
+    patch datatables.f90 < ../HS_datatables.patch
+    patch HiggsSignals_subroutines.F90 < ../HS_subroutines.patch
+    # patch to assign mass better
+    patch usefulbits_HS.f90 < ../HS_assignmass.patch
+    ./configure
+    make
+    cd ..
+}
+
+# Point a tool unpacked from a bundle at its new location.
+# Args: [tool directory]
+relocate_tool() {
+    local dir=$1
+    local old_dir=$(cat "$dir/$BUILDDIR_FILE")
+    local new_dir=$(cd "$dir" && pwd)
+    if [[ "$old_dir" == "$new_dir" ]]; then
+        return
+    fi
+    local files=$(grep -rlIF --exclude="$BUILDDIR_FILE" "$old_dir" "$dir" || true)
+    if [[ -n "$files" ]]; then
+        echo "Relocating $dir from $old_dir"
+        for f in $files;
+        do
+            sed -i "s|$old_dir|$new_dir|g" "$f"
+        done
+        (cd "$dir" && make)
+    fi
+    echo "$new_dir" > "$dir/$BUILDDIR_FILE"
+}
+
+# Save a built tool directory as a bundle. Written to a temporary name then
+# moved, so other jobs never see a half-written bundle.
+# Args: [tool directory] [bundle name]
+save_bundle() {
+    local dir=$1
+    local bundle="$BUNDLEDIR/$2.tar.gz"
+    (cd "$dir" && pwd) > "$dir/$BUILDDIR_FILE"
+    mkdir -p "$BUNDLEDIR"
+    tar czf "$bundle.tmp.$$" "$dir"
+    mv "$bundle.tmp.$$" "$bundle"
+    echo "Saved bundle $bundle"
+}
+
+# Set up a tool: unpack its bundle if there is one, otherwise build from source.
+# Args: [tool directory] [build function] [patch files...]
+setup_tool() {
+    local dir=$1
+    local build=$2
+    shift 2
+    local name=$(bundle_name "$dir" "$@")
+    local bundle="$BUNDLEDIR/$name.tar.gz"
+    if [[ -f "$bundle" ]] && tar xzf "$bundle"; then
+        echo "Using prebuilt bundle $bundle"
+        relocate_tool "$dir"
+        return
+    fi
+    echo "No bundle $bundle, building $dir from source"
+    rm -rf "$dir"
+    $build
+}
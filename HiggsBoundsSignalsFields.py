@@ -33,17 +33,20 @@ higgssignals_fields = [
 
 ]
 
-# Observation-specific fields
+# Observation-specific fields, from the HiggsSignalsPeakObservables block
+# (not written when HiggsSignals is run in batches, see hbhs_batch.py)
+higgssignals_observable_fields = []
 for chan in range(1, 86):
   chan_field = Field(block='HiggsSignalsPeakObservables', name='HS_%d_muPred' % chan, type=float,
                      regex=re.compile(r' +%d +17 +([E\d\.\-\+]+) +\# Total predicted signal strength modifier mu' % chan),
                      comment='')
-  higgssignals_fields.append(chan_field)
+  higgssignals_observable_fields.append(chan_field)
   chi2_field = Field(block='HiggsSignalsPeakObservables', name='HS_%d_chi2' % chan, type=float,
                      regex=re.compile(r' +%d +20 +([E\d\.\-\+]+) +\# Chi\-squared value \(total\)' % chan),
                      comment='')
-  higgssignals_fields.append(chi2_field)
+  higgssignals_observable_fields.append(chi2_field)
   # chan_field = Field(block='HiggsSignalsPeakObservables', name='HS_%d_muObs' % chan, type=float,
   #                    regex=re.compile(r' +%d +9 +([E\d\.\-\+]+) +\# Observed signal strength modifier \(mu\)' % chan),
   #                    comment='')
-  # higgssignals_fields.append(chan_field)
+  # higgssignals_observable_fields.append(chan_field)
+higgssignals_fields += higgssignals_observable_fields
@@ -10,15 +10,51 @@ randomly over a given range, improving efficiency.
 """
 
 import os
+import re
 import sys
 import argparse
 import logging
-import random
-from subprocess import call
-import json
-import re
+import shutil
+import time
+import signal
+import threading
+from collections import defaultdict
+from itertools import izip
+from subprocess import call, Popen
 from time import strftime
 import common_utils as cu
+from card_template import CardTemplate
+from scan_workers import setup_worker_dirs, run_pool, run_points
+import sampling
+import scan_mcmc
+import tree_level
+import hbhs_batch
+import nmssmtools_scan
+import scan_journal
+import scan_timing
+import analyse_scans
+from result_cache import ResultCache
+import numpy as np
+
+
+# MODSEL settings for the cheap first pass in --staged mode:
+# tree-level + leading-log Higgs masses, and no micrOMEGAs
+STAGE1_MODSEL = {('MODSEL', 8): '0', ('MODSEL', 9): '0'}
+
+# Fields used for the stage 1 cuts
+STAGE1_FIELDS = ['ma1', 'mh1', 'mh2']
+
+# Failed NMSSMTools constraints that veto a point at stage 1: those that don't
+# depend on the precise Higgs masses or micrOMEGAs (i.e. not the Higgs
+# searches & couplings, relic density or direct detection), so won't change
+# at full precision. Matched case-insensitively against the SPINFO messages.
+STAGE1_CONSTRAINTS = re.compile(r'landau|b ?-> ?s ?gamma|b_?s ?->|b\+? ?-> ?tau|'
+                                r'delta ?m_?[ds]|chargino|neutralino|squark|gluino|'
+                                r'stop|sbottom|slepton|stau|sneutrino', re.IGNORECASE)
+
+# Random sub-stream for picking which spectra to keep with --analyse
+# (well away from the per-chain MCMC streams)
+KEEP_SUB_STREAM = 1000000
 
 
 logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.INFO)
@@ -39,6 +75,74 @@ def NMSSMScan(in_args=sys.argv[1:]):
                         help='Number of points to run over',
                         type=int,
                         default=1)
+    parser.add_argument('--seed',
+                        help='Random seed for the whole set of jobs. If not '
+                        'specified, one is generated (and stored in the manifest).',
+                        type=int)
+    parser.add_argument('--batch',
+                        help='Job number within the set of jobs. Each job '
+                        'gets its own random stream from (seed, batch).',
+                        type=int,
+                        default=0)
+    parser.add_argument('--nBatches',
+                        help='Total number of jobs in the set. Needed for '
+                        '--sampler lhs, so each job takes its own part of one '
+                        'global Latin hypercube.',
+                        type=int,
+                        default=1)
+    parser.add_argument('--sampler',
+                        help='How to fill parameter space. random: uniform '
+                        'random numbers. sobol/lhs: low-discrepancy Sobol '
+                        'sequence or Latin hypercube, with each job taking a '
+                        'separate segment of one global set of points.',
+                        choices=sampling.SAMPLERS,
+                        default='random')
+    parser.add_argument('--mcmc',
+                        help='Scan with Markov chain(s) that move towards the '
+                        'interesting region, instead of independent points. '
+                        'Runs one chain per --jobs. Chains are checkpointed, '
+                        'so rerunning resumes them.',
+                        action='store_true')
+    parser.add_argument('--prescreen',
+                        help='Check tree-level Higgs masses before running '
+                        'NMSSMTools. Points with clearly tachyonic Higgs '
+                        'bosons are either not run (reject), or replaced with '
+                        'new random points (resample).',
+                        choices=['none', 'reject', 'resample'],
+                        default='none')
+    parser.add_argument('--prescreenMargin',
+                        help='Only reject points with a tree-level squared '
+                        'Higgs mass below -(margin^2), to allow for loop '
+                        'corrections. In GeV.',
+                        type=float,
+                        default=tree_level.DEFAULT_MARGIN)
+    parser.add_argument('--staged',
+                        help='First run NMSSMTools over all points with cheap '
+                        'settings (lower Higgs mass precision, no micrOMEGAs), '
+                        'then only run the full card & other tools over points '
+                        'passing loose cuts, and not failing constraints that '
+                        "don't depend on those settings (e.g. flavour, "
+                        'sparticle limits). Timings & survival fraction are '
+                        'written to stages_*.csv.',
+                        action='store_true')
+    parser.add_argument('--stageMa1Max',
+                        help='Stage 1 cut: require 0 < ma1 < this (GeV)',
+                        type=float,
+                        default=80.)
+    parser.add_argument('--stageMhWindow',
+                        help='Stage 1 cut: require h1 or h2 within this of 125 GeV',
+                        type=float,
+                        default=10.)
+    parser.add_argument('--ntScan',
+                        help="Experimental: use NMSSMTools' own random scan (ISCAN=2): write "
+                        "one scan card per --jobs covering the parameter "
+                        "ranges, run NMSSMTools once on each, and collect the "
+                        "points into ntscan_*.csv. Priors are ignored, and "
+                        "HiggsBounds/HiggsSignals are not run. The column layout "
+                        "read from NMSSMTools' out*.dat tables has not been "
+                        "checked against a real scan run yet, see "
+                        "testing/check_nt_scan_table.py.",
+                        action='store_true')
     parser.add_argument('--NT',
                         help='NMSSMTools directory',
                         required=True,
@@ -55,6 +159,91 @@ def NMSSMScan(in_args=sys.argv[1:]):
                         help="sushi directory (don't include /bin",
                         type=str)
                         # action='store_true')
+    parser.add_argument('--hbhsBatch',
+                        help='Run HiggsBounds/HiggsSignals once per this many '
+                        'spectra, using their multi-point (effC) input, rather '
+                        'than once per point. 0 = once per point (the default). '
+                        'Experimental: not yet validated against once per '
+                        'point, see testing/check_hbhs_batch.py. '
+                        'Not used in --mcmc mode.',
+                        type=int,
+                        default=0)
+    parser.add_argument('-j', '--jobs',
+                        help='Number of points to run in parallel. Each parallel '
+                        'worker gets its own copy of the tool directories.',
+                        type=int,
+                        default=1)
+    parser.add_argument('--workDir',
+                        help='Directory to put per-worker copies of tool '
+                        'directories, if --jobs > 1',
+                        default=os.path.join(os.getcwd(), 'workers'))
+    parser.add_argument('--keepUnphysical',
+                        help='Keep spectrum files for points NMSSMTools flags '
+                        'as unphysical (by default these are deleted straight '
+                        'away; HiggsBounds/HiggsSignals are never run on them)',
+                        action='store_true')
+    parser.add_argument('--analyse',
+                        help='Parse each point as soon as it finishes, as '
+                        'analyse_scans.py would, writing output<batch>.csv, '
+                        'output_good<batch>.csv & output_ma1Lt11<batch>.csv. '
+                        'Spectrum files are then only kept for "good" points '
+                        'and a random --keepFraction of the rest. '
+                        'Not used in --mcmc or --ntScan mode.',
+                        action='store_true')
+    parser.add_argument('--keepFraction',
+                        help='With --analyse, fraction of spectrum files to '
+                        'keep, on top of those for good points',
+                        type=float,
+                        default=0)
+    parser.add_argument('--flushDir',
+                        help='Every so often, copy newly finished spectra (as '
+                        'partial<batch>_<N>.tgz) and the checkpoint journal '
+                        '(as journal<batch>.txt) to this directory, e.g. the '
+                        'HDFS job dir, so an evicted job can be resumed. '
+                        'In --mcmc mode, the chain CSVs & checkpoints are '
+                        'instead copied to mcmc<batch>/ in this directory '
+                        'after every step.',
+                        default=None)
+    parser.add_argument('--flushEvery',
+                        help='Flush to --flushDir once this many spectra are done...',
+                        type=int,
+                        default=200)
+    parser.add_argument('--flushMinutes',
+                        help='...or this many minutes after the last flush',
+                        type=float,
+                        default=15)
+    parser.add_argument('--ntTimeout',
+                        help='Kill NMSSMTools if it takes longer than this '
+                        'many seconds on a point (0 = no limit)',
+                        type=float,
+                        default=0)
+    parser.add_argument('--hbTimeout',
+                        help='Kill HiggsBounds after this many seconds (0 = no limit)',
+                        type=float,
+                        default=0)
+    parser.add_argument('--hsTimeout',
+                        help='Kill HiggsSignals after this many seconds (0 = no limit)',
+                        type=float,
+                        default=0)
+    parser.add_argument('--retries',
+                        help='Number of times to retry a program that times out',
+                        type=int,
+                        default=0)
+    parser.add_argument('--cache',
+                        help='Directory of the result cache: points whose card '
+                        'has been run before with the same tools & patches get '
+                        'their spectrum copied from here instead of being rerun. '
+                        'Can be shared between jobs.',
+                        default=None)
+    parser.add_argument('--cacheSize',
+                        help='Maximum size of the result cache in GB; the '
+                        'least-recently-used entries are deleted beyond this',
+                        type=float,
+                        default=10)
+    parser.add_argument('--copyTools',
+                        help='Fully copy tool directories for each worker, '
+                        'instead of hardlinking executables, libraries & tables',
+                        action='store_true')
     parser.add_argument("--dry",
                         help="Dry run, don't run programs.",
                         action='store_true')
@@ -75,103 +264,762 @@ def NMSSMScan(in_args=sys.argv[1:]):
     cu.check_file_exists(args.param)
     if args.number < 1:
         log.error('-n|--number must have an argument >= 1')
+    if args.jobs < 1:
+        log.error('-j|--jobs must have an argument >= 1')
     if not args.oDir:
         # generate output directory if one not specified
         args.oDir = generate_odir()
     cu.check_create_dir(args.oDir, args.v)
 
-    # read template card
-    with open(args.card) as template_file:
-        template = template_file.readlines()
-
-    # read in JSON file with parameters and bounds
-    with open(args.param) as json_file:
-        param_dict = json.load(json_file)
-        # remove any comments
-        rm_keys = []
-        for k in param_dict.iterkeys():
-            if k.startswith('_'):
-                rm_keys.append(k)
-        for k in rm_keys:
-            log.debug('Removing entry %s' % k)
-            del param_dict[k]
-
-    # loop over number of points requested, making an input card for each
-    for ind in xrange(args.number):
+    # read in JSON file with parameters, bounds and priors
+    params = sampling.load_param_ranges(args.param)
 
-        if ind % 200 == 0:
-            log.info('Processing %dth point at %s', ind, strftime("%H%M%S"))
-
-        # generate a random point within the range
-        for v in param_dict.itervalues():
-            v['value'] = random.uniform(v['min'], v['max'])
-
-        # replace values in the card text
-        # eurgh stupid string in python
-        new_card_text = template[:]
-        for i in range(len(new_card_text)):
-            for k, v in param_dict.iteritems():
-                s_match = r'(\s+\d+\s+)[\w.]+(\s+#\s%s.*)' % k
-                s_repl = r'\g<1>' + str(v['value']) + 'D0\g<2>'
-                new_card_text[i] = re.sub(s_match, s_repl, new_card_text[i])
-
-        # write a new card
-        new_card_path = generate_new_card_path(args.oDir, args.card, ind)
-        log.debug('New card: %s' % new_card_path)
-        with open(new_card_path, 'w') as new_card:
-            for line in new_card_text:
-                new_card.write(line)
-
-        base_dir = os.getcwd()
-
-        if args.dry:
-            continue
-
-        # Run your tools!
-        # --------------------------------------------------------------------
-        # run NMSSMTools with the new card
-        # NMSSMTools requires relpath NOT abspath!
-        os.chdir(args.NT)
-        ntools_cmds = ['./run', os.path.relpath(new_card_path)]
-        log.debug(ntools_cmds)
-        call(ntools_cmds)
-        os.chdir(base_dir)
-
-        spectr_name = new_card_path.replace('inp', 'spectr')
-        if args.HB or args.HS:
-            # need to add in DMASS block for HB/HS
-            # this is somewhat aribitrary
-            add_dmass_block(spectr=spectr_name, dmh1=2, dmh2=2)
+    # parse template card once
+    template = CardTemplate.from_file(args.card, [p.name for p in params])
+
+    if args.seed is None:
+        # if resuming, carry on with the same seed
+        settings = scan_journal.read_settings(generate_journal_path(args.oDir, args.card))
+        args.seed = settings['seed'] if settings else sampling.new_seed()
+
+    tool_dirs = {'NT': args.NT, 'HB': args.HB, 'HS': args.HS, 'sushi': args.sushi}
 
-        # run HiggsBounds and HiggsSignals
-        if args.HB:
-            os.chdir(args.HB)
-            hb_cmds = ['./HiggsBounds', 'LandH', 'SLHA', '5', '1', os.path.relpath(spectr_name)]
-            log.debug(hb_cmds)
-            call(hb_cmds)
-            os.chdir(base_dir)
-
-        if args.HS:
-            os.chdir(args.HS)
-            hs_cmds = ['./HiggsSignals', 'latestresults', 'peak', '2', 'SLHA', '5', '1', os.path.relpath(spectr_name)]
-            log.debug(hs_cmds)
-            call(hs_cmds)
-            os.chdir(base_dir)
-
-        if args.sushi:
-            pass
-            # os.chdir(args.sushi, 'bin'))
-            # sushi_cmds = ['./sushi', input, output]
-            # log.debug(sushi_cmds)
-            # call(sushi_cmds)
-            # os.chidr(base_dir)
+    args.result_cache = None
+    if args.cache and not args.dry:
+        args.result_cache = ResultCache(args.cache, args.cacheSize)
+        args.result_cache.evict()
+
+    if args.analyse and (args.mcmc or args.ntScan):
+        log.warning('--analyse is ignored in --mcmc & --ntScan modes')
+
+    n_timeouts, n_failed = None, None
+    if args.mcmc:
+        run_mcmc_scan(args, params, template, tool_dirs)
+    elif args.ntScan:
+        run_nt_scan(args, params, template, tool_dirs)
+    else:
+        n_timeouts, n_failed = run_sampled_scan(args, params, template, tool_dirs)
 
     # print some stats
     print '*' * 40
     print '* Num iterations:', args.number
+    if n_timeouts:
+        for name, n in sorted(n_timeouts.iteritems()):
+            print '* Num points timed out in %s: %d' % (name, n)
+    if n_failed:
+        print '* Num points failed (redone on resuming): %d' % n_failed
     print '*' * 40
 
 
+def run_sampled_scan(args, params, template, tool_dirs):
+    """Generate all points up front, write all the cards, then run the tools
+    over them.
+
+    Points that fail with an error (e.g. the worker raised) aren't recorded
+    in the journal, so they're redone when resuming.
+
+    Returns a dict of the number of points that timed out in each program,
+    and the number of points that failed.
+    """
+    log.info('Sampling %d points with %s sampler, seed %d, batch %d',
+             args.number, args.sampler, args.seed, args.batch)
+    values = sampling.sample_points(params, args.number, args.seed, args.batch,
+                                    args.sampler, args.nBatches)
+    indices = range(args.number)
+    prescreen_pass = None
+
+    if args.prescreen != 'none':
+        values, prescreen_pass = prescreen_points(args, params, template, values)
+        if args.prescreen == 'reject':
+            indices = [i for i in indices if prescreen_pass[i]]
+
+    sampling.write_manifest(generate_manifest_path(args.oDir, args.card),
+                            params, values, args.seed, args.batch,
+                            args.sampler, args.nBatches, prescreen_pass)
+    points = sampling.points_to_dicts(params, values)
+
+    if args.dry:
+        # write all the new cards in one go
+        template.write_cards([generate_new_card_path(args.oDir, args.card, ind) for ind in indices],
+                             [points[ind] for ind in indices])
+        log.info('Dry run, not running any programs')
+        return {}, 0
+
+    # skip any points already done by an earlier attempt at this job
+    journal = scan_journal.ScanJournal(generate_journal_path(args.oDir, args.card),
+                                       journal_settings(args))
+    indices = [ind for ind in indices if ind not in journal.done]
+
+    outputs, keep = None, None
+    if args.analyse:
+        # batched HiggsSignals gives no per-observable results
+        drop = analyse_scans.HS_OBSERVABLE_COLUMNS if args.hbhsBatch > 0 else None
+        # only carry on with existing CSVs when resuming, not from another scan
+        outputs = analyse_scans.OutputCSVs(args.oDir, str(args.batch), append=bool(journal.done),
+                                           drop=drop)
+        keep = sampling.get_rng(args.seed, args.batch, KEEP_SUB_STREAM).rand(args.number) < args.keepFraction
+    flusher = None
+    if args.flushDir:
+        cu.check_create_dir(args.flushDir, args.v)
+        flusher = scan_journal.SpectrumFlusher(args.flushDir, journal, args.batch,
+                                               args.flushEvery, args.flushMinutes,
+                                               extra_files=outputs.filenames if outputs else None)
+
+    timing_log = scan_timing.TimingLog(generate_timing_path(args.oDir, args.card))
+    point_timings = {}
+
+    def finish_points(inds):
+        """Record points as done, and queue their spectra to be saved"""
+        spectra = [generate_new_card_path(args.oDir, args.card, ind).replace('inp', 'spectr')
+                   for ind in inds]
+        if outputs:
+            for ind, spectr in izip(inds, spectra):
+                with scan_timing.stage_timer(point_timings.setdefault(ind, {}), 'analyse'):
+                    analyse_point(spectr, outputs, keep[ind], args.keepUnphysical)
+            outputs.flush()
+        journal.record(inds)
+        for ind in inds:
+            if ind in point_timings:
+                timing_log.record(ind, point_timings.pop(ind))
+        if flusher:
+            flusher.add(spectra)
+
+    worker_dirs = get_worker_dirs(args, tool_dirs)
+    n_timeouts = {}
+    failed = {}  # {index: error message}, for points to redo
+
+    if args.staged:
+        stage1_start = time.time()
+        stage1_results = run_stage1(args, template, points, indices, worker_dirs)
+        stage1_time = time.time() - stage1_start
+        n_timeouts = report_timeouts(stage1_results)
+        failed.update({ind: r['error'] for ind, r in stage1_results.iteritems() if 'error' in r})
+        finish_points([ind for ind in indices
+                       if not stage1_results[ind]['pass'] and ind not in failed])
+        indices = [ind for ind in indices if stage1_results[ind]['pass']]
+
+    # write all the new cards in one go
+    card_paths = {ind: generate_new_card_path(args.oDir, args.card, ind)
+                  for ind in indices}
+    render_timings = []
+    template.write_cards([card_paths[ind] for ind in indices],
+                         [points[ind] for ind in indices], render_timings)
+    log.info('Written %d cards at %s', len(card_paths), strftime("%H%M%S"))
+    for ind, timing in izip(indices, render_timings):
+        point_timings[ind] = {'render': timing}
+
+    # with --hbhsBatch, only run NMSSMTools per point, then HB/HS over batches
+    batch_hbhs = args.hbhsBatch > 0 and (tool_dirs['HB'] or tool_dirs['HS'])
+
+    def run_point(ind, tool_dirs):
+        start = time.time()
+        if batch_hbhs:
+            tool_dirs = {'NT': tool_dirs['NT']}
+        result = run_cached_tool_chain(args.result_cache, card_paths[ind], tool_dirs,
+                                       not args.keepUnphysical, get_timeouts(args), args.retries)
+        result['time'] = time.time() - start
+        return result
+
+    def needs_batch(ind, result):
+        """Whether a point still needs batched HB/HS, i.e. NMSSMTools ran
+        without problems and left a spectrum file"""
+        return (batch_hbhs and not any(k in result for k in ['veto', 'timeout', 'error']) and
+                os.path.isfile(card_paths[ind].replace('inp', 'spectr')))
+
+    def point_done(ind, result):
+        point_timings[ind].update(result.get('timings', {}))
+        if 'error' in result:
+            failed[ind] = result['error']
+            return
+        # with batched HB/HS, a physical point isn't done until its batch is
+        if not needs_batch(ind, result):
+            finish_points([ind])
+        if ind % 200 == 0:
+            log.info('Processed %dth point at %s', ind, strftime("%H%M%S"))
+
+    def batch_done(inds, result):
+        if 'error' in result:
+            # leave the points out of the journal, so they're redone on resuming
+            log.error('HiggsBounds/HiggsSignals batch of points %s failed: %s',
+                      ', '.join(str(i) for i in inds), result['error'])
+            failed.update({ind: result['error'] for ind in inds})
+            return
+        # share the batch's HB/HS time out between its points
+        for stage, (wall, cpu) in result.get('timings', {}).iteritems():
+            for ind in inds:
+                point_timings[ind][stage] = (wall / len(inds), cpu / len(inds))
+        finish_points(inds)
+
+    run_start = time.time()
+    results = run_points(indices, run_point, worker_dirs, callback=point_done)
+    n_vetoed = len([r for r in results.itervalues() if r.get('veto')])
+    log.info('%d / %d points unphysical according to NMSSMTools, skipped other programs%s',
+             n_vetoed, len(results), '' if args.keepUnphysical else ' & deleted spectra')
+    if args.result_cache:
+        log.info('%d / %d points taken from the result cache',
+                 len([r for r in results.itervalues() if r.get('cached')]), len(results))
+    if batch_hbhs:
+        run_hbhs_batches(args, {ind: card_paths[ind].replace('inp', 'spectr')
+                                for ind in indices if needs_batch(ind, results[ind])},
+                         worker_dirs, callback=batch_done)
+    run_time = time.time() - run_start
+
+    if outputs:
+        outputs.close()
+        outputs.log_stats()
+    if flusher:
+        flusher.flush()
+    timing_log.summary()
+
+    if args.staged:
+        report_stages(generate_stages_path(args.oDir, args.card),
+                      stage1_results, stage1_time, results, run_time)
+
+    for name, n in report_timeouts(results).iteritems():
+        n_timeouts[name] = n_timeouts.get(name, 0) + n
+    return n_timeouts, report_failures(failed)
+
+
+def analyse_point(spectr, outputs, keep=False, keep_unphysical=False):
+    """Parse a finished point's spectrum file into the output CSVs, then
+    delete the file unless it's a good point or keep is set.
+
+    spectr : str
+        Spectrum filepath. Nothing is done if it doesn't exist
+        (e.g. an unphysical point, already deleted).
+    outputs : analyse_scans.OutputCSVs
+        Output CSVs to add the point to.
+    keep : bool
+        Keep the spectrum file regardless.
+    keep_unphysical : bool
+        Keep the spectrum file of an unphysical point.
+    """
+    if not os.path.isfile(spectr):
+        return
+    results = analyse_scans.get_point_results(spectr)
+    if results is None:
+        keep = keep or keep_unphysical
+    elif 'good' in outputs.add(results):
+        keep = True
+    if not keep:
+        os.remove(spectr)
+
+
+def get_timeouts(args):
+    """Get the per-tool timeouts (in seconds) from the command line args"""
+    return {'NT': args.ntTimeout, 'HB': args.hbTimeout, 'HS': args.hsTimeout}
+
+
+def report_timeouts(results):
+    """Log how many points timed out in each program, and which ones.
+    Returns a dict of {tool name: number of points}."""
+    timed_out = defaultdict(list)
+    for ind, result in results.iteritems():
+        if result.get('timeout'):
+            timed_out[result['timeout']].append(ind)
+    for name, inds in sorted(timed_out.iteritems()):
+        log.warning('%d points timed out in %s: %s', len(inds), name,
+                    ', '.join(str(i) for i in sorted(inds)))
+    return {name: len(inds) for name, inds in timed_out.iteritems()}
+
+
+def report_failures(failed):
+    """Log how many points failed with an error, and which ones.
+    failed is a dict of {point index: error message}. Returns the number of points."""
+    if failed:
+        log.warning('%d points failed, not recorded as done so will be redone on resuming: %s',
+                    len(failed), ', '.join(str(i) for i in sorted(failed)))
+    return len(failed)
+
+
+def journal_settings(args):
+    """Get the settings that determine the points, to check against the journal
+    when resuming."""
+    return {k: getattr(args, k) for k in ['seed', 'batch', 'number', 'sampler', 'nBatches',
+                                          'prescreen', 'prescreenMargin']}
+
+
+def run_hbhs_batches(args, spectra, worker_dirs, callback=None):
+    """Run HiggsBounds/HiggsSignals over spectrum files in batches of
+    args.hbhsBatch, with each worker taking whole batches.
+
+    spectra: dict
+        Map of point index to spectrum filepath.
+    callback: callable, optional
+        Called as callback(point indices, result) as each batch finishes.
+    """
+    indices = sorted(spectra)
+    batches = [indices[i:i + args.hbhsBatch]
+               for i in xrange(0, len(indices), args.hbhsBatch)]
+    log.info('Running HiggsBounds/HiggsSignals over %d spectra in %d batches',
+             len(spectra), len(batches))
+
+    def run_batch(ind, tool_dirs):
+        batch_dir = os.path.join(args.oDir, 'hbhs_batch_%d' % ind)
+        return hbhs_batch.run_batch([spectra[i] for i in batches[ind]],
+                                    tool_dirs['HB'], tool_dirs['HS'], batch_dir)
+
+    def batch_done(ind, result):
+        if callback:
+            callback(batches[ind], result)
+
+    return run_points(range(len(batches)), run_batch, worker_dirs, callback=batch_done)
+
+
+def get_worker_dirs(args, tool_dirs):
+    """Get the tool directories for each worker (just one if args.jobs == 1)"""
+    if args.jobs > 1:
+        # run points in parallel, each worker with its own tool directories
+        log.info('Running over points with %d workers', args.jobs)
+        return setup_worker_dirs(tool_dirs, args.workDir, args.jobs,
+                                 hardlink=not args.copyTools)
+    return [tool_dirs]
+
+
+def run_stage1(args, template, points, indices, worker_dirs):
+    """Run NMSSMTools alone over all points with the cheap settings
+    (STAGE1_MODSEL), and see which points pass the stage 1 cuts.
+
+    Stage 1 files are put in a separate directory, which is deleted afterwards.
+
+    Returns a dict of {index: result dict}, where each result has 'pass',
+    'time' and the STAGE1_FIELDS values.
+    """
+    stage1_dir = os.path.join(args.oDir, 'stage1')
+    cu.check_create_dir(stage1_dir, args.v)
+    cheap_template = template.with_block_entries(STAGE1_MODSEL)
+    card_paths = {ind: generate_new_card_path(stage1_dir, args.card, ind)
+                  for ind in indices}
+    cheap_template.write_cards([card_paths[ind] for ind in indices],
+                               [points[ind] for ind in indices])
+    fields = analyse_scans.fields_by_name(STAGE1_FIELDS)
+
+    def run_point(ind, tool_dirs):
+        start = time.time()
+        return_codes = run_cached_tool_chain(args.result_cache, card_paths[ind],
+                                             {'NT': tool_dirs['NT']}, not args.keepUnphysical,
+                                             get_timeouts(args), args.retries)
+        result = {'time': time.time() - start, 'timeout': return_codes.get('timeout')}
+        result.update(stage1_cuts(card_paths[ind].replace('inp', 'spectr'), fields,
+                                  args.stageMa1Max, args.stageMhWindow))
+        return result
+
+    def log_progress(ind, result):
+        if ind % 200 == 0:
+            log.info('Stage 1: processed %dth point at %s', ind, strftime("%H%M%S"))
+
+    results = run_points(indices, run_point, worker_dirs, callback=log_progress)
+    for ind, result in results.iteritems():
+        if 'error' in result:
+            log.error('Stage 1 failed for point %d: %s', ind, result['error'])
+            failed = {f.name: '' for f in fields}
+            failed.update({'pass': False, 'time': 0., 'timeout': None, 'error': result['error']})
+            results[ind] = failed
+    shutil.rmtree(stage1_dir)
+    return results
+
+
+def stage1_cuts(spectr, fields, ma1_max, mh_window):
+    """Decide whether a stage 1 spectrum is worth running at full precision.
+
+    Requires a physical point, no failed constraints matching
+    STAGE1_CONSTRAINTS, 0 < ma1 < ma1_max, and either h1 or h2 within
+    mh_window of 125 GeV. The cuts should be looser than the final ones,
+    since the stage 1 masses are less precise.
+
+    Returns a dict with 'pass' and the values of the fields.
+    """
+    result = {f.name: '' for f in fields}
+    result['pass'] = False
+    if not os.path.isfile(spectr):
+        return result
+    constraints, values = analyse_scans.read_nmssmtools_spectrum(spectr, fields)
+    if constraints is None:
+        return result
+    result.update(values)
+    del result['file']
+    vetoes = [c for c in constraints if STAGE1_CONSTRAINTS.search(c)]
+    if vetoes:
+        log.debug('Stage 1: %s fails %s', spectr, ', '.join(vetoes))
+        return result
+    if result['ma1'] == '' or not 0 < result['ma1'] < ma1_max:
+        return result
+    result['pass'] = any(result[m] != '' and abs(result[m] - 125.) < mh_window
+                         for m in ['mh1', 'mh2'])
+    return result
+
+
+def report_stages(filename, stage1_results, stage1_time, stage2_results, stage2_time):
+    """Write per-point stage 1 & 2 timings & results to CSV, and log a summary."""
+    columns = ['index', 'stage1_time', 'stage1_pass'] + STAGE1_FIELDS + ['stage2_time']
+    with open(filename, 'w') as f:
+        f.write(','.join(columns) + '\n')
+        for ind in sorted(stage1_results):
+            r1 = stage1_results[ind]
+            r2 = stage2_results.get(ind, {})
+            row = ([ind, r1['time'], int(r1['pass'])] + [r1[k] for k in STAGE1_FIELDS] +
+                   [r2.get('time', '')])
+            f.write(','.join([str(x) for x in row]) + '\n')
+
+    n1, n2 = len(stage1_results), len(stage2_results)
+    mean1 = sum(r['time'] for r in stage1_results.itervalues()) / max(n1, 1)
+    mean2 = sum(r['time'] for r in stage2_results.itervalues()) / max(n2, 1)
+    log.info('#' * 60)
+    log.info('# Stage 1: %d points in %.1f s (%.3f s per point)', n1, stage1_time, mean1)
+    log.info('# Stage 2: %d points in %.1f s (%.3f s per point)', n2, stage2_time, mean2)
+    log.info('# Survival fraction: %.3f', n2 / float(max(n1, 1)))
+    if n2:
+        log.info('# Time for stage 2 over all points would have been ~%.1f s', mean2 * n1)
+    log.info('# Per-point results written to %s', filename)
+    log.info('#' * 60)
+
+
+def prescreen_points(args, params, template, values):
+    """Check points with the tree-level Higgs masses, and resample any that
+    are clearly tachyonic if args.prescreen == 'resample'.
+
+    Parameters needed for the tree-level masses that aren't being scanned
+    are taken from the template card.
+
+    Returns (values, boolean array of whether each original point passed)
+    """
+    names = [p.name for p in params]
+
+    def get_tree_inputs(values):
+        inputs = {}
+        for k in tree_level.PARAM_NAMES:
+            if k in names:
+                inputs[k] = values[:, names.index(k)]
+            else:
+                inputs[k] = template.template_value(k)
+                if inputs[k] is None:
+                    raise RuntimeError('%s is neither scanned nor set in the card '
+                                       'template, cannot do tree-level prescreen' % k)
+        return inputs
+
+    passed, n_fail = tree_level.prescreen(get_tree_inputs(values), args.prescreenMargin)
+    tree_level.report(passed, n_fail)
+    original_pass = passed.copy()
+
+    if args.prescreen == 'resample':
+        values = values.copy()
+        rng = sampling.get_rng(args.seed, args.batch, sub_stream=1)
+        for _ in xrange(100):
+            if passed.all():
+                break
+            redo = np.flatnonzero(~passed)
+            u = rng.random_sample((len(redo), len(params)))
+            values[redo] = sampling.transform_points(params, u)
+            passed[redo], _ = tree_level.prescreen(get_tree_inputs(values[redo]),
+                                                   args.prescreenMargin)
+        if not passed.all():
+            log.warning('Could not find passing replacements for %d points', (~passed).sum())
+        log.info('Resampled %d points', (~original_pass).sum())
+
+    return values, original_pass
+
+
+def run_mcmc_scan(args, params, template, tool_dirs):
+    """Run one Markov chain per worker. Chain C uses point indices
+    C, C + n_chains, C + 2*n_chains, ... so card/spectrum names stay unique.
+
+    Each chain is checkpointed, so re-running the same command resumes
+    any unfinished chains.
+    """
+    if args.dry:
+        log.error('Cannot do a dry run in MCMC mode, since each point depends on the last')
+        return
+
+    n_chains = args.jobs
+    log.info('Running %d Markov chain(s) for %d points in total, seed %d, batch %d',
+             n_chains, args.number, args.seed, args.batch)
+    # Use the sampler to pick well-spread starting points
+    u_start = sampling.sample_unit_cube(n_chains, len(params), args.seed, args.batch,
+                                        args.sampler, args.nBatches)
+    backup_dir = None
+    if args.flushDir:
+        backup_dir = os.path.join(args.flushDir, 'mcmc%d' % args.batch)
+        cu.check_create_dir(backup_dir, args.v)
+
+    def run_one_chain(chain, tool_dirs):
+
+        def evaluate(ind, values):
+            card_path = generate_new_card_path(args.oDir, args.card, ind)
+            with open(card_path, 'w') as new_card:
+                new_card.write(template.render(values))
+            run_cached_tool_chain(args.result_cache, card_path, tool_dirs,
+                                  not args.keepUnphysical, get_timeouts(args), args.retries)
+            return card_path.replace('inp', 'spectr')
+
+        state = scan_mcmc.run_chain(params,
+                                    indices=range(chain, args.number, n_chains),
+                                    u_start=u_start[chain],
+                                    rng=sampling.get_rng(args.seed, args.batch, chain),
+                                    evaluate=evaluate,
+                                    checkpoint_file=os.path.join(args.oDir, 'mcmc_state_%d.json' % chain),
+                                    chain_file=os.path.join(args.oDir, 'mcmc_chain_%d.csv' % chain),
+                                    backup_dir=backup_dir)
+        return {'steps': state.step, 'accepted': state.n_accepted}
+
+    def log_chain(chain, result):
+        log.info('Chain %d finished: %s', chain, result)
+
+    if n_chains > 1:
+        worker_dirs = setup_worker_dirs(tool_dirs, args.workDir, n_chains,
+                                        hardlink=not args.copyTools)
+        run_pool(xrange(n_chains), worker_dirs, run_one_chain, callback=log_chain)
+    else:
+        log_chain(0, run_one_chain(0, tool_dirs))
+
+
+def run_nt_scan(args, params, template, tool_dirs):
+    """Use NMSSMTools' own random scan mode: each worker gets a scan card
+    with its share of the points, NMSSMTools is run once per card, and the
+    tables of points are collected into one CSV. Experimental, see
+    nmssmtools_scan."""
+    log.warning('NMSSMTools scan mode is experimental: the out*.dat column layout '
+                'has not been checked against a real scan run')
+    if tool_dirs['HB'] or tool_dirs['HS']:
+        log.warning('HiggsBounds/HiggsSignals are not run in NMSSMTools scan mode')
+    if args.sampler != 'random' or args.prescreen != 'none' or args.staged:
+        log.warning('--sampler, --prescreen & --staged are ignored in NMSSMTools scan mode')
+
+    scan_dir = os.path.join(args.oDir, 'ntscan')
+    cu.check_create_dir(scan_dir, args.v)
+    n_cards = min(args.jobs, args.number)
+    iseeds = sampling.get_rng(args.seed, args.batch).randint(1, 2**31 - 1, size=n_cards)
+    card_paths = [generate_new_card_path(scan_dir, args.card, ind) for ind in xrange(n_cards)]
+    for ind, card_path in enumerate(card_paths):
+        n_points = len(xrange(ind, args.number, n_cards))
+        with open(card_path, 'w') as card:
+            card.write(nmssmtools_scan.make_scan_card(template, params, n_points, iseeds[ind]))
+    log.info('Written %d scan cards for %d points, seed %d, batch %d',
+             n_cards, args.number, args.seed, args.batch)
+
+    if args.dry:
+        log.info('Dry run, not running any programs')
+        return
+
+    def run_scan(ind, tool_dirs):
+        start = time.time()
+        nt_dir = tool_dirs['NT']
+        return_code = call(['./run', os.path.relpath(card_paths[ind], nt_dir)], cwd=nt_dir)
+        return {'NT': return_code, 'time': time.time() - start}
+
+    worker_dirs = get_worker_dirs(args, {'NT': tool_dirs['NT']})
+    results = run_points(range(n_cards), run_scan, worker_dirs)
+
+    # same columns as the analyse_scans output, blank if not in the scan table
+    columns = sorted([f.name for f in analyse_scans.point_fields()] + ['constraints', 'file'])
+    n_failed = 0
+    csv_path = generate_nt_scan_path(args.oDir, args.card)
+    with open(csv_path, 'w') as f:
+        f.write(','.join(columns) + '\n')
+        n_passed = 0
+        for ind, card_path in enumerate(card_paths):
+            if 'error' in results[ind]:
+                log.error('NMSSMTools scan of %s failed: %s', card_path, results[ind]['error'])
+                continue
+            out_path, err_path = nmssmtools_scan.scan_output_paths(card_path)
+            if not os.path.isfile(out_path):
+                log.error('No NMSSMTools scan output %s', out_path)
+                continue
+            for row, point in enumerate(nmssmtools_scan.read_scan_table(out_path), 1):
+                point.update({'constraints': '', 'file': '%s:%d' % (os.path.basename(out_path), row)})
+                f.write(','.join([str(point.get(c, '')) for c in columns]) + '\n')
+                n_passed += 1
+            if os.path.isfile(err_path):
+                n_failed += len(nmssmtools_scan.read_scan_table(err_path))
+
+    log.info('NMSSMTools scan gave %d points passing constraints and %d failing, '
+             'out of %d, in %.1f s, written to %s', n_passed, n_failed, args.number,
+             max([r.get('time', 0.) for r in results.itervalues()] or [0.]), csv_path)
+
+
+def run_cached_tool_chain(cache, card_path, tool_dirs, delete_vetoed=True,
+                          timeouts=None, retries=0):
+    """Like run_tool_chain(), but first look for the card in the result cache.
+
+    cache : ResultCache
+        Cache to use. If None, just run the tool chain.
+
+    On a hit, the stored spectrum is copied into place, and the stored return
+    codes are returned with 'cached' set. On a miss, the tool chain is run and
+    its results stored, unless a program timed out.
+    """
+    if not cache:
+        return run_tool_chain(card_path, tool_dirs, delete_vetoed, timeouts, retries)
+
+    spectr_name = card_path.replace('inp', 'spectr')
+    with open(card_path) as f:
+        key = cache.key(f.read(), tool_dirs)
+    return_codes = cache.fetch(key, spectr_name)
+    if return_codes is not None:
+        log.debug('Cache hit for %s', card_path)
+        if return_codes.get('veto') and delete_vetoed and os.path.isfile(spectr_name):
+            os.remove(spectr_name)
+        return return_codes
+
+    return_codes = run_tool_chain(card_path, tool_dirs, delete_vetoed, timeouts, retries)
+    if not return_codes.get('timeout'):
+        cache.store(key, spectr_name, return_codes)
+    return return_codes
+
+
+def run_tool_chain(card_path, tool_dirs, delete_vetoed=True, timeouts=None, retries=0):
+    """Run NMSSMTools, and optionally HiggsBounds & HiggsSignals over one card.
+
+    If NMSSMTools flags the point as unphysical (a show-stopper in SPINFO,
+    e.g. M_H1^2<1), or doesn't make a spectrum file, the other programs are
+    skipped, since the point would be thrown away in the analysis anyway.
+
+    Each program is run from inside its own directory (via cwd), so this is
+    safe to call from several processes at once, as long as each has its own
+    set of tool directories.
+
+    card_path : str
+        Absolute path of the input card.
+    tool_dirs : dict
+        Map of tool name ('NT', 'HB', 'HS', 'sushi') to directory. If a
+        directory is None, that program is not run.
+    delete_vetoed : bool
+        Delete the spectrum file of an unphysical point.
+    timeouts : dict
+        Map of tool name to timeout in seconds, see run_tool().
+    retries : int
+        Number of times to retry a program that times out.
+
+    Returns a dict of program return codes. For a vetoed point, this also has
+    a 'veto' entry with the reason, and if a program timed out (even after
+    retrying), a 'timeout' entry with its name. The 'timings' entry has the
+    (wall, cpu) time of each stage, see scan_timing.
+    """
+    return_codes = {'timings': {}}
+
+    # run NMSSMTools with the new card
+    # NMSSMTools requires relpath NOT abspath!
+    nt_dir = tool_dirs['NT']
+    ntools_cmds = ['./run', os.path.relpath(card_path, nt_dir)]
+    spectr_name = card_path.replace('inp', 'spectr')
+    if not run_tool('NT', ntools_cmds, nt_dir, return_codes, timeouts, retries):
+        # don't keep a half-written spectrum
+        if os.path.isfile(spectr_name):
+            os.remove(spectr_name)
+        return return_codes
+    if not os.path.isfile(spectr_name):
+        log.debug('No spectrum file %s', spectr_name)
+        return_codes['veto'] = 'no spectrum file'
+        return return_codes
+    showstoppers = analyse_scans.get_nmssmtools_showstoppers(spectr_name)
+    if showstoppers:
+        log.debug('Vetoing %s: %s', spectr_name, ', '.join(showstoppers))
+        return_codes['veto'] = ', '.join(showstoppers)
+        if delete_vetoed:
+            os.remove(spectr_name)
+        return return_codes
+
+    run_hbhs_slha(spectr_name, tool_dirs, return_codes, timeouts, retries)
+
+    if tool_dirs.get('sushi'):
+        pass
+        # sushi_cmds = ['./sushi', input, output]
+        # log.debug(sushi_cmds)
+        # call(sushi_cmds, cwd=os.path.join(tool_dirs['sushi'], 'bin'))
+
+    return return_codes
+
+
+def run_hbhs_slha(spectr_name, tool_dirs, return_codes, timeouts=None, retries=0):
+    """Run HiggsBounds and/or HiggsSignals on one spectrum file in SLHA mode,
+    which append their results to the file.
+
+    tool_dirs : dict
+        As for run_tool_chain(); only the 'HB' & 'HS' entries are used.
+    return_codes : dict
+        Return codes, timeouts & timings are added to this, see run_tool().
+    """
+    if tool_dirs.get('HB') or tool_dirs.get('HS'):
+        # need to add in DMASS block for HB/HS
+        # this is somewhat aribitrary
+        with scan_timing.stage_timer(return_codes.setdefault('timings', {}), 'DMASS'):
+            add_dmass_block(spectr=spectr_name, dmh1=2, dmh2=2)
+
+    # run HiggsBounds and HiggsSignals
+    hb_dir = tool_dirs.get('HB')
+    if hb_dir:
+        hb_cmds = ['./HiggsBounds', 'LandH', 'SLHA', '5', '1', os.path.relpath(spectr_name, hb_dir)]
+        run_tool('HB', hb_cmds, hb_dir, return_codes, timeouts, retries)
+
+    hs_dir = tool_dirs.get('HS')
+    if hs_dir:
+        hs_cmds = ['./HiggsSignals', 'latestresults', 'peak', '2', 'SLHA', '5', '1', os.path.relpath(spectr_name, hs_dir)]
+        run_tool('HS', hs_cmds, hs_dir, return_codes, timeouts, retries)
+
+
+def run_tool(name, cmds, cwd, return_codes, timeouts=None, retries=0):
+    """Run one program, killing it if it takes too long.
+
+    name : str
+        Tool name, e.g. 'NT'.
+    cmds : list of str
+        Command to run.
+    cwd : str
+        Directory to run it in.
+    return_codes : dict
+        The return code is stored in here under `name`, or 'timeout' if it
+        timed out on every attempt, in which case return_codes['timeout'] is
+        also set to `name`. The time taken (including any retries) is stored
+        in return_codes['timings'][name].
+    timeouts : dict
+        Map of tool name to timeout in seconds. No entry (or 0) means no timeout.
+    retries : int
+        Number of extra attempts if it times out.
+
+    Returns True if the program finished, False if it timed out.
+    """
+    log.debug(cmds)
+    timeout = (timeouts or {}).get(name)
+    for attempt in xrange(retries + 1):
+        with scan_timing.stage_timer(return_codes.setdefault('timings', {}), name):
+            return_code = call_with_timeout(cmds, cwd, timeout)
+        if return_code is not None:
+            return_codes[name] = return_code
+            return True
+        log.warning('%s timed out after %g s running %s (attempt %d of %d)',
+                    name, timeout, ' '.join(cmds), attempt + 1, retries + 1)
+    return_codes[name] = 'timeout'
+    return_codes['timeout'] = name
+    return False
+
+
+def call_with_timeout(cmds, cwd, timeout=None):
+    """Like subprocess.call, but kill the program, and anything it started,
+    if it runs for longer than `timeout` seconds.
+
+    Returns the return code, or None if it timed out.
+    """
+    if not timeout:
+        return call(cmds, cwd=cwd)
+    # own process group, so we can also kill e.g. micrOMEGAs started by ./run
+    proc = Popen(cmds, cwd=cwd, preexec_fn=os.setsid)
+    timed_out = []
+
+    def kill():
+        timed_out.append(True)
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except OSError:
+            pass  # already finished
+
+    timer = threading.Timer(timeout, kill)
+    timer.start()
+    try:
+        return_code = proc.wait()
+    finally:
+        timer.cancel()
+    return None if timed_out else return_code
+
+
 def add_dmass_block(spectr, dmh1=2, dmh2=2):
     """Add DMASS block to spectrum file so can be used with
     HiggsBounds/HiggsSignals correctly.
@@ -193,6 +1041,37 @@ def generate_odir():
     return os.path.join(os.getcwd(), 'jobs_%s' % (strftime("%d_%b_%y_%H%M")))
 
 
+def generate_stages_path(oDir, card):
+    """Generate the filepath for the per-point staged-mode summary."""
+    stem = os.path.splitext(os.path.basename(card))[0]
+    return os.path.abspath(os.path.join(oDir, 'stages_%s.csv' % stem))
+
+
+def generate_nt_scan_path(oDir, card):
+    """Generate the filepath for the CSV of points from NMSSMTools scan mode."""
+    stem = os.path.splitext(os.path.basename(card))[0]
+    return os.path.abspath(os.path.join(oDir, 'ntscan_%s.csv' % stem))
+
+
+def generate_timing_path(oDir, card):
+    """Generate the filepath for the per-point stage timings."""
+    stem = os.path.splitext(os.path.basename(card))[0]
+    return os.path.abspath(os.path.join(oDir, 'timing_%s.csv' % stem))
+
+
+def generate_journal_path(oDir, card):
+    """Generate the filepath for the checkpoint journal."""
+    stem = os.path.splitext(os.path.basename(card))[0]
+    return os.path.abspath(os.path.join(oDir, 'journal_%s.txt' % stem))
+
+
+def generate_manifest_path(oDir, card):
+    """Generate the filepath for the parameter manifest, to sit alongside
+    the cards made from template `card`."""
+    stem = os.path.splitext(os.path.basename(card))[0]
+    return os.path.abspath(os.path.join(oDir, 'params_%s.npz' % stem))
+
+
 def generate_new_card_path(oDir, card, ind):
     """Generate a new filepath for the output card.
 
@@ -1,6 +1,8 @@
 """Declare all the fields & associated regexes you want for pulling info from NMSSMTools spectrum file
 
 Use ([E\d\.\-\+]+) to capture a floating-point number group.
+
+Branching ratios & widths are DecayFields instead, given by PDGIDs.
 """
 
 
@@ -29,6 +31,32 @@ class Field(object):
       return 'Field({0})'.format(self.__dict__)
 
 
+class DecayField(Field):
+    """A branching ratio from the DECAY table of the parent particle, or its
+    total width if daughters is None.
+
+    Looked up by PDGID in the parsed DECAY tables (see
+    slha_parser.parse_decays()), so doesn't need a regex or comment. The
+    order of the daughters doesn't matter.
+    """
+    def __init__(self, name, parent, daughters=None, type=float):
+        self.block = 'DECAY'
+        self.regex = None
+        self.name = name
+        self.type = type
+        self.comment = None
+        self.parent = parent
+        self.daughters = None if daughters is None else tuple(sorted(daughters))
+
+
+# PDGIDs for DecayFields
+S, C, B = 3, 4, 5
+MU, TAU = 13, 15
+GLUON, PHOTON, Z, W = 21, 22, 23, 24
+H1, H2, H3 = 25, 35, 45
+A1 = 36
+
+
 nmssmtools_fields = [
     # parameters
     Field(block='MINPAR', name="tgbeta", type=float,
@@ -237,130 +265,50 @@ nmssmtools_fields = [
 
     # Higgs branching ratios
     # h1
-    Field(block='DCINFO', name="Brh1gg", type=float,
-          regex=re.compile(r' +([E\d\.\-\+]+) +2 +21 +21 +\# BR\(H_1 \-> gluon gluon\)'),
-          comment=''),
-    Field(block='DCINFO', name="Brh1mumu", type=float,
-          regex=re.compile(r' +([E\d\.\-\+]+) +2 +13 +\-13 +\# BR\(H_1 \-> muon muon\)'),
-          comment=''),
-    Field(block='DCINFO', name="Brh1tautau", type=float,
-          regex=re.compile(r' +([E\d\.\-\+]+) +2 +15 +\-15 +\# BR\(H_1 \-> tau tau\)'),
-          comment=''),
-    Field(block='DCINFO', name="Brh1cc", type=float,
-          regex=re.compile(r' +([E\d\.\-\+]+) +2 +4 +\-4 +\# BR\(H_1 \-> c cbar\)'),
-          comment=''),
-    Field(block='DCINFO', name="Brh1bb", type=float,
-          regex=re.compile(r' +([E\d\.\-\+]+) +2 +5 +\-5 +\# BR\(H_1 \-> b bbar\)'),
-          comment=''),
-    Field(block='DCINFO', name="Brh1ww", type=float,
-          regex=re.compile(r' +([E\d\.\-\+]+) +2 +24 +\-24 +\# BR\(H_1 \-> W\+ W\-\)'),
-          comment=''),
-    Field(block='DCINFO', name="Brh1zz", type=float,
-          regex=re.compile(r' +([E\d\.\-\+]+) +2 +23 +23 +\# BR\(H_1 \-> Z Z\)'),
-          comment=''),
-    Field(block='DCINFO', name="Brh1gammagamma", type=float,
-          regex=re.compile(r' +([E\d\.\-\+]+) +2 +22 +22 +\# BR\(H_1 \-> gamma gamma\)'),
-          comment=''),
-    Field(block='DCINFO', name="Brh1zgamma", type=float,
-          regex=re.compile(r' +([E\d\.\-\+]+) +2 +23 +22 +\# BR\(H_1 \-> Z gamma\)'),
-          comment=''),
-    Field(block='DCINFO', name="Brh1a1a1", type=float,
-          regex=re.compile(r' +([E\d\.\-\+]+) +2 +36 +36 +\# BR\(H_1 \-> A_1 A_1\)'),
-          comment=''),
-    Field(block='DCINFO', name="Brh1a1z", type=float,
-          regex=re.compile(r' +([E\d\.\-\+]+) +2 +23 +36 +\# BR\(H_1 \-> A_1 Z\)'),
-          comment=''),
+    DecayField(name="Brh1gg", parent=H1, daughters=(GLUON, GLUON)),
+    DecayField(name="Brh1mumu", parent=H1, daughters=(MU, -MU)),
+    DecayField(name="Brh1tautau", parent=H1, daughters=(TAU, -TAU)),
+    DecayField(name="Brh1cc", parent=H1, daughters=(C, -C)),
+    DecayField(name="Brh1bb", parent=H1, daughters=(B, -B)),
+    DecayField(name="Brh1ww", parent=H1, daughters=(W, -W)),
+    DecayField(name="Brh1zz", parent=H1, daughters=(Z, Z)),
+    DecayField(name="Brh1gammagamma", parent=H1, daughters=(PHOTON, PHOTON)),
+    DecayField(name="Brh1zgamma", parent=H1, daughters=(Z, PHOTON)),
+    DecayField(name="Brh1a1a1", parent=H1, daughters=(A1, A1)),
+    DecayField(name="Brh1a1z", parent=H1, daughters=(Z, A1)),
 
     # h2
-    Field(block='DCINFO', name="Brh2gg", type=float,
-          regex=re.compile(r' +([E\d\.\-\+]+) +2 +21 +21 +\# BR\(H_2 \-> gluon gluon\)'),
-          comment=''),
-    Field(block='DCINFO', name="Brh2tautau", type=float,
-          regex=re.compile(r' +([E\d\.\-\+]+) +2 +15 +\-15 +\# BR\(H_2 \-> tau tau\)'),
-          comment=''),
-    Field(block='DCINFO', name="Brh2bb", type=float,
-          regex=re.compile(r' +([E\d\.\-\+]+) +2 +5 +\-5 +\# BR\(H_2 \-> b bbar\)'),
-          comment=''),
-    Field(block='DCINFO', name="Brh2ww", type=float,
-          regex=re.compile(r' +([E\d\.\-\+]+) +2 +24 +\-24 +\# BR\(H_2 \-> W\+ W\-\)'),
-          comment=''),
-    Field(block='DCINFO', name="Brh2zz", type=float,
-          regex=re.compile(r' +([E\d\.\-\+]+) +2 +23 +23 +\# BR\(H_2 \-> Z Z\)'),
-          comment=''),
-    Field(block='DCINFO', name="Brh2gammagamma", type=float,
-          regex=re.compile(r' +([E\d\.\-\+]+) +2 +22 +22 +\# BR\(H_2 \-> gamma gamma\)'),
-          comment=''),
-    Field(block='DCINFO', name="Brh2zgamma", type=float,
-          regex=re.compile(r' +([E\d\.\-\+]+) +2 +23 +22 +\# BR\(H_2 \-> Z gamma\)'),
-          comment=''),
-    Field(block='DCINFO', name="Brh2a1a1", type=float,
-          regex=re.compile(r' +([E\d\.\-\+]+) +2 +36 +36 +\# BR\(H_2 \-> A_1 A_1\)'),
-          comment=''),
-    Field(block='DCINFO', name="Brh2a1z", type=float,
-          regex=re.compile(r' +([E\d\.\-\+]+) +2 +23 +36 +\# BR\(H_2 \-> A_1 Z\)'),
-          comment=''),
-    Field(block='DCINFO', name="Brh2h1h1", type=float,
-          regex=re.compile(r' +([E\d\.\-\+]+) +2 +25 +25 +\# BR\(H_2 \-> H_1 H_1\)'),
-          comment=''),
+    DecayField(name="Brh2gg", parent=H2, daughters=(GLUON, GLUON)),
+    DecayField(name="Brh2tautau", parent=H2, daughters=(TAU, -TAU)),
+    DecayField(name="Brh2bb", parent=H2, daughters=(B, -B)),
+    DecayField(name="Brh2ww", parent=H2, daughters=(W, -W)),
+    DecayField(name="Brh2zz", parent=H2, daughters=(Z, Z)),
+    DecayField(name="Brh2gammagamma", parent=H2, daughters=(PHOTON, PHOTON)),
+    DecayField(name="Brh2zgamma", parent=H2, daughters=(Z, PHOTON)),
+    DecayField(name="Brh2a1a1", parent=H2, daughters=(A1, A1)),
+    DecayField(name="Brh2a1z", parent=H2, daughters=(Z, A1)),
+    DecayField(name="Brh2h1h1", parent=H2, daughters=(H1, H1)),
 
     # h3
-    Field(block='DCINFO', name="Brh3gg", type=float,
-          regex=re.compile(r' +([E\d\.\-\+]+) +2 +21 +21 +\# BR\(H_3 \-> gluon gluon\)'),
-          comment=''),
-    Field(block='DCINFO', name="Brh3tautau", type=float,
-          regex=re.compile(r' +([E\d\.\-\+]+) +2 +15 +\-15 +\# BR\(H_3 \-> tau tau\)'),
-          comment=''),
-    Field(block='DCINFO', name="Brh3bb", type=float,
-          regex=re.compile(r' +([E\d\.\-\+]+) +2 +5 +\-5 +\# BR\(H_3 \-> b bbar\)'),
-          comment=''),
-    Field(block='DCINFO', name="Brh3ww", type=float,
-          regex=re.compile(r' +([E\d\.\-\+]+) +2 +24 +\-24 +\# BR\(H_3 \-> W\+ W\-\)'),
-          comment=''),
-    Field(block='DCINFO', name="Brh3zz", type=float,
-          regex=re.compile(r' +([E\d\.\-\+]+) +2 +23 +23 +\# BR\(H_3 \-> Z Z\)'),
-          comment=''),
-    Field(block='DCINFO', name="Brh3gammagamma", type=float,
-          regex=re.compile(r' +([E\d\.\-\+]+) +2 +22 +22 +\# BR\(H_3 \-> gamma gamma\)'),
-          comment=''),
-    Field(block='DCINFO', name="Brh3zgamma", type=float,
-          regex=re.compile(r' +([E\d\.\-\+]+) +2 +23 +22 +\# BR\(H_3 \-> Z gamma\)'),
-          comment=''),
-    Field(block='DCINFO', name="Brh3a1a1", type=float,
-          regex=re.compile(r' +([E\d\.\-\+]+) +2 +36 +36 +\# BR\(H_3 \-> A_1 A_1\)'),
-          comment=''),
-    Field(block='DCINFO', name="Brh3a1z", type=float,
-          regex=re.compile(r' +([E\d\.\-\+]+) +2 +23 +36 +\# BR\(H_3 \-> A_1 Z\)'),
-          comment=''),
-    Field(block='DCINFO', name="Brh3h1h1", type=float,
-          regex=re.compile(r' +([E\d\.\-\+]+) +2 +25 +25 +\# BR\(H_3 \-> H_1 H_1\)'),
-          comment=''),
-    Field(block='DCINFO', name="Brh3h2h2", type=float,
-          regex=re.compile(r' +([E\d\.\-\+]+) +2 +35 +35 +\# BR\(H_3 \-> H_2 H_2\)'),
-          comment=''),
-    Field(block='DCINFO', name="Brh3h1h2", type=float,
-          regex=re.compile(r' +([E\d\.\-\+]+) +2 +25 +35 +\# BR\(H_3 \-> H_1 H_2\)'),
-          comment=''),
+    DecayField(name="Brh3gg", parent=H3, daughters=(GLUON, GLUON)),
+    DecayField(name="Brh3tautau", parent=H3, daughters=(TAU, -TAU)),
+    DecayField(name="Brh3bb", parent=H3, daughters=(B, -B)),
+    DecayField(name="Brh3ww", parent=H3, daughters=(W, -W)),
+    DecayField(name="Brh3zz", parent=H3, daughters=(Z, Z)),
+    DecayField(name="Brh3gammagamma", parent=H3, daughters=(PHOTON, PHOTON)),
+    DecayField(name="Brh3zgamma", parent=H3, daughters=(Z, PHOTON)),
+    DecayField(name="Brh3a1a1", parent=H3, daughters=(A1, A1)),
+    DecayField(name="Brh3a1z", parent=H3, daughters=(Z, A1)),
+    DecayField(name="Brh3h1h1", parent=H3, daughters=(H1, H1)),
+    DecayField(name="Brh3h2h2", parent=H3, daughters=(H2, H2)),
+    DecayField(name="Brh3h1h2", parent=H3, daughters=(H1, H2)),
 
     # a1
-    Field(block='DCINFO', name="a1width", type=float,
-          regex=re.compile(r'DECAY +36 +([E\d\.\-\+]+) +\# Lightest pseudoscalar'),
-          comment=''),
-    Field(block='DCINFO', name="Bra1mumu", type=float,
-          regex=re.compile(r' +([E\d\.\-\+]+) +2 +13 +\-13 +\# BR\(A_1 \-> muon muon\)'),
-          comment=''),
-    Field(block='DCINFO', name="Bra1tautau", type=float,
-          regex=re.compile(r' +([E\d\.\-\+]+) +2 +15 +\-15 +\# BR\(A_1 \-> tau tau\)'),
-          comment=''),
-    Field(block='DCINFO', name="Bra1bb", type=float,
-          regex=re.compile(r' +([E\d\.\-\+]+) +2 +5 +\-5 +\# BR\(A_1 \-> b bbar\)'),
-          comment=''),
-    Field(block='DCINFO', name="Bra1gg", type=float,
-          regex=re.compile(r' +([E\d\.\-\+]+) +2 +21 +21 +\# BR\(A_1 \-> gluon gluon\)'),
-          comment=''),
-    Field(block='DCINFO', name="Bra1cc", type=float,
-          regex=re.compile(r' +([E\d\.\-\+]+) +2 +4 +\-4 +\# BR\(A_1 \-> c cbar\)'),
-          comment=''),
-    Field(block='DCINFO', name="Bra1ss", type=float,
-          regex=re.compile(r' +([E\d\.\-\+]+) +2 +3 +\-3 +\# BR\(A_1 \-> s sbar\)'),
-          comment='')
-]
\ No newline at end of file
+    DecayField(name="a1width", parent=A1),
+    DecayField(name="Bra1mumu", parent=A1, daughters=(MU, -MU)),
+    DecayField(name="Bra1tautau", parent=A1, daughters=(TAU, -TAU)),
+    DecayField(name="Bra1bb", parent=A1, daughters=(B, -B)),
+    DecayField(name="Bra1gg", parent=A1, daughters=(GLUON, GLUON)),
+    DecayField(name="Bra1cc", parent=A1, daughters=(C, -C)),
+    DecayField(name="Bra1ss", parent=A1, daughters=(S, -S))
+]
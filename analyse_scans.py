@@ -2,24 +2,42 @@
 """
 Script to run over output from NMSSMTools, etc, and pull relevant info.
 
-The relevant info from ALL spectrum files in the input directory is put into
+The relevant info from ALL spectrum files in the input directory (or
+spectr*.tgz archive, read directly without extracting) is put into
 some CSV files:
-- all points
+- all points passing the cuts (by default 0 < ma1 < 60, see --cut)
 - all points passing all constraints except g-2 (must have +ve contribution)
 and relic density
 - all points with ma1 < 11
+
+or, with --format hdf5, one HDF5 table of all points passing the cuts, with
+flag columns for the other two.
 """
 
 
 import os
 import sys
+import abc
 import argparse
 import logging
 import glob
 import re
+import tarfile
+import contextlib
+import multiprocessing
+from itertools import islice, imap, izip
+from functools import partial
 from collections import defaultdict
 import NMSSMToolsFields, SuperIsoFields, NMSSMCalcFields, HiggsBoundsSignalsFields
+import slha_parser
+import analysis_manifest
 from time import strftime
+import numpy as np
+try:
+    import pandas as pd
+except ImportError:
+    # only needed for --format hdf5
+    pd = None
 
 
 logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.INFO)
@@ -28,6 +46,80 @@ log = logging.getLogger(__name__)
 # fileextension for output files - may need to be used in further processing
 OFMT = 'csv'
 
+# Inputs with these extensions are read as tar archives of spectrum files
+ARCHIVE_EXTS = ('.tgz', '.tar.gz', '.tar')
+
+# With --format hdf5: table name in the file, boolean columns for which sets
+# each point is in, number of rows to write at a time, and string column sizes
+HDF5_KEY = 'points'
+HDF5_FLAGS = ['good', 'ma1Lt11']
+HDF5_CHUNK = 1000
+HDF5_STR_SIZE = 256
+HDF5_STR_SIZES = {'constraints': 2048}
+
+# Per-observable HiggsSignals fields, left out with --noHSObservables
+HS_OBSERVABLE_COLUMNS = [f.name for f in HiggsBoundsSignalsFields.higgssignals_observable_fields]
+
+# With --manifest, save progress after this many files
+MANIFEST_EVERY = 500
+
+# With --jobs, number of files sent to a worker at a time
+CHUNKSIZE = 20
+# and number of chunks per worker read ahead from the input
+CHUNKS_AHEAD = 4
+
+
+class Cut(object):
+    """Cut on a field value: passes if low < value < high.
+
+    name: str
+        Field name, e.g. 'ma1'.
+    low, high: float
+        Limits, None for no limit.
+
+    A missing value (field not found) always fails.
+    """
+    def __init__(self, name, low=None, high=None):
+        self.name = name
+        self.low = low
+        self.high = high
+
+    def __call__(self, value):
+        if value == '':
+            return False
+        return ((self.low is None or self.low < value) and
+                (self.high is None or value < self.high))
+
+    def __str__(self):
+        return ''.join([('%g < ' % self.low) if self.low is not None else '',
+                        self.name,
+                        (' < %g' % self.high) if self.high is not None else ''])
+
+    def __repr__(self):
+        return 'Cut(%r, %r, %r)' % (self.name, self.low, self.high)
+
+
+# Points not passing these are ignored, unless other cuts are given
+DEFAULT_CUTS = [Cut('ma1', 0, 60)]
+
+
+def parse_cut(spec):
+    """Make a Cut from a NAME:LOW:HIGH string, e.g. ma1:0:60 or mh1:120:
+    (either limit can be left empty). For use as an argparse type."""
+    parts = spec.split(':')
+    if len(parts) != 3 or not parts[0]:
+        raise argparse.ArgumentTypeError('Cut must be NAME:LOW:HIGH, not %r' % spec)
+    try:
+        low, high = [float(x) if x else None for x in parts[1:]]
+    except ValueError:
+        raise argparse.ArgumentTypeError('Cut limits must be numbers, not %r' % spec)
+    return Cut(parts[0], low, high)
+
+
+def passes_cuts(results_dict, cuts):
+    """Return bool for whether a point passes all the cuts"""
+    return all(cut(results_dict.get(cut.name, '')) for cut in cuts)
+
 
 class AnalysisParser(argparse.ArgumentParser):
     """Class to handle arg parsing"""
@@ -37,7 +129,10 @@ class AnalysisParser(argparse.ArgumentParser):
 
     def add_arguments(self):
         self.add_argument('input',
-                          help='Directory with sample names and locations')
+                          help='Directory with spectrum files, or a spectr*.tgz '
+                          'archive of them. Archives are read directly, along '
+                          'with the matching superiso*.tgz/nmssmcalc*.tgz next '
+                          'to them for --superiso/--nmssmcalc.')
         self.add_argument('--oDir',
                           help='Output directory for files. If one is not '
                           'specified, uses $PWD.',
@@ -54,6 +149,42 @@ class AnalysisParser(argparse.ArgumentParser):
         self.add_argument('-n',
                           help='Number of files to run over (default is all)',
                           type=int)
+        self.add_argument('--cut',
+                          help='Only keep points with LOW < field NAME < HIGH, '
+                          'given as NAME:LOW:HIGH. Either limit can be left '
+                          'empty. Can be used several times. NMSSMTools fields '
+                          'are checked as soon as they are read, and the rest '
+                          'of the file skipped if they fail. '
+                          'Default: %s' % ', '.join(str(c) for c in DEFAULT_CUTS),
+                          type=parse_cut, action='append', dest='cuts')
+        self.add_argument('--noCuts',
+                          help='Keep all physical points, ignoring the default cuts',
+                          action='store_true')
+        self.add_argument('--format',
+                          help='Output format: csv = output, output_good & '
+                          'output_ma1Lt11 CSV files, hdf5 = one output<ID>.h5 '
+                          'table with good & ma1Lt11 flag columns '
+                          '(needs pandas & PyTables)',
+                          choices=['csv', 'hdf5'],
+                          default='csv')
+        self.add_argument('--noHSObservables',
+                          help='Leave out the per-observable HiggsSignals '
+                          'columns (HS_*), e.g. for spectra from a scan with '
+                          '--hbhsBatch, which only have the overall results',
+                          action='store_true')
+        self.add_argument('--manifest',
+                          help='Record which files have been analysed, and '
+                          'with which fields & settings, in '
+                          'analysis_manifest<ID>.json in --oDir. If the input '
+                          'has already been done with the same settings, does '
+                          'nothing; if it was partly done, carries on, '
+                          'appending to the existing output.',
+                          action='store_true')
+        self.add_argument('-j', '--jobs',
+                          help='Number of processes to parse files with. '
+                          'Output is the same as with 1, in the same order.',
+                          type=int,
+                          default=1)
         # Some generic script options
         self.add_argument("-v",
                           help="Display debug messages.",
@@ -68,129 +199,659 @@ def analyse_scans(in_args=sys.argv[1:]):
         log.setLevel(logging.DEBUG)
         log.debug(args)
 
+    args.cuts = resolve_cuts(args)
+    all_names = set(f.name for f in (NMSSMToolsFields.nmssmtools_fields +
+                                     HiggsBoundsSignalsFields.higgsbounds_fields +
+                                     HiggsBoundsSignalsFields.higgssignals_fields +
+                                     SuperIsoFields.superiso_fields +
+                                     NMSSMCalcFields.nmssmcalc_fields))
+    for cut in args.cuts:
+        if cut.name not in all_names:
+            parser.error('Unknown field in cut: %s' % cut.name)
+    if args.jobs < 1:
+        parser.error('-j|--jobs must have an argument >= 1')
+
     log.info('Getting spectrum files from %s' % args.input)
 
     # Do some checks
     # ------------------------------------------------------------------------
     check_create_dir(args.oDir)
 
-    num_spectr_files = len(glob.glob(os.path.join(args.input, 'spectr_*')))
-    if not args.n:
-        args.n = num_spectr_files
+    # See if this input has been (partly) done before
+    entry, skip = None, set()
+    if args.manifest:
+        settings_hash = analysis_manifest.analysis_hash(analysis_settings(args))
+        input_name = os.path.basename(os.path.normpath(args.input))
+        entry = analysis_manifest.load_entry(args.oDir, args.ID, input_name)
+        if (not analysis_manifest.entry_matches(entry, settings_hash, args.input) or
+                not analysis_manifest.outputs_exist(entry, args.oDir)):
+            # start again if any of the outputs have gone
+            entry = None
+        elif entry['complete']:
+            log.info('%s already analysed with these fields & settings, nothing to do',
+                     args.input)
+            return
+        else:
+            log.info('Carrying on with %s, %d files already done',
+                     args.input, len(entry['files']))
+            skip = set(entry['files'])
+            truncate_outputs(args.oDir, entry['outputs'])
+
+    pool = None
+    if args.jobs > 1:
+        log.info('Parsing with %d processes', args.jobs)
+        pool = multiprocessing.Pool(args.jobs)
+    mapper = partial(ordered_map, pool=pool, block_size=CHUNKSIZE * CHUNKS_AHEAD * args.jobs)
+
+    if is_archive(args.input):
+        points = iter_archive_points(args.input, args.superiso, args.nmssmcalc,
+                                     args.cuts, args.n, mapper, skip)
+    else:
+        points = iter_dir_points(args.input, args.superiso, args.nmssmcalc,
+                                 args.cuts, args.n, mapper, skip)
+
+    # Analyse SLHA files
+    # ------------------------------------------------------------------------
+    num_spectr_files = 0
+    try:
+        with OUTPUTS[args.format](args.oDir, args.ID, cuts=args.cuts,
+                                  append=entry is not None,
+                                  drop=dropped_columns(args)) as outputs:
+            if args.manifest and entry is None:
+                entry = analysis_manifest.new_entry(settings_hash, args.input,
+                                                    outputs.positions().keys())
+
+            # Loop through each spectrum file
+            # If un-physical point (M_H^2 < 1 or M_A^2 < 1), or failing
+            # the cuts, results_dict is None.
+            for name, results_dict in points:
+
+                if num_spectr_files % 100 == 0:
+                    log.info('Parsing %dth file at %s', num_spectr_files, strftime("%H%M%S"))
+                num_spectr_files += 1
+
+                if results_dict is not None:
+                    outputs.add(results_dict)
+
+                if entry is not None:
+                    entry['files'].append(name)
+                    if len(entry['files']) % MANIFEST_EVERY == 0:
+                        save_progress(outputs, entry, args.oDir, args.ID, input_name)
+
+            if entry is not None:
+                # done, unless only asked for the first n
+                entry['complete'] = args.n is None
+                save_progress(outputs, entry, args.oDir, args.ID, input_name)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    # Finish by printing some stats
+    log.info('#' * 60)
+    log.info('# N. input points: %d' % num_spectr_files)
+    outputs.log_stats()
+    if num_spectr_files:
+        log.info('# Fraction useful: %.3f' % (float(outputs.n_all) / float(num_spectr_files)))
+        log.info('# Fraction good: %.3f' % (float(outputs.n_good) / float(num_spectr_files)))
+    log.info('#' * 60)
+
+
+def resolve_cuts(args):
+    """Get the list of Cuts to use from the parsed args"""
+    if args.noCuts:
+        return []
+    return args.cuts or DEFAULT_CUTS
+
+
+def analysis_settings(args):
+    """Get the settings in the parsed args that change the output, for
+    analysis_manifest.analysis_hash()."""
+    settings = {'cuts': [[c.name] + [None if x is None else float(x) for x in (c.low, c.high)]
+                         for c in resolve_cuts(args)],
+                'superiso': args.superiso, 'nmssmcalc': args.nmssmcalc,
+                'format': args.format}
+    # only when set, so manifests from before the option still match
+    if args.noHSObservables:
+        settings['noHSObservables'] = True
+    return settings
+
+
+def dropped_columns(args):
+    """Get the names of the fields to leave out of the output, from the parsed args"""
+    if args.noHSObservables:
+        return HS_OBSERVABLE_COLUMNS
+    return []
+
+
+def save_progress(outputs, entry, odir, ID, name):
+    """Flush the outputs, then record how far through them the files done so
+    far go in the manifest entry, and save it."""
+    outputs.flush()
+    entry['outputs'] = outputs.positions()
+    analysis_manifest.save_entry(odir, ID, name, entry)
+
+
+def truncate_outputs(odir, positions):
+    """Cut the output files back to the positions recorded in a manifest entry
+    (see PointOutputs.positions()), before appending to them. Rows after that
+    are from files that weren't recorded as done, so will be redone."""
+    for name, pos in positions.iteritems():
+        filename = os.path.join(odir, name)
+        if not os.path.isfile(filename):
+            continue
+        if filename.endswith('.h5'):
+            with contextlib.closing(pd.HDFStore(filename)) as store:
+                if HDF5_KEY in store and store.get_storer(HDF5_KEY).nrows > pos:
+                    store.remove(HDF5_KEY, start=pos)
+        else:
+            with open(filename, 'r+') as f:
+                f.truncate(pos)
+
+
+def ordered_map(func, items, pool=None, block_size=1000):
+    """Apply func to each of items, in parallel over the processes in pool
+    if given, yielding the results in the same order as items.
+
+    items are sent to the workers in chunks of CHUNKSIZE, and only block_size
+    at a time are read, so items can be a long stream (e.g. the contents of an
+    archive) without it all being read into memory.
+    """
+    if pool is None:
+        for result in imap(func, items):
+            yield result
+        return
+    items = iter(items)
+    while True:
+        block = list(islice(items, block_size))
+        if not block:
+            break
+        for result in pool.imap(func, block, CHUNKSIZE):
+            yield result
+
+
+def iter_dir_points(input_dir, superiso=False, nmssmcalc=False, cuts=None, n=None,
+                    mapper=ordered_map, skip=None):
+    """Get (filename, results dict) for each spectrum file in a directory, in
+    filename order. The results dict is None for each one that's un-physical
+    or failing the cuts (see get_point_results()).
+
+    n: int
+        Number of files to run over (default is all).
+    mapper: callable
+        Called as mapper(func, items) to apply func to each item in order,
+        e.g. ordered_map() with a pool of processes.
+    skip: set of str
+        Filenames (without the directory) to leave out, e.g. already done.
+    """
+    spectr_files = sorted(glob.glob(os.path.join(input_dir, 'spectr_*.dat')))
+    num_spectr_files = len(glob.glob(os.path.join(input_dir, 'spectr_*')))
 
     # Figure out if we are also including SuperIso output
-    if args.superiso:
-        if len(glob.glob(os.path.join(args.input, 'superiso_*'))) != num_spectr_files:
-            args.superiso = False
+    if superiso:
+        if len(glob.glob(os.path.join(input_dir, 'superiso_*'))) != num_spectr_files:
+            superiso = False
             log.warning('Not enough SuperIso output files - will not analyse.')
 
     # Figure out if we are also including NMSSMCalc output
-    if args.nmssmcalc:
-        if len(glob.glob(os.path.join(args.input, 'nmssmcalc_*'))) != num_spectr_files:
-            args.nmssmcalc = False
+    if nmssmcalc:
+        if len(glob.glob(os.path.join(input_dir, 'nmssmcalc_*'))) != num_spectr_files:
+            nmssmcalc = False
             log.warning('Not enough NMSSMCalc output files - will not analyse.')
 
-    # Create output filenames
-    # ------------------------------------------------------------------------
-    outfile = os.path.join(args.oDir, 'output%s.%s' % (args.ID, OFMT))
-    outfile_good = os.path.join(args.oDir, 'output_good%s.%s' % (args.ID, OFMT))
-    outfile_ma1Lt11 = os.path.join(args.oDir, 'output_ma1Lt11%s.%s' % (args.ID, OFMT))
-    log.info('Writing CSV to %s' % ', '.join([outfile, outfile_good, outfile_ma1Lt11]))
-
-    # Analyse SLHA files
-    # ------------------------------------------------------------------------
-    # Counters
-    n_all, n_good, n_ma1Lt11 = 0, 0, 0
+    skip = skip or set()
+    spectr_files = [f for f in spectr_files if os.path.basename(f) not in skip][:n]
+    get_results = partial(get_point_results, superiso=superiso, nmssmcalc=nmssmcalc, cuts=cuts)
+    return izip((os.path.basename(f) for f in spectr_files), mapper(get_results, spectr_files))
 
-    # ignore any points with ma1 > mass_cut
-    mass_cut = 60
 
-    done_cols = False
+def is_archive(path):
+    """Check if an input path is a tar archive, rather than a directory"""
+    return os.path.isfile(path) and path.endswith(ARCHIVE_EXTS)
 
-    with open(outfile, 'w') as f, \
-         open(outfile_good, 'w') as f_good, \
-         open(outfile_ma1Lt11, 'w') as f_ma1Lt11:
 
-        columns = []  # to hold column order - important as dict not sorted
+def companion_archive(archive, prefix):
+    """Get the archive with the SuperIso/NMSSMCalc output files that goes with
+    a spectrum archive, e.g. spectr12.tgz -> superiso12.tgz"""
+    dirname, basename = os.path.split(archive)
+    return os.path.join(dirname, basename.replace('spectr', prefix, 1))
 
-        # Loop through each spectrum file
-        for i, spectr in enumerate(glob.iglob(os.path.join(args.input, 'spectr_*.dat'))):
 
-            if i % 100 == 0:
-                log.info('Parsing %dth file at %s', i, strftime("%H%M%S"))
+def iter_archive_members(archives):
+    """Stream the (member name, contents) of each file in a list of tar
+    archives, in order, without extracting anything to disk."""
+    for archive in archives:
+        log.debug('Reading %s', archive)
+        with contextlib.closing(tarfile.open(archive, 'r|*')) as tar:
+            for member in tar:
+                if member.isfile():
+                    yield member.name, tar.extractfile(member).read()
 
-            if i == args.n:
-                break
 
-            log.debug('Parsing %s', spectr)
+def iter_point_members(archives, prefixes, n=None, skip=None):
+    """Get the (prefix, point, member name, contents) of each point file in
+    the archives, where prefix is one of prefixes (e.g. 'spectr') and point
+    is the rest of the filename, which is the same for all files of a point.
 
-            # Look for failing constraints.
-            # If un-physical point (M_H^2 < 1 or M_A^2 < 1), skips file.
-            nmssmtools_constraints = get_nmssmtools_constraints(spectr)
-            if isinstance(nmssmtools_constraints, type(None)):
+    Only the first n spectrum files are included, leaving out those in skip
+    (filenames without the directory), and their other files.
+    """
+    skip = skip or set()
+    n_spectr = 0
+    for name, text in iter_archive_members(archives):
+        basename = os.path.basename(name)
+        prefix = next((p for p in prefixes if basename.startswith(p + '_')), None)
+        if prefix is None or not basename.endswith('.dat'):
+            continue
+        if 'spectr' + basename[len(prefix):] in skip:
+            continue
+        if prefix == 'spectr':
+            if n_spectr == n:
+                if len(prefixes) == 1:
+                    break
                 continue
+            n_spectr += 1
+        yield prefix, basename[len(prefix):], name, text
 
-            dict_fields = (NMSSMToolsFields.nmssmtools_fields +
-                           HiggsBoundsSignalsFields.higgsbounds_fields +
-                           HiggsBoundsSignalsFields.higgssignals_fields)
-            results_dict = get_slha_dict(spectr, dict_fields)
-            # need joiner as CSV file
-            results_dict['constraints'] = '|'.join(nmssmtools_constraints)
-            # log.debug(results_dict)
-
-            if args.superiso:
-                # Get matching SuperIso output file and parse
-                superiso = os.path.basename(spectr.replace("spectr", "superiso"))
-                superiso = os.path.join(os.path.dirname(spectr), superiso)
-                superiso_dict = get_slha_dict(superiso, SuperIsoFields.superiso_fields)
-                results_dict.update(superiso_dict)
-                log.debug(superiso_dict)
-
-            if args.nmssmcalc:
-                # Get matching NMSSMCalc output file and parse
-                nmssmcalc = os.path.basename(spectr.replace("spectr", "nmssmcalc"))
-                nmssmcalc = os.path.join(os.path.dirname(spectr), nmssmcalc)
-                nmssmcalc_dict = get_slha_dict(nmssmcalc, NMSSMCalcFields.nmssmcalc_fields)
-                results_dict.update(nmssmcalc_dict)
-                log.debug(nmssmcalc_dict)
-
-            # First time, write out column headers
-            if not done_cols:
-                # This defines the output column order & writes headers
-                columns = sorted(results_dict.keys())
-                # log.debug('Columns: %s', columns)
-                for o in f, f_good, f_ma1Lt11:
-                    o.write(','.join(columns) + '\n')
-                done_cols = True
-
-            # Now write to file if we want this result
-            if 0 < results_dict['ma1'] < mass_cut:
-                # everything goes into the general output file - must keep
-                # same order as header columns
-                results_str = ','.join([str(results_dict.get(x, '')) for x in columns])
-                log.debug('All: %s', results_str)
-                f.write(results_str + '\n')
-                n_all += 1
-
-                if pass_constraints(results_dict, strict=False):
-                    # "good" points
-                    f_good.write(results_str + '\n')
-                    n_good += 1
-
-                if results_dict['ma1'] < 11:
-                    # specifically for low mass points
-                    f_ma1Lt11.write(results_str + '\n')
-                    n_ma1Lt11 += 1
 
-    # Finish by printing some stats
-    log.info('#' * 60)
-    log.info('# N. input points: %d' % num_spectr_files)
-    log.info('# N. with 0 < ma1 < %g: %d' % (mass_cut, n_all))
-    log.info('# N. with 0 < ma1 < %g + passing exp. constraints: %d' % (mass_cut, n_good))
-    log.info('# N. with 0 < ma1 < 11: %d' % n_ma1Lt11)
-    log.info('# Fraction useful: %.3f' % (float(n_all) / float(num_spectr_files)))
-    log.info('# Fraction good: %.3f' % (float(n_good) / float(num_spectr_files)))
-    log.info('#' * 60)
+def parse_point_member(member, cuts=None, extra_fields=None):
+    """Parse a file from iter_point_members(): a spectrum file with
+    parse_point_results(), or a SuperIso/NMSSMCalc file using its fields
+    in extra_fields ({prefix: fields}).
+
+    Returns (prefix, point, results dict).
+    """
+    prefix, point, name, text = member
+    if prefix == 'spectr':
+        log.debug('Parsing %s', name)
+        return prefix, point, parse_point_results(text, name, cuts)
+    return prefix, point, parse_slha_text(text, extra_fields[prefix], name)
+
+
+def iter_archive_points(archive, superiso=False, nmssmcalc=False, cuts=None, n=None,
+                        mapper=ordered_map, skip=None):
+    """Like iter_dir_points(), but for a spectr*.tgz archive, read as a stream,
+    with points in the order they are in the archive. Filenames are those of
+    the spectrum files, without the directory.
+
+    The SuperIso/NMSSMCalc files for each point are taken from the same
+    archive, or from the superiso*.tgz/nmssmcalc*.tgz next to it, streamed
+    after it. Each file is parsed as soon as it is read (so only the results
+    dicts of points passing the cuts are held while waiting for their other
+    files), and the point is done once all its files are in.
+    Points whose other files never turn up get blank values for those fields.
+    """
+    extras = []
+    if superiso:
+        extras.append(('superiso', SuperIsoFields.superiso_fields))
+    if nmssmcalc:
+        extras.append(('nmssmcalc', NMSSMCalcFields.nmssmcalc_fields))
+    prefixes = ['spectr'] + [prefix for prefix, _ in extras]
+
+    archives = [archive]
+    for prefix, _ in extras:
+        other = companion_archive(archive, prefix)
+        if other != archive and os.path.isfile(other):
+            archives.append(other)
+
+    # results dicts of spectra waiting for their other files, and the results
+    # of other files that turned up before their spectrum, by point
+    pending, waiting = {}, defaultdict(dict)
+    # points that don't need their other files
+    dropped = set()
+
+    def finish(point, results_dict):
+        for prefix, _ in extras:
+            results_dict.update(waiting[point][prefix])
+        waiting.pop(point, None)
+        if cuts and not passes_cuts(results_dict, cuts):
+            return None
+        return results_dict
+
+    parse = partial(parse_point_member, cuts=cuts, extra_fields=dict(extras))
+    members = iter_point_members(archives, prefixes, n, skip)
+    for prefix, point, results_dict in mapper(parse, members):
+        if prefix == 'spectr':
+            if results_dict is None:
+                dropped.add(point)
+                waiting.pop(point, None)
+                yield 'spectr' + point, None
+            elif len(waiting[point]) == len(extras):
+                yield 'spectr' + point, finish(point, results_dict)
+            else:
+                pending[point] = results_dict
+        elif point not in dropped:
+            waiting[point][prefix] = results_dict
+            if point in pending and len(waiting[point]) == len(extras):
+                yield 'spectr' + point, finish(point, pending.pop(point))
+
+    if pending:
+        log.warning('%d points missing SuperIso/NMSSMCalc files in %s',
+                    len(pending), ', '.join(archives))
+    for point, results_dict in pending.iteritems():
+        for prefix, fields in extras:
+            if prefix not in waiting[point]:
+                waiting[point][prefix] = {f.name: '' for f in fields}
+        yield 'spectr' + point, finish(point, results_dict)
+
+
+def get_point_results(spectr, superiso=False, nmssmcalc=False, cuts=None):
+    """Get the results dict for one point: the fields & failed constraints
+    from its NMSSMTools spectrum file, plus those from the matching SuperIso
+    and NMSSMCalc output files if wanted.
+
+    cuts: list of Cut, optional
+        If given, points failing any of them are dropped. Cuts on NMSSMTools
+        fields are applied while parsing, so the rest of the file (and the
+        SuperIso/NMSSMCalc files) are only read for points passing them.
+
+    Returns None for an un-physical point (M_H^2 < 1 or M_A^2 < 1), or one
+    failing the cuts.
+    """
+    with open(spectr) as f:
+        results_dict = parse_point_results(f.read(), spectr, cuts)
+    if results_dict is None:
+        return None
+
+    if superiso:
+        # Get matching SuperIso output file and parse
+        superiso = os.path.basename(spectr.replace("spectr", "superiso"))
+        superiso = os.path.join(os.path.dirname(spectr), superiso)
+        superiso_dict = get_slha_dict(superiso, SuperIsoFields.superiso_fields)
+        results_dict.update(superiso_dict)
+        log.debug(superiso_dict)
+
+    if nmssmcalc:
+        # Get matching NMSSMCalc output file and parse
+        nmssmcalc = os.path.basename(spectr.replace("spectr", "nmssmcalc"))
+        nmssmcalc = os.path.join(os.path.dirname(spectr), nmssmcalc)
+        nmssmcalc_dict = get_slha_dict(nmssmcalc, NMSSMCalcFields.nmssmcalc_fields)
+        results_dict.update(nmssmcalc_dict)
+        log.debug(nmssmcalc_dict)
+
+    if cuts and not passes_cuts(results_dict, cuts):
+        return None
+
+    return results_dict
+
+
+def point_fields():
+    """Get the Fields read from each NMSSMTools spectrum file, including the
+    HiggsBounds/HiggsSignals results"""
+    return (NMSSMToolsFields.nmssmtools_fields +
+            HiggsBoundsSignalsFields.higgsbounds_fields +
+            HiggsBoundsSignalsFields.higgssignals_fields)
+
+
+def parse_point_results(text, spectr, cuts=None):
+    """Get the results dict for one point from the text of its NMSSMTools
+    spectrum file: the fields & failed constraints.
+
+    Returns None for an un-physical point, or one failing the cuts on
+    NMSSMTools fields.
+    """
+    dict_fields = point_fields()
+    # Look for failing constraints, and get the fields, from one read.
+    nmssmtools_constraints, results_dict = parse_nmssmtools_spectrum(text, dict_fields,
+                                                                     spectr, cuts)
+    if results_dict is None:
+        return None
+
+    # need joiner as CSV file
+    results_dict['constraints'] = '|'.join(nmssmtools_constraints)
+    # log.debug(results_dict)
+    return results_dict
+
+
+class PointOutputs(object):
+    """Base class for the output files for a set of points: all points passing
+    the cuts, which of those also pass constraints (see pass_constraints()),
+    i.e. are "good", and which have 0 < ma1 < 11.
+
+    Use as a context manager, to close the files at the end. Subclasses
+    must define write() and positions().
+
+    cuts: list of Cut
+        Ignore any points failing these. Default is DEFAULT_CUTS.
+    drop: list of str
+        Fields to leave out of the output.
+    """
+    __metaclass__ = abc.ABCMeta
+
+    def __init__(self, cuts=None, drop=None):
+        self.cuts = DEFAULT_CUTS if cuts is None else cuts
+        self.drop = set(drop or [])
+        self.n_all, self.n_good, self.n_ma1Lt11 = 0, 0, 0
+        # to hold column order - important as dict not sorted
+        self.columns = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        pass
+
+    def flush(self):
+        pass
+
+    @abc.abstractmethod
+    def positions(self):
+        """Get {output filename (without the directory): position}, for how
+        far through each output file the rows written so far go (after a
+        flush), so that anything after can be cut off, see truncate_outputs()."""
+
+    def add(self, results_dict):
+        """Write a point's results to the outputs.
+
+        Returns a list of the sets it is in: 'all', 'good', 'ma1Lt11'.
+        """
+        # First time, define the column order
+        if not self.columns:
+            self.columns = sorted(k for k in results_dict if k not in self.drop)
+            # log.debug('Columns: %s', columns)
+            self.write_header()
+
+        # Now write to file if we want this result
+        written = []
+        if passes_cuts(results_dict, self.cuts):
+            self.n_all += 1
+            written.append('all')
+
+            if pass_constraints(results_dict, strict=False):
+                # "good" points
+                self.n_good += 1
+                written.append('good')
+
+            if 0 < results_dict['ma1'] < 11:
+                # specifically for low mass points
+                self.n_ma1Lt11 += 1
+                written.append('ma1Lt11')
+
+            self.write(results_dict, written)
+        return written
+
+    def write_header(self):
+        """Called once the columns are known"""
+        pass
+
+    @abc.abstractmethod
+    def write(self, results_dict, written):
+        """Write out a point passing the cuts, which is in the sets `written`"""
+
+    def log_stats(self):
+        cuts = ' & '.join(str(c) for c in self.cuts) or 'no cuts'
+        log.info('# N. with %s: %d' % (cuts, self.n_all))
+        log.info('# N. with %s + passing exp. constraints: %d' % (cuts, self.n_good))
+        log.info('# N. with 0 < ma1 < 11: %d' % self.n_ma1Lt11)
+
+
+class OutputCSVs(PointOutputs):
+    """The output CSV files for a set of points:
+    - output<ID>.csv: all points passing the cuts
+    - output_good<ID>.csv: those also passing constraints (see pass_constraints())
+    - output_ma1Lt11<ID>.csv: those with 0 < ma1 < 11
+
+    odir: str
+        Output directory.
+    ID: str
+        Unique identifier to append to output filenames.
+    cuts: list of Cut
+        Ignore any points failing these. Default is DEFAULT_CUTS.
+    append: bool
+        Add to existing files (e.g. when resuming a scan), rather than
+        starting new ones. The columns are then taken from the existing header.
+    drop: list of str
+        Fields to leave out of the output.
+    """
+    def __init__(self, odir, ID='', cuts=None, append=False, drop=None):
+        super(OutputCSVs, self).__init__(cuts, drop)
+        self.filenames = [os.path.join(odir, 'output%s%s.%s' % (stem, ID, OFMT))
+                          for stem in ['', '_good', '_ma1Lt11']]
+        log.info('Writing CSV to %s' % ', '.join(self.filenames))
+
+        if append and os.path.isfile(self.filenames[0]):
+            with open(self.filenames[0]) as f:
+                header = f.readline().strip()
+            if header:
+                self.columns = header.split(',')
+        mode = 'a' if self.columns else 'w'
+        self.f, self.f_good, self.f_ma1Lt11 = [open(fn, mode) for fn in self.filenames]
+
+    def close(self):
+        for o in self.f, self.f_good, self.f_ma1Lt11:
+            o.close()
+
+    def flush(self):
+        for o in self.f, self.f_good, self.f_ma1Lt11:
+            o.flush()
+
+    def positions(self):
+        # in bytes
+        return {os.path.basename(fn): os.path.getsize(fn) for fn in self.filenames}
+
+    def write_header(self):
+        for o in self.f, self.f_good, self.f_ma1Lt11:
+            o.write(','.join(self.columns) + '\n')
+
+    def write(self, results_dict, written):
+        # everything goes into the general output file - must keep
+        # same order as header columns
+        results_str = ','.join([str(results_dict.get(x, '')) for x in self.columns])
+        log.debug('All: %s', results_str)
+        self.f.write(results_str + '\n')
+        if 'good' in written:
+            self.f_good.write(results_str + '\n')
+        if 'ma1Lt11' in written:
+            self.f_ma1Lt11.write(results_str + '\n')
+
+
+class OutputHDF5(PointOutputs):
+    """One HDF5 file for a set of points, output<ID>.h5, instead of 3 CSVs.
+
+    All points passing the cuts are stored once, in a pandas table under
+    HDF5_KEY, with a typed column per field (numbers as float64, with NaN for
+    missing values), plus boolean columns 'good' & 'ma1Lt11' marking the points
+    that would have gone into output_good<ID>.csv & output_ma1Lt11<ID>.csv.
+    Rows are buffered, and appended HDF5_CHUNK at a time.
+
+    Needs pandas & PyTables.
+
+    Arguments are as for OutputCSVs.
+    """
+    def __init__(self, odir, ID='', cuts=None, append=False, drop=None):
+        super(OutputHDF5, self).__init__(cuts, drop)
+        if pd is None:
+            raise ImportError('HDF5 output needs pandas & PyTables')
+        self.filename = os.path.join(odir, 'output%s.h5' % ID)
+        self.filenames = [self.filename]
+        log.info('Writing HDF5 to %s' % self.filename)
+        self.store = pd.HDFStore(self.filename, mode='a' if append else 'w',
+                                 complevel=9, complib='blosc')
+        self.rows, self.flags = [], []
+        self.n_written = 0
+        self.numeric = {}
+        if append and HDF5_KEY in self.store:
+            existing = self.store.select(HDF5_KEY, start=0, stop=0)
+            self.columns = [c for c in existing.columns if c not in HDF5_FLAGS]
+            self.numeric = {c: existing[c].dtype.kind == 'f' for c in self.columns}
+            self.n_written = self.store.get_storer(HDF5_KEY).nrows
+
+    def close(self):
+        self.flush()
+        self.store.close()
+
+    def flush(self):
+        self.write_chunk()
+        self.store.flush()
+
+    def positions(self):
+        # in rows
+        return {os.path.basename(self.filename): self.n_written}
+
+    def write(self, results_dict, written):
+        if not self.numeric:
+            types = field_types()
+            self.numeric = {c: types.get(c, type(results_dict.get(c, ''))) in (float, int)
+                            for c in self.columns}
+        self.rows.append(results_dict)
+        self.flags.append(written)
+        if len(self.rows) >= HDF5_CHUNK:
+            self.write_chunk()
+
+    def write_chunk(self):
+        """Append the buffered rows to the table"""
+        if not self.rows:
+            return
+        data = {}
+        for col in self.columns:
+            values = [row.get(col, '') for row in self.rows]
+            if self.numeric[col]:
+                data[col] = np.array([np.nan if v == '' else v for v in values], dtype=float)
+            else:
+                size = HDF5_STR_SIZES.get(col, HDF5_STR_SIZE)
+                data[col] = [str(v) for v in values]
+                for row, v in zip(self.rows, data[col]):
+                    if len(v) > size:
+                        log.warning('%s for %s is %d characters, truncating to %d',
+                                    col, row.get('file', ''), len(v), size)
+                data[col] = [v[:size] for v in data[col]]
+        for flag in HDF5_FLAGS:
+            data[flag] = np.array([flag in w for w in self.flags])
+        index = np.arange(self.n_written, self.n_written + len(self.rows))
+        df = pd.DataFrame(data, index=index, columns=self.columns + HDF5_FLAGS)
+        min_itemsize = {c: HDF5_STR_SIZES.get(c, HDF5_STR_SIZE)
+                        for c in self.columns if not self.numeric[c]}
+        self.store.append(HDF5_KEY, df, format='table', data_columns=list(HDF5_FLAGS),
+                          min_itemsize=min_itemsize, index=False)
+        self.n_written += len(self.rows)
+        self.rows, self.flags = [], []
+
+
+# Output classes for each --format
+OUTPUTS = {'csv': OutputCSVs, 'hdf5': OutputHDF5}
+
+
+def field_types():
+    """Get {field name: type} for all the fields that go into the output"""
+    types = {f.name: f.type for f in (NMSSMToolsFields.nmssmtools_fields +
+                                      HiggsBoundsSignalsFields.higgsbounds_fields +
+                                      HiggsBoundsSignalsFields.higgssignals_fields +
+                                      SuperIsoFields.superiso_fields +
+                                      NMSSMCalcFields.nmssmcalc_fields)}
+    types.update({'constraints': str, 'file': str})
+    return types
+
+
+def fields_by_name(names):
+    """Get the NMSSMTools/HiggsBounds/HiggsSignals Field objects with the
+    given names"""
+    all_fields = (NMSSMToolsFields.nmssmtools_fields +
+                  HiggsBoundsSignalsFields.higgsbounds_fields +
+                  HiggsBoundsSignalsFields.higgssignals_fields)
+    return [f for f in all_fields if f.name in names]
 
 
 def get_slha_dict(filename, fields):
@@ -211,21 +872,21 @@ def get_slha_dict(filename, fields):
 
         Field(block='MINPAR', name="tgbeta", type=float,
               regex=re.compile(r' +3 +([E\d\.\-\+]+) +\# TANBETA\(MZ\)'))
+
+    The Fields are compiled into a lookup table (see slha_parser.py), so each
+    line is only split up once, instead of trying all the regexes on it.
     """
-    # For each BLOCK, we assign a list of pairs of field name + compiled regex pattern
-    # Means we can only go through the patterns pertinent to that block
-    scan_dict = defaultdict(list)
-    for f in fields:
-        if isinstance(f.regex, re._pattern_type):
-            scan_dict[f.block].append(f)
-        else:
-            new_field = NMSSMToolsFields.Field(name=f.name,
-                                               block=f.block,
-                                               type=f.type,
-                                               regex=re.compile(f.regex),
-                                               comment=f.regex.pattern.split('#')[1].replace('\\', ''))
-            scan_dict[f.block].append(new_field)
+    with open(filename) as f:
+        return parse_slha_text(f.read(), fields, filename)
+
+
+def parse_slha_text(text, fields, filename='', cuts=None):
+    """Like get_slha_dict(), but for the text of an SLHA file that has
+    already been read. filename is just stored in the dict.
 
+    If cuts (list of Cut) are given, returns None as soon as a field fails
+    one. Cuts on fields not in the list are ignored.
+    """
     results = defaultdict(str)
     # ensures all dicts have the same keys
     for f in fields:
@@ -233,57 +894,66 @@ def get_slha_dict(filename, fields):
 
     results['file'] = filename
 
-    p_block = re.compile(r'BLOCK +(\w+)', re.I)
+    # combine any cuts on the same field
+    field_cuts = defaultdict(list)
+    for cut in cuts or []:
+        field_cuts[cut.name].append(cut)
+    checks = {name: lambda value, cs=cs: all(c(value) for c in cs)
+              for name, cs in field_cuts.iteritems()}
+    return slha_parser.get_field_table(fields).parse(text, results, checks)
+
+
+def read_nmssmtools_spectrum(filename, fields, cuts=None):
+    """Read an NMSSMTools spectrum file once, and get both its failed
+    constraints and its fields from the one read.
 
-    # Now go through the file, line by line. If we encounter a BLOCK line,
-    # then we loop through the block contents, checking each line against all
-    # of the user's regexes. If there is a match, it is stored in the results
-    # dict.
-    # Note that we cannot use 'for line in f' as it skips alternate 'BLOCK' lines
+    cuts: list of Cut, optional
+        Cuts on any of the fields are applied as each field is parsed,
+        see slha_parser.FieldTable.parse().
+
+    Returns (constraints, results dict), as from get_nmssmtools_constraints()
+    and get_slha_dict(). For an un-physical point, returns (None, None)
+    straight after the SPINFO block, without parsing the fields. If a cut
+    fails, the results dict is None, and the rest of the file isn't parsed.
+    """
     with open(filename) as f:
-        try:
-            line = f.next()
-            while True:
-                if line.startswith('#'):
-                    line = f.next()
-                    continue
-
-                if is_block_line(line):
-                    # block = p_block.search(line).group(1).strip()
-                    block = line.split('#')[0].replace('BLOCK ', '').replace("Block ", '').strip().split(' ')[0]
-                    # log.debug(block)
-
-                    line = f.next()
-                    if block in scan_dict.keys():
-                        # Now loop over contents of this block and try matching
-                        # against the regexes
-                        while not is_block_line(line):
-                            # tmp_list = scan_dict[block]
-                            found_field = None
-                            for ind, field in enumerate(scan_dict[block]):
-                                if field.comment in line:
-                                    result = field.regex.search(line)
-                                    if result:
-                                        results[field.name] = field.type(result.group(1))
-                                        found_field = ind
-                                        log.debug('%s: %s', field.name, result.group(1))
-                                        break
-                            if found_field:
-                                del scan_dict[block][found_field]
-                            line = f.next()
-                    else:
-                        line = f.next()
-                else:
-                    line = f.next()
-        except StopIteration:
-            pass
-
-    return results
+        return parse_nmssmtools_spectrum(f.read(), fields, filename, cuts)
+
+
+def parse_nmssmtools_spectrum(text, fields, filename='', cuts=None):
+    """Like read_nmssmtools_spectrum(), but for the text of a spectrum file
+    that has already been read."""
+    constraints = parse_nmssmtools_constraints(text)
+    if constraints is None:
+        return None, None
+    return constraints, parse_slha_text(text, fields, filename, cuts)
 
 
 # put these outside to get ocmpiled once, then used lots of times
 p_id = re.compile(r' *3 *# *')  # needed to remove identifier
 p_space = re.compile(r'\s{2,}')  # needed to remove surplus spaces
+p_spinfo = re.compile(r'^[ \t]*BLOCK SPINFO[^\n]*', re.I | re.M)  # start of SPINFO block
+
+
+def get_nmssmtools_showstoppers(filename):
+    """Get a list of show-stoppers (SPINFO '4' lines, e.g. M_H1^2<1) from the
+    NMSSMTools spectrum file. An empty list means a physical point.
+
+    Only reads as far as the end of the SPINFO block, so it's cheap enough to
+    use straight after running NMSSMTools.
+    """
+    showstoppers = []
+    in_spinfo = False
+    with open(filename) as f:
+        for line in f:
+            line = line.strip()
+            if line.upper().startswith('BLOCK'):
+                if in_spinfo:
+                    break
+                in_spinfo = line.upper().startswith('BLOCK SPINFO')
+            elif in_spinfo and line.startswith('4'):
+                showstoppers.append(line.split('#', 1)[-1].strip())
+    return showstoppers
 
 
 def get_nmssmtools_constraints(filename):
@@ -297,27 +967,36 @@ def get_nmssmtools_constraints(filename):
     to distinguish.
     """
     with open(filename) as f:
-        for line in f:
-            line = line.strip()
-            if line.startswith('#'):
-                continue
-            if line.upper().startswith('BLOCK SPINFO'):
-                line = f.next().strip()
-                constraints = []
-                while 'BLOCK' not in line.upper():
-                    if line.startswith('3'):
-                        # store failed experimantal/theory constraints
-                        log.debug(line)
-                        line = p_id.sub('', line)
-                        line = line.replace(',', '')  # important as CSV file
-                        line = p_space.sub(' ', line)
-                        constraints.append(line)
-                    if line.startswith('4'):
-                        # see if there was any show-stoppers in the constraints
-                        return None
-                    line = f.next().strip()
-
-                return constraints
+        return parse_nmssmtools_constraints(f.read())
+
+
+def parse_nmssmtools_constraints(text):
+    """Like get_nmssmtools_constraints(), but for the text of a spectrum file
+    that has already been read. Only looks at the SPINFO block."""
+    spinfo = p_spinfo.search(text)
+    if not spinfo:
+        return None
+    constraints = []
+    start = spinfo.end() + 1
+    while start <= len(text):
+        end = text.find('\n', start)
+        if end < 0:
+            end = len(text)
+        line = text[start:end].strip()
+        start = end + 1
+        if 'BLOCK' in line.upper():
+            break
+        if line.startswith('3'):
+            # store failed experimantal/theory constraints
+            log.debug(line)
+            line = p_id.sub('', line)
+            line = line.replace(',', '')  # important as CSV file
+            line = p_space.sub(' ', line)
+            constraints.append(line)
+        if line.startswith('4'):
+            # see if there was any show-stoppers in the constraints
+            return None
+    return constraints
 
 
 def pass_constraints(results_dict, strict=False):
@@ -357,9 +1036,5 @@ def check_create_dir(directory):
         log.debug("Making dir %s" % directory)
 
 
-def is_block_line(line):
-    return line.startswith('BLOCK') or line.startswith('Block')
-
-
 if __name__ == "__main__":
     analyse_scans()
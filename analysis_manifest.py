@@ -0,0 +1,173 @@
+"""
+Manifest of which spectrum archives in a job directory have been analysed,
+so that rerunning the analysis only redoes what has changed.
+
+For each input (e.g. spectr12.tgz), the manifest records:
+- a hash of the settings it was analysed with: the field registry (blocks,
+  names, types & patterns of all Fields, or PDGIDs for DecayFields), plus
+  the analysis options that change the output rows (see analysis_hash()),
+- the archive's size & mtime, so an archive that has been rewritten is redone,
+- the spectrum files parsed so far, and whether the input is complete,
+- the output files its rows are in, and how far through each one they go.
+
+An input needs analysing if it has no entry, or its entry is incomplete, or
+was made with different settings, or for a different archive, or its outputs
+have gone (see AnalysisManifest.needs_analysis()).
+
+Analysis jobs run in parallel, so each one writes only its own entry, to
+analysis_manifest<ID>.json next to its outputs. These are folded into the
+job directory's analysis_manifest.json the next time it is loaded and saved,
+e.g. by submit_analysis_condor_new.py before deciding which archives to
+(re)analyse. Files are written to a temporary name and renamed into place,
+so a half-written manifest is never read.
+"""
+
+
+import os
+import json
+import glob
+import socket
+import hashlib
+import logging
+import slha_parser
+import NMSSMToolsFields, SuperIsoFields, NMSSMCalcFields, HiggsBoundsSignalsFields
+
+
+log = logging.getLogger(__name__)
+
+
+# Bump if the entry format or meaning changes, so everything is redone
+MANIFEST_VERSION = 1
+
+# Manifest filename stem: <stem>.json for the job directory,
+# <stem><ID>.json for the entry from one analysis job
+MANIFEST_STEM = 'analysis_manifest'
+
+
+def registry_fields():
+    """Get all the Fields in the field registry"""
+    return (NMSSMToolsFields.nmssmtools_fields +
+            HiggsBoundsSignalsFields.higgsbounds_fields +
+            HiggsBoundsSignalsFields.higgssignals_fields +
+            SuperIsoFields.superiso_fields +
+            NMSSMCalcFields.nmssmcalc_fields)
+
+
+def analysis_hash(settings):
+    """Hash the field registry, plus a dict of other analysis settings that
+    change the output (must be JSON-serialisable)."""
+    fields = [(f.block, f.name, f.type.__name__,
+               getattr(f.regex, 'pattern', f.regex), getattr(f, 'comment', None),
+               slha_parser.decay_key(f))
+              for f in registry_fields()]
+    h = hashlib.sha256()
+    h.update(json.dumps([MANIFEST_VERSION, fields, settings], sort_keys=True))
+    return h.hexdigest()
+
+
+def input_stat(path):
+    """Get [size, mtime] for an input archive (or directory)"""
+    st = os.stat(path)
+    return [st.st_size, int(st.st_mtime)]
+
+
+def new_entry(settings_hash, path, outputs):
+    """Make a manifest entry for an input about to be analysed from scratch.
+
+    settings_hash: str
+        From analysis_hash().
+    path: str
+        Input archive/directory.
+    outputs: list of str
+        Output filenames (basenames) that its rows go into.
+    """
+    return {'hash': settings_hash, 'stat': input_stat(path), 'complete': False,
+            'files': [], 'outputs': {name: 0 for name in outputs}}
+
+
+def entry_matches(entry, settings_hash, path):
+    """Check if a manifest entry is for this input, with these settings"""
+    return (entry is not None and entry['hash'] == settings_hash and
+            entry['stat'] == input_stat(path))
+
+
+def outputs_exist(entry, odir):
+    """Check if all the output files a manifest entry's rows went into are
+    still in odir"""
+    return all(os.path.isfile(os.path.join(odir, name)) for name in entry['outputs'])
+
+
+def read_manifest(filename):
+    """Get the {input name: entry} in a manifest file, empty if it doesn't
+    exist or is for an older version."""
+    try:
+        with open(filename) as f:
+            contents = json.load(f)
+    except (IOError, ValueError):
+        return {}
+    if contents.get('version') != MANIFEST_VERSION:
+        return {}
+    return contents['inputs']
+
+
+def write_manifest(filename, entries):
+    """Write {input name: entry} to a manifest file, atomically"""
+    tmp = '%s.tmp.%s.%d' % (filename, socket.gethostname(), os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump({'version': MANIFEST_VERSION, 'inputs': entries}, f, indent=1)
+    os.rename(tmp, filename)
+
+
+def entry_filename(odir, ID):
+    """Get the file the analysis job with ID writes its entry to"""
+    return os.path.join(odir, '%s%s.json' % (MANIFEST_STEM, ID))
+
+
+def load_entry(odir, ID, name):
+    """Get the entry for input `name` as analysed by the job with ID into odir:
+    from its own entry file if there is one, otherwise from the job directory's
+    manifest. Returns None if there isn't one."""
+    for filename in [entry_filename(odir, ID), entry_filename(odir, '')]:
+        entry = read_manifest(filename).get(name)
+        if entry is not None:
+            return entry
+    return None
+
+
+def save_entry(odir, ID, name, entry):
+    """Save the entry for input `name` as analysed by the job with ID"""
+    write_manifest(entry_filename(odir, ID), {name: entry})
+
+
+class AnalysisManifest(object):
+    """The manifest for a job directory, with the entries from all its
+    analysis jobs folded in.
+
+    job_dir: str
+        Directory with the spectrum archives & analysis outputs.
+    """
+    def __init__(self, job_dir):
+        self.job_dir = job_dir
+        self.filename = entry_filename(job_dir, '')
+        self.entries = read_manifest(self.filename)
+        self.job_files = [f for f in glob.glob(entry_filename(job_dir, '*'))
+                          if f != self.filename]
+        for filename in self.job_files:
+            self.entries.update(read_manifest(filename))
+
+    def needs_analysis(self, path, settings_hash):
+        """Check if an input archive needs (re)analysing with these settings"""
+        entry = self.entries.get(os.path.basename(os.path.normpath(path)))
+        return (not entry_matches(entry, settings_hash, path) or not entry['complete'] or
+                not outputs_exist(entry, self.job_dir))
+
+    def save(self):
+        """Save the job directory's manifest, and remove the per-job entry
+        files that are now folded into it."""
+        write_manifest(self.filename, self.entries)
+        for filename in self.job_files:
+            try:
+                os.remove(filename)
+            except OSError:
+                log.warning('Could not remove %s', filename)
+        self.job_files = []
@@ -0,0 +1,174 @@
+"""
+Fast renderer for NMSSMTools input card templates.
+
+The template is parsed once: for each line we work out which parameter
+(if any) it sets, and where the value sits on that line. A card is then built
+by gluing the fixed text between slots together with the new values, rather
+than running a regex substitution for every (line, parameter) pair.
+
+A line is considered to set parameter KEY if it looks like:
+
+    <whitespace><int><whitespace><value><whitespace># KEY...
+
+which is the same pattern NMSSMScan has always used.
+"""
+
+
+import re
+import time
+import logging
+from itertools import izip
+
+
+log = logging.getLogger(__name__)
+
+
+def slot_pattern(key):
+    """Get the compiled regex used to find the value for parameter `key`
+    on a template line. Group 1 is the text before the value, group 2 the
+    text after it.
+    """
+    return re.compile(r'(\s+\d+\s+)[\w.]+(\s+#\s%s.*)' % key)
+
+
+def format_value(value):
+    """Convert a parameter value to the Fortran double format used in cards."""
+    return str(value) + 'D0'
+
+
+class CardTemplate(object):
+    """Template card, parsed once into a slot map so that many cards can be
+    generated cheaply.
+
+    lines: list of str
+        Lines of the template card (as from readlines()).
+    keys: list of str
+        Parameter names to look for, e.g. ['LAMBDA', 'KAPPA'].
+        If several keys match the same line, the last one wins (as with the
+        old sequential re.sub).
+    """
+    def __init__(self, lines, keys):
+        self.lines = list(lines)
+        self.keys = list(keys)
+        # slot map: line index -> (key, value start, value end)
+        self.slots = {}
+        patterns = [(k, slot_pattern(k)) for k in self.keys]
+        for i, line in enumerate(self.lines):
+            for k, p in patterns:
+                match = p.search(line)
+                if match:
+                    self.slots[i] = (k, match.end(1), match.start(2))
+
+        found = set(s[0] for s in self.slots.itervalues())
+        for k in self.keys:
+            if k not in found:
+                log.warning('Parameter %s not found in card template', k)
+
+        # Pre-split the template into alternating fixed text & parameter keys,
+        # so rendering is just a join
+        self._text = []
+        self._slot_keys = []
+        chunk = []
+        for i, line in enumerate(self.lines):
+            if i in self.slots:
+                k, start, end = self.slots[i]
+                chunk.append(line[:start])
+                self._text.append(''.join(chunk))
+                self._slot_keys.append(k)
+                chunk = [line[end:]]
+            else:
+                chunk.append(line)
+        self._text.append(''.join(chunk))
+
+    @classmethod
+    def from_file(cls, filename, keys):
+        """Make a CardTemplate from a template card file."""
+        with open(filename) as template_file:
+            return cls(template_file.readlines(), keys)
+
+    def with_block_entries(self, entries):
+        """Make a copy of this template with some block entries changed,
+        e.g. to change the MODSEL settings.
+
+        entries: dict
+            Map of (block name, index) to new value (as str),
+            e.g. {('MODSEL', 8): '0'}. Block names are case-insensitive.
+        """
+        entries = {(b.upper(), i): v for (b, i), v in entries.iteritems()}
+        p_entry = re.compile(r'^(\s*)(\d+)(\s+)(\S+)')
+        new_lines = []
+        block = None
+        found = set()
+        for line in self.lines:
+            if line.upper().startswith('BLOCK'):
+                block = line.split()[1].upper()
+            elif not line.lstrip().startswith('#'):
+                match = p_entry.search(line)
+                if match and (block, int(match.group(2))) in entries:
+                    key = (block, int(match.group(2)))
+                    found.add(key)
+                    line = (line[:match.start(4)] + entries[key] + line[match.end(4):])
+            new_lines.append(line)
+        for key in set(entries) - found:
+            log.warning('Block entry %s %d not found in card template', *key)
+        return CardTemplate(new_lines, self.keys)
+
+    def template_value(self, key):
+        """Get the value the template itself sets for parameter `key`
+        (ignoring commented-out lines), or None if there isn't a numerical
+        one, e.g. if it's a placeholder like SED_LAMBDAD0."""
+        p = slot_pattern(key)
+        for line in self.lines:
+            match = p.search(line)
+            if match and not line.lstrip().startswith('#'):
+                try:
+                    return float(line[match.end(1):match.start(2)].upper().replace('D', 'E'))
+                except ValueError:
+                    return None
+        return None
+
+    def slot_map(self):
+        """Return the slot map as {line index: {key: (value start, value end)}}"""
+        return {i: {k: (start, end)} for i, (k, start, end) in self.slots.iteritems()}
+
+    def render(self, values):
+        """Make the text for one card.
+
+        values: dict
+            Map of parameter name to value. Must have an entry for every
+            parameter found in the template.
+        """
+        parts = [self._text[0]]
+        for k, text in zip(self._slot_keys, self._text[1:]):
+            parts.append(format_value(values[k]))
+            parts.append(text)
+        return ''.join(parts)
+
+    def render_many(self, values_list):
+        """Generator to make the text for many cards, one per entry in
+        values_list (an iterable of dicts, as for render())."""
+        for values in values_list:
+            yield self.render(values)
+
+    def write_cards(self, card_paths, values_list, timings=None):
+        """Render and write out many cards.
+
+        card_paths: iterable of str
+            Output filepath for each card.
+        values_list: iterable of dict
+            Parameter values for each card, in the same order as card_paths.
+        timings: list, optional
+            If given, the (wall, cpu) time taken for each card is appended.
+        """
+        n_cards = 0
+        start = (time.time(), time.clock())
+        for card_path, text in izip(card_paths, self.render_many(values_list)):
+            log.debug('New card: %s' % card_path)
+            with open(card_path, 'w') as new_card:
+                new_card.write(text)
+            n_cards += 1
+            if timings is not None:
+                end = (time.time(), time.clock())
+                timings.append((end[0] - start[0], end[1] - start[1]))
+                start = end
+        return n_cards
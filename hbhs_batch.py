@@ -0,0 +1,343 @@
+"""
+Run HiggsBounds & HiggsSignals over many NMSSMTools spectra in one go.
+
+In SLHA mode both programs are started once per spectrum, and each time they
+reload all their experimental tables, which takes far longer than the actual
+calculation. Instead, here we use their multi-point "effC" input: the Higgs
+masses, widths, reduced couplings and BRs for a whole batch of spectra are
+written to one set of tables (one line per point), each program is run once
+over them, and the results are written back into each spectrum file as
+HiggsBoundsResults/HiggsSignalsResults blocks, so analyse_scans.py can read
+them as usual.
+
+The inputs come from the same places HiggsBounds uses when reading the SLHA
+file itself: the MASS block, DECAY blocks, and the
+HiggsBoundsInputHiggsCouplingsBosons/Fermions blocks that NMSSMTools writes.
+Those blocks hold the squares of the normalised couplings, whereas the effC
+tables take the normalised couplings themselves, so the square root is
+written (keeping the sign of any negative entry). NMSSMTools only gives the
+b, t & tau couplings; at tree level the NMSSM Higgs couplings are the same for
+all down-type quarks, all up-type quarks and all charged leptons, so unless
+the s, c & mu couplings are in the blocks, they are taken from the b, t & tau
+ones. Other couplings not in the blocks (e.g. ggZ) are 0. The LEP H+H- cross
+section ratio is 1, as the NMSSM has the same H+H-Z/gamma couplings as the
+2HDM the LEP limits assume.
+
+The results tables are read by column name, from the '# cols' header line
+both programs write, rather than by position.
+
+This mode has not yet been checked against running HiggsBounds/HiggsSignals
+per point in SLHA mode: testing/check_hbhs_batch.py does that for one
+spectrum, and should pass before this is used for real scans.
+
+Note that in this mode HiggsSignals only gives the overall results
+(chi^2, number of observables, probability), not the per-observable
+HiggsSignalsPeakObservables block, so analyse the spectra with
+analyse_scans.py --noHSObservables to leave out those (empty) columns.
+"""
+
+
+import os
+import re
+import math
+import shutil
+import logging
+from subprocess import call
+from collections import defaultdict
+from scan_timing import stage_timer
+
+
+log = logging.getLogger(__name__)
+
+
+# Neutral Higgs PDGIDs, in the order HiggsBounds numbers them
+NEUTRAL_HIGGS = [25, 35, 45, 36, 46]
+CHARGED_HIGGS = 37
+N_HZERO = len(NEUTRAL_HIGGS)
+N_HPLUS = 1
+
+# 3rd generation fermion with the same tree-level Higgs couplings, for
+# those NMSSMTools doesn't give: s -> b, c -> t, mu -> tau
+FERMION_FAMILY = {3: 5, 4: 6, 13: 15}
+
+# Lightest neutralino, for invisible decays
+NEUTRALINO1 = 1000022
+
+# Results we need from each results file, with the possible names of their
+# columns in the '# cols' header (compared after normalise_column()), in
+# order of preference
+HB_RESULT_COLUMNS = {
+    'HBresult': ['hbresult'],
+    'chan': ['chan'],
+    'obsratio': ['obsratio'],
+    'ncombined': ['ncomb', 'ncombined'],
+}
+HS_RESULT_COLUMNS = {
+    'csq_mu': ['csqmu', 'chisqmu', 'chi2mu'],
+    'csq_mh': ['csqmh', 'chisqmh', 'chi2mh'],
+    'csq_tot': ['csqtot', 'chisqtot', 'chi2tot'],
+    'nobs': ['nobstot', 'nobs'],
+    'Pvalue': ['pvalue'],
+}
+
+
+class HiggsInputs(object):
+    """Everything HiggsBounds/HiggsSignals need from one spectrum file.
+
+    filename: str
+        NMSSMTools spectrum file.
+    """
+    def __init__(self, filename):
+        self.masses = {}
+        self.widths = {}
+        self.brs = defaultdict(dict)  # {parent: {sorted daughter PDGIDs: BR}}
+        self.bosons = {}  # {sorted PDGIDs: coupling^2}
+        self.fermions = {}  # {(higgs, f, f): (scalar coupling^2, pseudoscalar coupling^2)}
+
+        block, decay = None, None
+        with open(filename) as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                upper = line.upper()
+                if upper.startswith('BLOCK'):
+                    block, decay = upper.split()[1], None
+                    continue
+                if upper.startswith('DECAY'):
+                    parts = line.split()
+                    block, decay = None, int(parts[1])
+                    self.widths[decay] = float(parts[2])
+                    continue
+                data = line.split('#')[0].split()
+                if decay is not None:
+                    n_daughters = int(data[1])
+                    daughters = tuple(sorted(int(x) for x in data[2:2 + n_daughters]))
+                    self.brs[decay][daughters] = float(data[0])
+                elif block == 'MASS':
+                    self.masses[int(data[0])] = float(data[1])
+                elif block == 'HIGGSBOUNDSINPUTHIGGSCOUPLINGSBOSONS':
+                    self.bosons[tuple(sorted(int(x) for x in data[2:]))] = float(data[0])
+                elif block == 'HIGGSBOUNDSINPUTHIGGSCOUPLINGSFERMIONS':
+                    self.fermions[tuple(int(x) for x in data[3:])] = (float(data[0]), float(data[1]))
+
+    def br(self, parent, *daughters):
+        """BR(parent -> daughters), 0 if not listed"""
+        return self.brs[parent].get(tuple(sorted(daughters)), 0.)
+
+    def boson_coupling(self, *pdgids):
+        """Normalised coupling of the particles, 0 if not listed"""
+        return coupling(self.bosons.get(tuple(sorted(pdgids)), 0.))
+
+    def fermion_coupling(self, higgs, fermion, pseudo):
+        """Normalised scalar (or pseudoscalar) coupling of a Higgs to a
+        fermion pair. If not listed, that of the same-type 3rd generation
+        fermion (see FERMION_FAMILY), else 0."""
+        key = (higgs, fermion, fermion)
+        if key not in self.fermions:
+            family = FERMION_FAMILY.get(fermion, fermion)
+            key = (higgs, family, family)
+        return coupling(self.fermions.get(key, (0., 0.))[int(pseudo)])
+
+
+def coupling(coupling_sq):
+    """Normalised coupling from the coupling^2 in the SLHA input blocks,
+    keeping the sign if it is negative"""
+    return math.copysign(math.sqrt(abs(coupling_sq)), coupling_sq)
+
+
+def input_tables(inputs, dmh=(2, 2)):
+    """Make the effC-mode input table rows for one point.
+
+    inputs: HiggsInputs
+        Spectrum information.
+    dmh: list of float
+        Theoretical uncertainty on each neutral Higgs mass, for HiggsSignals
+        (the same as the DMASS block used in SLHA mode). Missing entries are 0.
+
+    Returns a dict of {table filename: list of values}.
+    """
+    h = NEUTRAL_HIGGS
+    tables = {}
+    tables['MH_GammaTot.dat'] = ([inputs.masses.get(x, 0.) for x in h] +
+                                 [inputs.widths.get(x, 0.) for x in h])
+    tables['MHplus_GammaTot.dat'] = [inputs.masses.get(CHARGED_HIGGS, 0.),
+                                     inputs.widths.get(CHARGED_HIGGS, 0.)]
+
+    effc = []
+    # ss, cc, bb, tt, mumu, tautau
+    for fermion in [3, 4, 5, 6, 13, 15]:
+        for pseudo in [False, True]:
+            effc.extend(inputs.fermion_coupling(x, fermion, pseudo) for x in h)
+    # WW, ZZ, Zgamma, gammagamma, gg
+    for pair in [(24, 24), (23, 23), (23, 22), (22, 22), (21, 21)]:
+        effc.extend(inputs.boson_coupling(x, *pair) for x in h)
+    effc.extend(inputs.boson_coupling(x, 21, 21, 23) for x in h)
+    effc.extend(inputs.boson_coupling(x, y, 23) for x in h for y in h)
+    tables['effC.dat'] = effc
+
+    tables['BR_H_NP.dat'] = ([inputs.br(x, NEUTRALINO1, NEUTRALINO1) for x in h] +
+                             [inputs.br(x, y, y) for x in h for y in h])
+    tables['BR_t.dat'] = [inputs.br(6, 5, 24), inputs.br(6, 5, CHARGED_HIGGS)]
+    tables['BR_Hplus.dat'] = [inputs.br(CHARGED_HIGGS, 4, -3),
+                              inputs.br(CHARGED_HIGGS, 4, -5),
+                              inputs.br(CHARGED_HIGGS, -15, 16)]
+    # sigma(ee -> H+H-) / 2HDM value: only depends on gauge couplings
+    tables['LEP_HpHm_CS_ratios.dat'] = [1.]
+    tables['MHall_uncertainties.dat'] = list(dmh) + [0.] * (N_HZERO - len(dmh))
+    return tables
+
+
+def write_input_tables(prefix, spectra, dmh=(2, 2)):
+    """Write effC-mode input tables for a batch of spectrum files.
+    Point n in the tables is spectra[n - 1]."""
+    rows = defaultdict(list)
+    for n, spectr in enumerate(spectra, 1):
+        for table, values in input_tables(HiggsInputs(spectr), dmh).iteritems():
+            rows[table].append('%d ' % n + ' '.join('%.8E' % v for v in values))
+    for table, lines in rows.iteritems():
+        with open(prefix + table, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+
+def normalise_column(name):
+    """Lower-case a column name and strip anything but letters & digits,
+    e.g. 'nobs(tot)' -> 'nobstot'"""
+    return re.sub(r'[^a-z0-9]', '', name.lower())
+
+
+def header_columns(line):
+    """Get the column names from a '# cols: n Mh(1) ...' header line,
+    or None if it isn't one"""
+    parts = line.lstrip('#').replace(':', ' ').split()
+    if not parts or parts[0].lower() not in ('col', 'cols', 'columns'):
+        return None
+    return parts[1:]
+
+
+def column_positions(header, columns, filename):
+    """Match each wanted column to its position in the header.
+
+    header: list of str
+        Column names from the '# cols' line.
+    columns: dict
+        Map of our name to possible header names, e.g. HB_RESULT_COLUMNS.
+
+    Raises ValueError if one isn't there.
+    """
+    positions = {normalise_column(name): i for i, name in reversed(list(enumerate(header)))}
+    matched = {}
+    for name, aliases in columns.iteritems():
+        found = [positions[a] for a in aliases if a in positions]
+        if not found:
+            raise ValueError('No %s column in %s, columns are: %s' %
+                             (name, filename, ' '.join(header)))
+        matched[name] = found[0]
+    return matched
+
+
+def read_results(filename, columns):
+    """Read a HiggsBounds/HiggsSignals results table, using the '# cols'
+    header line to find the columns.
+
+    columns: dict
+        Map of our name to possible header names, e.g. HB_RESULT_COLUMNS.
+
+    Returns a dict of {point number: {our column name: value string}}.
+    Raises IOError if the file is missing, and ValueError if it has no
+    header, or a column isn't in it.
+    """
+    results = {}
+    positions = None
+    with open(filename) as f:
+        for line in f:
+            parts = line.split()
+            if not parts:
+                continue
+            if parts[0].startswith('#'):
+                header = header_columns(line)
+                if header:
+                    positions = column_positions(header, columns, filename)
+                continue
+            if positions is None:
+                raise ValueError('No "# cols" header before the results in %s' % filename)
+            results[int(float(parts[0]))] = {name: parts[i] for name, i in positions.iteritems()}
+    return results
+
+
+def hb_block(result):
+    """Make a HiggsBoundsResults SLHA block, as HiggsBounds writes in SLHA mode"""
+    return ('BLOCK HiggsBoundsResults\n'
+            '#CHANNELTYPE 1: channel with the highest statistical sensitivity\n'
+            '     1     1     %d         # channel id number\n'
+            '     1     2     %d         # HBresult\n'
+            '     1     3     %.8E       # obsratio\n'
+            '     1     4     %d         # combination\n' %
+            (int(float(result['chan'])), int(float(result['HBresult'])),
+             float(result['obsratio']), int(float(result['ncombined']))))
+
+
+def hs_block(result):
+    """Make a HiggsSignalsResults SLHA block, as HiggsSignals writes in SLHA mode"""
+    return ('BLOCK HiggsSignalsResults\n'
+            '     7       %d       # Number of observables (total)\n'
+            '     8       %.8E     # chi^2 (signal strength) from peak observables\n'
+            '     9       %.8E     # chi^2 (Higgs mass) from peak observables\n'
+            '    12       %.8E     # chi^2 (total)\n'
+            '    13       %.8E     # Probability (total chi^2, total number observables)\n' %
+            (int(float(result['nobs'])), float(result['csq_mu']), float(result['csq_mh']),
+             float(result['csq_tot']), float(result['Pvalue'])))
+
+
+def run_batch(spectra, hb_dir, hs_dir, batch_dir, dmh=(2, 2)):
+    """Run HiggsBounds and/or HiggsSignals once over a batch of spectrum
+    files, and append their results to each file.
+
+    spectra: list of str
+        Spectrum filepaths.
+    hb_dir, hs_dir: str
+        HiggsBounds & HiggsSignals directories. If None, that program isn't run.
+    batch_dir: str
+        Directory for the input & output tables. Deleted afterwards.
+    dmh: list of float
+        Neutral Higgs mass uncertainties for HiggsSignals.
+
+    Returns a dict of program return codes, with the (wall, cpu) time for
+    each program in the 'timings' entry. Raises IOError or ValueError if a
+    results file is missing or can't be read (see read_results()).
+    """
+    if not os.path.isdir(batch_dir):
+        os.makedirs(batch_dir)
+    prefix = os.path.join(os.path.abspath(batch_dir), '')
+    write_input_tables(prefix, spectra, dmh)
+
+    return_codes = {'timings': {}}
+    hb_results, hs_results = {}, {}
+    # like NMSSMTools, use relpaths as the programs have limited string lengths
+    if hb_dir:
+        hb_cmds = ['./HiggsBounds', 'LandH', 'effC', str(N_HZERO), str(N_HPLUS),
+                   os.path.join(os.path.relpath(prefix, hb_dir), '')]
+        log.debug(hb_cmds)
+        with stage_timer(return_codes['timings'], 'HB'):
+            return_codes['HB'] = call(hb_cmds, cwd=hb_dir)
+        hb_results = read_results(prefix + 'HiggsBounds_results.dat', HB_RESULT_COLUMNS)
+    if hs_dir:
+        hs_cmds = ['./HiggsSignals', 'latestresults', 'peak', '2', 'effC', str(N_HZERO), str(N_HPLUS),
+                   os.path.join(os.path.relpath(prefix, hs_dir), '')]
+        log.debug(hs_cmds)
+        with stage_timer(return_codes['timings'], 'HS'):
+            return_codes['HS'] = call(hs_cmds, cwd=hs_dir)
+        hs_results = read_results(prefix + 'HiggsSignals_results.dat', HS_RESULT_COLUMNS)
+
+    for n, spectr in enumerate(spectra, 1):
+        blocks = []
+        if n in hb_results:
+            blocks.append(hb_block(hb_results[n]))
+        if n in hs_results:
+            blocks.append(hs_block(hs_results[n]))
+        if blocks:
+            with open(spectr, 'a') as f:
+                f.write(''.join(blocks))
+
+    shutil.rmtree(batch_dir)
+    return return_codes
@@ -2,6 +2,8 @@
 
 """
 Make a HDF5 binary from lots of CSV files so it can be easily used in pandas
+
+Also reads the output<ID>.h5 files from analyse_scans.py --format hdf5.
 """
 
 import sys
@@ -15,10 +17,19 @@ from shutil import copyfile
 from bisect import bisect_left
 
 
+# Table name & flag columns in the HDF5 files from analyse_scans.py --format hdf5
+# (see analyse_scans.OutputHDF5)
+HDF5_KEY = 'points'
+HDF5_FLAGS = {'output_good': 'good', 'output_ma1Lt11': 'ma1Lt11'}
+
+
 def load_df(folders, filestem, n_files=-1):
     """Load dataframe with CSV files from several folders in directory arg,
     from CSV files named <filestem>[0-9]*.dat
 
+    If there are output[0-9]*.h5 files instead (from analyse_scans.py
+    --format hdf5), these are used, see load_hdf5_df().
+
     Works by first making a large CSV file from all the consituent CSV files,
     and then reading that into a dataframe.
 
@@ -33,6 +44,11 @@ def load_df(folders, filestem, n_files=-1):
         file_list += [fi for fi in glob.glob(fo + "/%s[0-9]*.dat" % filestem)]
 
     if not file_list:
+        h5_list = []
+        for fo in folders:
+            h5_list += glob.glob(fo + "/output[0-9]*.h5")
+        if h5_list:
+            return load_hdf5_df(h5_list[:n_files], filestem)
         raise IndexError("file_list is empty - are you sure you've input the correct folders?")
 
     file_list = file_list[:n_files]
@@ -64,6 +80,34 @@ def load_df(folders, filestem, n_files=-1):
     return df
 
 
+def load_hdf5_df(file_list, filestem):
+    """Load dataframe from the HDF5 files of analyse_scans.py --format hdf5.
+
+    These are already typed, so there is no merged CSV to make & parse;
+    the per-file tables are just concatenated. The good & ma1Lt11 points are
+    picked out with their flag columns, e.g. filestem='output_good' only
+    loads points with good == True.
+    """
+    flag = HDF5_FLAGS.get(filestem)
+    dfs = []
+    for h5 in file_list:
+        print "Adding", h5
+        if flag:
+            dfs.append(pd.read_hdf(h5, HDF5_KEY, where='%s == True' % flag))
+        else:
+            dfs.append(pd.read_hdf(h5, HDF5_KEY))
+
+    print "Making dataframe..."
+    df = pd.concat(dfs, ignore_index=True)
+
+    # rename from column "lambda" to "lambda_"
+    df.rename(columns={'lambda': 'lambda_'}, inplace=True)
+
+    print "Entries:", len(df.index)
+    print "Columns:", df.columns.values, len(df.columns.values), "columns"
+    return df
+
+
 def store_channel_xsec(df):
     """
     Calculate total cross-section & scaled cross-sections
@@ -0,0 +1,120 @@
+"""
+Driver for NMSSMTools' own random scan mode (MODSEL 10 = ISCAN = 2).
+
+Instead of writing one card per point and starting NMSSMTools for each, we
+write a single scan-mode card covering the parameter ranges, run NMSSMTools
+once, and read back its table of points. This saves the process startup and
+file churn for every point.
+
+The scan card is made from the usual template: each scanned parameter line
+(e.g. "61 SED_LAMBDAD0 # LAMBDA") is replaced by a pair of lines with the
+NMSSMTools min/max codes (code * 10 + 7 and code * 10 + 8, e.g. 617/618),
+and a STEPS block sets the number of points (NTOT) and random seed (ISEED).
+
+NMSSMTools writes the points passing all its constraints to out*.dat, and
+those failing to err*.dat, one row per point with no header, so the columns
+are given by SCAN_COLUMNS for the NMSSMTools version in use.
+
+This is experimental: SCAN_COLUMNS was worked out by reading the NMSSMTools
+4.9.3 source, not checked against the output of a real scan run.
+testing/check_nt_scan_table.py compares a real out*.dat with the spectrum
+of one of its points, and should pass before the ntscan_*.csv output is
+relied on.
+
+Note that NMSSMTools does the sampling itself, so the priors, samplers and
+manifest of sampling.py do not apply, and it only gives the quantities in its
+scan table, not the full SLHA spectrum, so HiggsBounds/HiggsSignals cannot be
+run over the points.
+"""
+
+
+import re
+import logging
+from card_template import format_value
+
+
+log = logging.getLogger(__name__)
+
+
+# MODSEL 10 value for a random scan
+ISCAN_RANDOM = 2
+
+# Added to 10 * the parameter code to get the min/max codes
+MIN_CODE, MAX_CODE = 7, 8
+
+# The first columns of each row of the scan output files of NMSSMTools 4.9.3
+# (the OUTPUT routine of main/nmhdecay_rand.f), as analyse_scans field names:
+# PAR(1-6), the gaugino masses PAR(20-22), then the Higgs masses.
+# Any further columns are ignored. Not yet checked against a real scan run,
+# see testing/check_nt_scan_table.py.
+SCAN_COLUMNS = ['lambda', 'kappa', 'tgbeta', 'mueff', 'alambda', 'akappa',
+                'm1', 'm2', 'm3',
+                'mh1', 'mh2', 'mh3', 'ma1', 'ma2', 'mhc']
+
+
+def make_scan_card(template, params, n_points, iseed):
+    """Make the text of a scan-mode card.
+
+    template: CardTemplate
+        Template card, with slots for each parameter.
+    params: list of sampling.Parameter
+        Parameters to scan. Fixed parameters are just set to their value.
+    n_points: int
+        Number of points for NMSSMTools to try (NTOT).
+    iseed: int
+        Random seed for NMSSMTools (ISEED).
+    """
+    scan_template = template.with_block_entries({('MODSEL', 10): str(ISCAN_RANDOM)})
+    params = {p.name: p for p in params}
+    for p in params.itervalues():
+        if p.prior == 'log':
+            log.warning('NMSSMTools scan mode samples its own way, '
+                        'ignoring log prior for %s', p.name)
+
+    lines = []
+    for i, line in enumerate(scan_template.lines):
+        # slots can also match commented-out lines, e.g. "# M3H^2" for M3
+        if i not in scan_template.slots or line.lstrip().startswith('#'):
+            lines.append(line)
+            continue
+        key, start, end = scan_template.slots[i]
+        p = params[key]
+        if p.prior == 'fixed':
+            lines.append(line[:start] + format_value(p.value) + line[end:])
+            continue
+        indent, code = re.match(r'(\s*)(\d+)', line).groups()
+        for suffix, value, label in [(MIN_CODE, p.min, 'min'), (MAX_CODE, p.max, 'max')]:
+            lines.append('%s%d\t%s\t# %s_%s\n' % (indent, int(code) * 10 + suffix,
+                                                 format_value(value), key, label))
+
+    if lines and not lines[-1].endswith('\n'):
+        lines[-1] += '\n'
+    lines.append('\nBLOCK STEPS\n')
+    lines.append('\t0\t%d\t\t# NTOT\n' % n_points)
+    lines.append('\t1\t%d\t\t# ISEED\n' % iseed)
+    return ''.join(lines)
+
+
+def scan_output_paths(card_path):
+    """Get the (passing, failing) points files NMSSMTools writes for a scan card"""
+    return card_path.replace('inp', 'out'), card_path.replace('inp', 'err')
+
+
+def read_scan_table(filename):
+    """Read the points from an NMSSMTools scan output file (out*.dat or err*.dat).
+
+    Returns a list of {field name: value} dicts, one per point, with the
+    fields in SCAN_COLUMNS. Raises ValueError on a row that is too short.
+    """
+    points = []
+    with open(filename) as f:
+        for n, line in enumerate(f, 1):
+            values = line.split()
+            if not values or values[0].startswith('#'):
+                continue
+            if len(values) < len(SCAN_COLUMNS):
+                raise ValueError('Only %d columns on line %d of %s, expected at least %d'
+                                 % (len(values), n, filename, len(SCAN_COLUMNS)))
+            points.append({name: float(x.upper().replace('D', 'E'))
+                           for name, x in zip(SCAN_COLUMNS, values)})
+    return points
@@ -0,0 +1,174 @@
+"""
+On-disk cache of tool chain results, keyed by the content of the input card.
+
+The key is a hash of the rendered card text plus a fingerprint of the tools
+that were run: each tool's directory name (which has its version, e.g.
+NMSSMTools_4.9.3) and the contents of the patch files applied to them.
+Identical inputs run with the same tools give the same key, whichever job
+or directory they come from, so the cache can live somewhere shared
+(e.g. on HDFS) and be used by many jobs at once.
+
+Each entry is a JSON file of the result (<key>.json), plus the spectrum file
+if there was one (<key>.dat), stored under a subdirectory named after the
+first two characters of the key. Files are written to a temporary name and
+renamed into place, so other jobs never see half-written entries; the JSON
+is written last, so its presence means the entry is complete.
+
+The cache is bounded in size: a hit updates the JSON file's mtime, and when
+the total size goes over the limit, the least-recently-used entries are
+deleted.
+"""
+
+
+import os
+import json
+import glob
+import shutil
+import socket
+import hashlib
+import logging
+
+
+log = logging.getLogger(__name__)
+
+
+# Bump if the entry format or meaning changes, to invalidate old entries
+CACHE_VERSION = 1
+
+# Patch files that go into the tool fingerprint, relative to this directory
+# (on the batch system they're transferred into the job directory itself)
+PATCH_GLOBS = ['patches/*.patch', '*.patch']
+
+# Check the cache size after this many new entries
+CHECK_EVERY = 100
+
+
+def patch_files():
+    """Get the patch files for the tool fingerprint"""
+    here = os.path.dirname(os.path.abspath(__file__))
+    files = set()
+    for pattern in PATCH_GLOBS:
+        files.update(glob.glob(os.path.join(here, pattern)))
+    return sorted(files, key=os.path.basename)
+
+
+class ResultCache(object):
+    """Content-addressed, size-bounded cache of tool chain results.
+
+    cache_dir: str
+        Cache directory. Created if needed.
+    max_size: float
+        Maximum total size in GB.
+    """
+    def __init__(self, cache_dir, max_size=10):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_bytes = max_size * 1024**3
+        self.n_stored = 0
+        if not os.path.isdir(self.cache_dir):
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError:
+                # another job may have made it first
+                if not os.path.isdir(self.cache_dir):
+                    raise
+        patches = hashlib.sha256()
+        for filename in patch_files():
+            with open(filename) as f:
+                patches.update(os.path.basename(filename) + f.read())
+        self.patch_hash = patches.hexdigest()
+
+    def key(self, card_text, tool_dirs):
+        """Make the cache key for a card run with the tools in tool_dirs
+        (map of tool name to directory, None = not run)."""
+        tools = sorted((name, os.path.basename(os.path.normpath(d)))
+                       for name, d in tool_dirs.iteritems() if d)
+        h = hashlib.sha256()
+        h.update(json.dumps([CACHE_VERSION, tools, self.patch_hash]))
+        h.update(card_text)
+        return h.hexdigest()
+
+    def _path(self, key, ext):
+        return os.path.join(self.cache_dir, key[:2], key + ext)
+
+    def fetch(self, key, spectr):
+        """Look up a key. On a hit, the stored spectrum (if any) is copied to
+        `spectr`, and the stored result dict is returned. On a miss, returns None.
+        """
+        json_path = self._path(key, '.json')
+        try:
+            with open(json_path) as f:
+                result = json.load(f)
+            if result.pop('has_spectrum', False):
+                shutil.copyfile(self._path(key, '.dat'), spectr)
+        except (IOError, OSError, ValueError):
+            # not there, or evicted by another job while we were reading it
+            return None
+        try:
+            os.utime(json_path, None)
+        except OSError:
+            # some filesystems (e.g. HDFS over FUSE) don't allow this
+            pass
+        result['cached'] = True
+        return result
+
+    def store(self, key, spectr, result):
+        """Store the result dict and spectrum file (if it exists) for a key."""
+        entry_dir = os.path.dirname(self._path(key, ''))
+        if not os.path.isdir(entry_dir):
+            try:
+                os.makedirs(entry_dir)
+            except OSError:
+                pass
+        tmp_suffix = '.tmp.%s.%d' % (socket.gethostname(), os.getpid())
+        result = {k: v for k, v in result.iteritems() if k != 'timings'}
+        result['has_spectrum'] = os.path.isfile(spectr)
+        dat_path, json_path = self._path(key, '.dat'), self._path(key, '.json')
+        try:
+            if result['has_spectrum']:
+                shutil.copyfile(spectr, dat_path + tmp_suffix)
+                os.rename(dat_path + tmp_suffix, dat_path)
+            with open(json_path + tmp_suffix, 'w') as f:
+                json.dump(result, f)
+            os.rename(json_path + tmp_suffix, json_path)
+        except (IOError, OSError) as e:
+            # e.g. another job stored the same entry first, on a filesystem
+            # where rename won't replace an existing file
+            log.warning('Could not store %s in cache: %s', spectr, e)
+            for path in [dat_path + tmp_suffix, json_path + tmp_suffix]:
+                if os.path.isfile(path):
+                    os.remove(path)
+            return
+        self.n_stored += 1
+        if self.n_stored % CHECK_EVERY == 0:
+            self.evict()
+
+    def evict(self):
+        """Delete least-recently-used entries until the cache is at most 90%
+        of its maximum size."""
+        entries = []
+        total = 0
+        for json_path in glob.iglob(os.path.join(self.cache_dir, '*', '*.json')):
+            dat_path = json_path[:-len('.json')] + '.dat'
+            try:
+                size = os.path.getsize(json_path)
+                if os.path.isfile(dat_path):
+                    size += os.path.getsize(dat_path)
+                entries.append((os.path.getmtime(json_path), size, json_path, dat_path))
+            except OSError:
+                continue
+            total += size
+        if total <= self.max_bytes:
+            return
+        target = 0.9 * self.max_bytes
+        n_deleted = 0
+        for _, size, json_path, dat_path in sorted(entries):
+            if total <= target:
+                break
+            for path in [json_path, dat_path]:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            total -= size
+            n_deleted += 1
+        log.info('Evicted %d entries from cache %s', n_deleted, self.cache_dir)
@@ -2,59 +2,73 @@
 
 """
 This runs analyse_scans.py locally, to overcome the /software issue on condor.
-Does it in multiprocessing mode as it's an embaressing parallel task.
+Does it in multiprocessing mode as it's an embaressing parallel task:
+one process per spectr*.tgz archive, --jobs at a time.
+
+Archives already analysed with the current fields & settings are skipped,
+and ones that were only partly done are carried on with, see
+analysis_manifest.py.
+
+To use all the cores on one big directory of spectrum files instead, run
+analyse_scans.py directly with --jobs.
 """
 
 
-from analyse_scans import analyse_scans
+from analyse_scans import analyse_scans, AnalysisParser, analysis_settings
+from analysis_manifest import AnalysisManifest, analysis_hash
 import os
-import sys
-from glob import glob, iglob
-from subprocess import check_call
-from multiprocessing import Pool
+import argparse
+from glob import glob
+from multiprocessing import Pool, cpu_count
 import contextlib
 from functools import partial
 
 
-N_CPUS = 6
-
 HDFS_DIR = '/hdfs/user/%s/NMSSM-Scan/' % os.environ['LOGNAME']
 
+# Options passed to analyse_scans.py for every archive
+ANALYSIS_ARGS = ['--manifest']
+
 
 def do_one_dir(tar_file, job_dir):
     print 'Doing', tar_file
 
     pid = os.path.basename(tar_file).replace('spectr', '').split('.')[0]
 
-    tmp_dir = os.path.join(job_dir, 'scratch%s' % pid)
-    if not os.path.isdir(tmp_dir):
-        print 'Making dir', tmp_dir
-        os.makedirs(tmp_dir)
-
-    check_call(['tar', 'xzf', tar_file, '-C', tmp_dir])
-
-    analyse_scans([tmp_dir, '--oDir', job_dir, '--ID', pid])
-
-    for f in iglob(os.path.join(tmp_dir, '*')):
-        os.remove(f)
+    # reads the spectrum files straight from the archive, no need to extract
+    analyse_scans([tar_file, '--oDir', job_dir, '--ID', pid] + ANALYSIS_ARGS)
 
 
 if __name__ == "__main__":
-    if len(sys.argv) > 2:
-        print 'Only do 1 folder at a time'
-        exit(1)
-    if len(sys.argv) < 2:
-        print 'Must specify a folder to do'
-        exit(1)
-
-    local_job_dir = sys.argv[1]
-
-    spectr_tars = glob(os.path.join(HDFS_DIR, local_job_dir, 'spectr*tgz'))
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('job_dir',
+                        help='Job folder to do (only 1 at a time), relative to %s' % HDFS_DIR)
+    parser.add_argument('-j', '--jobs',
+                        help='Number of archives to analyse in parallel. '
+                        'Default is the number of CPUs.',
+                        type=int,
+                        default=cpu_count())
+    args = parser.parse_args()
+
+    local_job_dir = args.job_dir
+
+    spectr_tars = sorted(glob(os.path.join(HDFS_DIR, local_job_dir, 'spectr*tgz')))
+
+    # the input filename is only a placeholder, it doesn't change the settings
+    settings_hash = analysis_hash(analysis_settings(
+        AnalysisParser().parse_args(['spectr.tgz'] + ANALYSIS_ARGS)))
+    manifest = AnalysisManifest(local_job_dir)
+    todo = [s for s in spectr_tars if manifest.needs_analysis(s, settings_hash)]
+    print 'Skipping %d archives already analysed' % (len(spectr_tars) - len(todo))
+    manifest.save()
 
     do_one_dir_partial = partial(do_one_dir, job_dir=local_job_dir)
 
-    with contextlib.closing(Pool(processes=N_CPUS)) as pool:
-        pool.map(do_one_dir_partial, spectr_tars)
+    with contextlib.closing(Pool(processes=args.jobs)) as pool:
+        pool.map(do_one_dir_partial, todo)
+
+    # fold the new entries from each archive into the job dir's manifest
+    AnalysisManifest(local_job_dir).save()
 
     # non-parallel version
     # for s_tar in spectr_tars[0:1]:
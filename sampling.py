@@ -0,0 +1,383 @@
+#!/usr/bin/env python
+
+"""
+Generate parameter points for a scan job, and store them in a manifest.
+
+All points for a job are generated up front as one matrix (one row per point,
+one column per parameter), from a random stream seeded by (seed, batch), where
+batch is the job number. So any point can be regenerated exactly from
+(seed, batch, index), without needing the card or spectrum file.
+
+Each parameter in the paramRange JSON can declare a prior:
+
+    "LAMBDA": {"min": 0, "max": 0.3}                      # uniform (default)
+    "ALAMBDA": {"min": 10, "max": 4000, "prior": "log"}   # log-uniform
+    "M1": {"prior": "fixed", "value": 150}                # fixed
+
+Log-uniform ranges must not include 0; if both limits are negative, the
+magnitude is sampled log-uniformly.
+
+There are several ways of filling the unit hypercube before the priors are
+applied (SAMPLERS):
+
+- random: independent uniform random numbers.
+- sobol: a Sobol low-discrepancy sequence, randomised by a digital shift
+  that depends only on the seed. Job `batch` takes points
+  [batch * n_points, (batch + 1) * n_points) of the one global sequence, so the
+  union of all jobs is itself a low-discrepancy set.
+- lhs: Latin hypercube over all n_batches * n_points points, with job `batch`
+  taking its own slice of rows. The union of all jobs is a full Latin hypercube.
+
+Usage to print a point from a manifest:
+
+    ./sampling.py <manifest.npz> <index>
+"""
+
+
+import sys
+import json
+import logging
+import numpy as np
+
+
+log = logging.getLogger(__name__)
+
+
+PRIORS = ['uniform', 'log', 'fixed']
+
+SAMPLERS = ['random', 'sobol', 'lhs']
+
+# Number of bits used for Sobol points, so max 2^SOBOL_BITS points in total
+SOBOL_BITS = 30
+
+# Sobol primitive polynomials & initial direction numbers for dimensions 2-40,
+# from Joe & Kuo (new-joe-kuo-6.21201). The polynomial includes the leading
+# and trailing 1 bits. Dimension 1 is the van der Corput sequence.
+SOBOL_DIRECTIONS = [
+    (3, [1]),
+    (7, [1, 3]),
+    (11, [1, 3, 1]),
+    (13, [1, 1, 1]),
+    (19, [1, 1, 3, 3]),
+    (25, [1, 3, 5, 13]),
+    (37, [1, 1, 5, 5, 17]),
+    (41, [1, 1, 5, 5, 5]),
+    (47, [1, 1, 7, 11, 19]),
+    (55, [1, 1, 5, 1, 1]),
+    (59, [1, 1, 1, 3, 11]),
+    (61, [1, 3, 5, 5, 31]),
+    (67, [1, 3, 3, 9, 7, 49]),
+    (91, [1, 1, 1, 15, 21, 21]),
+    (97, [1, 3, 1, 13, 27, 49]),
+    (103, [1, 1, 1, 15, 7, 5]),
+    (109, [1, 3, 1, 15, 13, 25]),
+    (115, [1, 1, 5, 5, 19, 61]),
+    (131, [1, 3, 7, 11, 23, 15, 103]),
+    (137, [1, 3, 7, 13, 13, 15, 69]),
+    (143, [1, 1, 3, 13, 7, 35, 63]),
+    (145, [1, 3, 5, 9, 1, 25, 53]),
+    (157, [1, 3, 1, 13, 9, 35, 107]),
+    (167, [1, 3, 1, 5, 27, 61, 31]),
+    (171, [1, 1, 5, 11, 19, 41, 61]),
+    (185, [1, 3, 5, 3, 3, 13, 69]),
+    (191, [1, 1, 7, 13, 1, 19, 1]),
+    (193, [1, 3, 7, 5, 13, 19, 59]),
+    (203, [1, 1, 3, 9, 25, 29, 41]),
+    (211, [1, 3, 5, 13, 23, 1, 55]),
+    (213, [1, 3, 7, 3, 13, 59, 17]),
+    (229, [1, 3, 1, 3, 5, 53, 69]),
+    (239, [1, 1, 5, 5, 23, 33, 13]),
+    (241, [1, 1, 7, 7, 1, 61, 123]),
+    (247, [1, 1, 7, 9, 13, 61, 49]),
+    (253, [1, 3, 3, 5, 3, 55, 33]),
+    (285, [1, 3, 1, 15, 31, 13, 49, 245]),
+    (299, [1, 3, 5, 15, 31, 59, 63, 97]),
+    (301, [1, 3, 1, 11, 11, 11, 77, 249]),
+]
+
+
+class Parameter(object):
+    """One scan parameter, with its prior.
+
+    name: str
+        Parameter name, as used in the card template e.g. 'LAMBDA'.
+    prior: str
+        One of PRIORS.
+    min, max: float
+        Range for uniform/log priors.
+    value: float
+        Value for fixed prior.
+    """
+    def __init__(self, name, prior='uniform', min=None, max=None, value=None):
+        if prior not in PRIORS:
+            raise ValueError('Unknown prior %s for %s, must be one of %s' % (prior, name, PRIORS))
+        if prior == 'fixed':
+            if value is None:
+                raise ValueError('Fixed parameter %s needs a value' % name)
+            min, max = value, value
+        else:
+            if min is None or max is None:
+                raise ValueError('Parameter %s needs a min and max' % name)
+            if prior == 'log' and (min * max <= 0):
+                raise ValueError('Log prior range for %s must not include 0' % name)
+        self.name = name
+        self.prior = prior
+        self.min = float(min)
+        self.max = float(max)
+        self.value = value
+
+    def transform(self, u):
+        """Convert array of numbers in [0, 1) to parameter values."""
+        if self.prior == 'fixed':
+            return np.full_like(u, self.min)
+        elif self.prior == 'log':
+            sign = np.sign(self.min)
+            lo, hi = np.log(abs(self.min)), np.log(abs(self.max))
+            return sign * np.exp(lo + u * (hi - lo))
+        else:
+            return self.min + u * (self.max - self.min)
+
+    def to_dict(self):
+        if self.prior == 'fixed':
+            return {'prior': self.prior, 'value': self.value}
+        return {'prior': self.prior, 'min': self.min, 'max': self.max}
+
+    def __repr__(self):
+        return 'Parameter({0})'.format(self.__dict__)
+
+
+def load_param_ranges(filename):
+    """Read parameters from a paramRange JSON file.
+
+    Entries beginning with '_' are comments and are ignored.
+    Returns a list of Parameter objects, sorted by name so that the column
+    order is always the same for a given file.
+    """
+    with open(filename) as json_file:
+        param_dict = json.load(json_file)
+    return params_from_dict(param_dict)
+
+
+def params_from_dict(param_dict):
+    """Make a sorted list of Parameter objects from a dict of {name: options}"""
+    params = []
+    for k in sorted(param_dict.iterkeys()):
+        if k.startswith('_'):
+            log.debug('Removing entry %s' % k)
+            continue
+        v = param_dict[k]
+        params.append(Parameter(name=str(k), prior=v.get('prior', 'uniform'),
+                                min=v.get('min'), max=v.get('max'),
+                                value=v.get('value')))
+    return params
+
+
+def get_rng(seed, batch, sub_stream=None):
+    """Get the random stream for a job. Each (seed, batch) gets its own stream.
+    Jobs that need several independent streams can also pass a sub_stream number."""
+    if sub_stream is None:
+        return np.random.RandomState([seed, batch])
+    return np.random.RandomState([seed, batch, sub_stream])
+
+
+def new_seed():
+    """Make a new random seed, for when the user doesn't specify one."""
+    return int(np.random.RandomState().randint(0, 2**31 - 1))
+
+
+def sobol_direction_numbers(n_dims):
+    """Get the Sobol direction numbers as a SOBOL_BITS x n_dims array of ints."""
+    if n_dims > len(SOBOL_DIRECTIONS) + 1:
+        raise ValueError('Sobol sampling only supports up to %d dimensions' % (len(SOBOL_DIRECTIONS) + 1))
+    v = np.zeros((SOBOL_BITS, n_dims), dtype=np.uint64)
+    # first dimension: all m_k = 1
+    for k in xrange(SOBOL_BITS):
+        v[k, 0] = 1 << (SOBOL_BITS - 1 - k)
+    for j in xrange(1, n_dims):
+        poly, m_init = SOBOL_DIRECTIONS[j - 1]
+        s = poly.bit_length() - 1
+        m = list(m_init)
+        for k in xrange(s, SOBOL_BITS):
+            # m_k = 2 a_1 m_{k-1} ^ 4 a_2 m_{k-2} ^ ... ^ 2^s m_{k-s} ^ m_{k-s}
+            new_m = m[k - s] ^ (m[k - s] << s)
+            for i in xrange(1, s):
+                if (poly >> (s - i)) & 1:
+                    new_m ^= m[k - i] << i
+            m.append(new_m)
+        for k in xrange(SOBOL_BITS):
+            v[k, j] = m[k] << (SOBOL_BITS - 1 - k)
+    return v
+
+
+def sobol_points(indices, n_dims, seed):
+    """Get the Sobol points with the given indices in the global sequence,
+    as a len(indices) x n_dims matrix in [0, 1).
+
+    The sequence is scrambled by a random digital shift (XOR) that only
+    depends on `seed`, so all jobs with the same seed share the same sequence.
+    """
+    indices = np.asarray(indices, dtype=np.uint64)
+    if len(indices) and indices.max() >= 2**SOBOL_BITS:
+        raise ValueError('Too many Sobol points, max is 2^%d' % SOBOL_BITS)
+    v = sobol_direction_numbers(n_dims)
+    # Gray code ordering, so each point only depends on its own index
+    gray = indices ^ (indices >> np.uint64(1))
+    x = np.zeros((len(indices), n_dims), dtype=np.uint64)
+    for k in xrange(SOBOL_BITS):
+        bit_set = ((gray >> np.uint64(k)) & np.uint64(1)).astype(bool)
+        x[bit_set] ^= v[k]
+    shift = np.random.RandomState(seed).randint(0, 2**SOBOL_BITS, size=n_dims).astype(np.uint64)
+    x ^= shift
+    return x.astype(np.float64) / 2**SOBOL_BITS
+
+
+def lhs_points(n_points, n_dims, seed, batch, n_batches):
+    """Get this job's rows of a Latin hypercube over n_batches * n_points points.
+
+    The strata for each dimension are shuffled by a permutation that only
+    depends on `seed`, so the jobs fit together into one Latin hypercube.
+    The position within each stratum comes from the job's own stream.
+    """
+    if not 0 <= batch < n_batches:
+        raise ValueError('batch must be in [0, n_batches) for LHS sampling')
+    n_total = n_points * n_batches
+    start = batch * n_points
+    strata = np.empty((n_points, n_dims))
+    for j in xrange(n_dims):
+        perm = np.random.RandomState([seed, j]).permutation(n_total)
+        strata[:, j] = perm[start:start + n_points]
+    jitter = get_rng(seed, batch).random_sample((n_points, n_dims))
+    return (strata + jitter) / n_total
+
+
+def sample_unit_cube(n_points, n_dims, seed, batch, sampler='random', n_batches=1):
+    """Get this job's n_points x n_dims matrix of points in [0, 1).
+
+    n_points: int
+        Number of points per job.
+    n_dims: int
+        Number of dimensions.
+    seed: int
+        Seed for the whole set of jobs.
+    batch: int
+        Job number.
+    sampler: str
+        One of SAMPLERS.
+    n_batches: int
+        Total number of jobs (only needed for lhs).
+    """
+    if sampler == 'random':
+        return get_rng(seed, batch).random_sample((n_points, n_dims))
+    elif sampler == 'sobol':
+        start = batch * n_points
+        return sobol_points(np.arange(start, start + n_points), n_dims, seed)
+    elif sampler == 'lhs':
+        return lhs_points(n_points, n_dims, seed, batch, n_batches)
+    else:
+        raise ValueError('Unknown sampler %s, must be one of %s' % (sampler, SAMPLERS))
+
+
+def transform_points(params, u):
+    """Convert matrix of [0, 1) numbers into parameter values, column by column."""
+    values = np.empty_like(u)
+    for i, p in enumerate(params):
+        values[:, i] = p.transform(u[:, i])
+    return values
+
+
+def sample_points(params, n_points, seed, batch=0, sampler='random', n_batches=1):
+    """Generate the parameter matrix for a job.
+
+    params: list of Parameter
+        Parameters to sample, one column each.
+    n_points: int
+        Number of points (rows).
+    seed: int
+        Seed for the whole set of jobs.
+    batch: int
+        Job number.
+    sampler: str
+        One of SAMPLERS.
+    n_batches: int
+        Total number of jobs (only needed for lhs).
+    """
+    u = sample_unit_cube(n_points, len(params), seed, batch, sampler, n_batches)
+    return transform_points(params, u)
+
+
+def regenerate_point(params, seed, batch, index, sampler='random', n_points=None, n_batches=1):
+    """Regenerate the parameter values for point `index` of job `batch`.
+
+    n_points (the number of points per job) is only needed for sobol & lhs.
+    Returns a dict of {name: value}.
+    """
+    if sampler == 'random':
+        # The stream is drawn row by row, so we only need the first index+1 rows
+        n_points = index + 1
+    elif n_points is None:
+        raise ValueError('Need n_points to regenerate a %s point' % sampler)
+    row = sample_points(params, n_points, seed, batch, sampler, n_batches)[index]
+    return {p.name: v for p, v in zip(params, row)}
+
+
+def points_to_dicts(params, values):
+    """Convert parameter matrix into a list of {name: value} dicts,
+    e.g. for CardTemplate.render_many()"""
+    names = [p.name for p in params]
+    return [dict(zip(names, row)) for row in values.tolist()]
+
+
+def write_manifest(filename, params, values, seed, batch, sampler='random', n_batches=1,
+                   prescreen_pass=None):
+    """Store the parameter matrix & how it was generated in a compressed
+    numpy file.
+
+    prescreen_pass: numpy.array of bool, optional
+        Whether each originally sampled point passed the tree-level prescreen.
+        Rows that failed were either not run, or replaced by a resampled point.
+    """
+    if prescreen_pass is None:
+        prescreen_pass = np.ones(len(values), dtype=bool)
+    np.savez_compressed(filename,
+                        prescreen_pass=prescreen_pass,
+                        names=np.array([p.name for p in params]),
+                        values=values,
+                        seed=np.array(seed),
+                        batch=np.array(batch),
+                        sampler=np.array(sampler),
+                        n_batches=np.array(n_batches),
+                        priors=np.array(json.dumps({p.name: p.to_dict() for p in params})))
+    log.info('Written parameter manifest to %s', filename)
+
+
+def read_manifest(filename):
+    """Read a manifest from write_manifest().
+
+    Returns a dict with keys names, values, seed, batch, sampler, n_batches,
+    prescreen_pass, params.
+    """
+    with np.load(filename) as data:
+        manifest = {
+            'names': [str(n) for n in data['names']],
+            'values': data['values'],
+            'seed': int(data['seed']),
+            'batch': int(data['batch']),
+            'sampler': str(data['sampler']),
+            'n_batches': int(data['n_batches']) if 'n_batches' in data else 1,
+        }
+        if 'prescreen_pass' in data:
+            manifest['prescreen_pass'] = data['prescreen_pass']
+        else:
+            manifest['prescreen_pass'] = np.ones(len(manifest['values']), dtype=bool)
+        manifest['params'] = params_from_dict(json.loads(str(data['priors'])))
+    return manifest
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print 'Usage: %s <manifest.npz> <index>' % sys.argv[0]
+        sys.exit(1)
+    manifest = read_manifest(sys.argv[1])
+    ind = int(sys.argv[2])
+    for name, value in zip(manifest['names'], manifest['values'][ind]):
+        print name, value
@@ -0,0 +1,141 @@
+"""
+Checkpointing for long scans, so an evicted job can carry on where it left off.
+
+Since all points for a job are generated up front from the (seed, batch)
+random stream, the only state needed to resume is the sampling settings and
+which point indices have finished. These are kept in a journal file: the
+first line is a JSON dict of settings, then each finished index is appended
+on its own line (and flushed to disk) as soon as the point is done.
+A half-written last line from a crash is ignored.
+
+To survive losing the worker's disk, SpectrumFlusher periodically tars up
+newly finished spectrum files into a safe directory (e.g. the job's HDFS
+directory), along with a copy of the journal made after the tar, so the
+saved journal never lists points whose spectra weren't saved.
+"""
+
+
+import os
+import json
+import glob
+import time
+import shutil
+import tarfile
+import logging
+
+
+log = logging.getLogger(__name__)
+
+
+def read_settings(filename):
+    """Get the settings dict from a journal file, or None if it doesn't exist."""
+    if not os.path.isfile(filename):
+        return None
+    with open(filename) as f:
+        return json.loads(f.readline())
+
+
+class ScanJournal(object):
+    """Append-only record of finished point indices.
+
+    filename: str
+        Journal file. If it exists, the finished indices are read from it,
+        and its settings must match.
+    settings: dict
+        Everything that determines the points, e.g. seed, batch, sampler.
+    """
+    def __init__(self, filename, settings):
+        self.filename = filename
+        self.done = set()
+        old_settings = read_settings(filename)
+        if old_settings is None:
+            with open(filename, 'w') as f:
+                f.write(json.dumps(settings, sort_keys=True) + '\n')
+            return
+
+        if old_settings != json.loads(json.dumps(settings)):
+            raise RuntimeError('Settings in journal %s (%s) do not match this scan (%s). '
+                               'Delete it to start again.' % (filename, old_settings, settings))
+        with open(filename) as f:
+            lines = f.readlines()
+        if not lines[-1].endswith('\n'):
+            # drop a half-written line, so new entries don't get appended to it
+            lines = lines[:-1]
+            with open(filename, 'w') as f:
+                f.writelines(lines)
+        self.done.update(int(line) for line in lines[1:])
+        log.info('Resuming from journal %s: %d points already done', filename, len(self.done))
+
+    def record(self, indices):
+        """Mark point indices as finished"""
+        with open(self.filename, 'a') as f:
+            for ind in indices:
+                f.write('%d\n' % ind)
+            f.flush()
+            os.fsync(f.fileno())
+        self.done.update(indices)
+
+
+class SpectrumFlusher(object):
+    """Copies finished spectrum files and the journal to a safe directory
+    every so often.
+
+    flush_dir: str
+        Directory to copy to.
+    journal: ScanJournal
+        Journal to copy after each chunk.
+    batch: int
+        Batch number, used in the filenames: chunks are partial<batch>_<N>.tgz,
+        and the journal is copied to journal<batch>.txt.
+    every: int
+        Flush once this many points have finished since the last flush...
+    minutes: float
+        ...or this long after the last flush, if any have.
+        Points count whether or not their spectrum files were kept, so the
+        journal & extra files are saved even if most spectra are deleted.
+    extra_files: list of str
+        Other files kept up to date with the finished points (e.g. output CSVs),
+        copied as they are on each flush, before the journal.
+    """
+    def __init__(self, flush_dir, journal, batch, every=200, minutes=15, extra_files=None):
+        self.flush_dir = flush_dir
+        self.journal = journal
+        self.extra_files = extra_files or []
+        self.batch = batch
+        self.every = every
+        self.seconds = minutes * 60.
+        self.pending = []
+        self.n_points = 0  # finished since the last flush
+        self.last_flush = time.time()
+        self.n_chunks = len(glob.glob(os.path.join(flush_dir, 'partial%d_*.tgz' % batch)))
+
+    def add(self, filenames):
+        """Add the spectrum files of finished points, one per point, flushing
+        if it's time to. Files that no longer exist (e.g. deleted after being
+        analysed) still count as finished points."""
+        self.pending.extend(f for f in filenames if os.path.isfile(f))
+        self.n_points += len(filenames)
+        if (self.n_points >= self.every or
+                (self.n_points and time.time() - self.last_flush > self.seconds)):
+            self.flush()
+
+    def flush(self):
+        """Tar up the waiting files into a new chunk, then copy the extra files
+        and the journal"""
+        if self.pending:
+            chunk = os.path.join(self.flush_dir, 'partial%d_%d.tgz' % (self.batch, self.n_chunks))
+            tmp_chunk = chunk + '.tmp'
+            with tarfile.open(tmp_chunk, 'w:gz') as tar:
+                for filename in self.pending:
+                    tar.add(filename, arcname=os.path.basename(filename))
+            os.rename(tmp_chunk, chunk)
+            log.info('Flushed %d files to %s', len(self.pending), chunk)
+            self.n_chunks += 1
+            self.pending = []
+        for filename in self.extra_files:
+            if os.path.isfile(filename):
+                shutil.copy2(filename, os.path.join(self.flush_dir, os.path.basename(filename)))
+        shutil.copy2(self.journal.filename,
+                     os.path.join(self.flush_dir, 'journal%d.txt' % self.batch))
+        self.n_points = 0
+        self.last_flush = time.time()
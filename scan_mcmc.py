@@ -0,0 +1,319 @@
+"""
+Markov-chain scanning, to concentrate points in the interesting region
+(0 < ma1 < 60 GeV, an h(125), passing constraints) rather than sampling
+parameter space uniformly.
+
+The chain moves in the unit hypercube, with the priors from the paramRange
+JSON mapping it onto parameter values, so proposal widths are automatically
+relative to each parameter's range. Widths start at INIT_WIDTH of the range,
+then adapt: each parameter's width follows the spread of the chain so far in
+that parameter, with an overall scale tuned towards TARGET_ACCEPTANCE.
+
+The chain state (position, adaptation, RNG state) is checkpointed to a JSON
+file after every step, so a preempted job carries on where it left off.
+The checkpoint and the chain CSV can also be copied to a backup directory
+after every step (e.g. the HDFS job dir), to resume from on another node.
+"""
+
+
+import os
+import json
+import math
+import shutil
+import logging
+import numpy as np
+import analyse_scans
+
+
+log = logging.getLogger(__name__)
+
+
+# Starting proposal width, as a fraction of each parameter range
+INIT_WIDTH = 0.05
+
+# Acceptance rate the proposal scale is tuned towards
+TARGET_ACCEPTANCE = 0.234
+
+# Number of steps before the widths start following the chain spread
+ADAPT_START = 50
+
+# Likelihood settings
+LIKELIHOOD_DEFAULTS = {
+    'ma1_max': 60.,  # ma1 window is (0, ma1_max)
+    'ma1_width': 10.,  # falloff outside the ma1 window
+    'mh_target': 125.,  # want either h1 or h2 here...
+    'mh_width': 3.,  # ...within this uncertainty
+    'constraint_penalty': 5.,  # per failed constraint (except allowed ones)
+    'hb_penalty': 5.,  # if excluded by HiggsBounds
+    'hs_weight': 0.1,  # multiplies -chi2/2 from HiggsSignals
+}
+
+# Failed constraints we don't penalise
+ALLOWED_CONSTRAINTS = ["Relic density too small (Planck)",
+                       "Muon magn. mom. more than 2 sigma away"]
+
+# Names of the fields needed for the likelihood
+LIKELIHOOD_FIELDS = ['ma1', 'mh1', 'mh2', 'HBresult', 'HSchi2']
+
+
+def get_likelihood_fields():
+    """Get the Field objects needed by spectrum_log_likelihood()"""
+    return analyse_scans.fields_by_name(LIKELIHOOD_FIELDS)
+
+
+def log_likelihood(results, constraints, settings=LIKELIHOOD_DEFAULTS):
+    """Calculate log-likelihood for a point.
+
+    results: dict
+        Output of analyse_scans.get_slha_dict() with LIKELIHOOD_FIELDS.
+    constraints: list of str, or None
+        Output of analyse_scans.get_nmssmtools_constraints().
+        None means an unphysical point.
+    settings: dict
+        See LIKELIHOOD_DEFAULTS.
+    """
+    if constraints is None or results.get('ma1', '') == '':
+        return -np.inf
+
+    llh = 0.
+
+    ma1 = results['ma1']
+    if ma1 <= 0:
+        llh -= 0.5 * (ma1 / settings['ma1_width'])**2
+    elif ma1 >= settings['ma1_max']:
+        llh -= 0.5 * ((ma1 - settings['ma1_max']) / settings['ma1_width'])**2
+
+    mh_diffs = [abs(results[m] - settings['mh_target'])
+                for m in ['mh1', 'mh2'] if results.get(m, '') != '']
+    if mh_diffs:
+        llh -= 0.5 * (min(mh_diffs) / settings['mh_width'])**2
+
+    n_failed = len([c for c in constraints if c not in ALLOWED_CONSTRAINTS])
+    llh -= settings['constraint_penalty'] * n_failed
+
+    if results.get('HBresult', '') == 0:
+        llh -= settings['hb_penalty']
+
+    if results.get('HSchi2', '') != '':
+        llh -= settings['hs_weight'] * 0.5 * results['HSchi2']
+
+    return llh
+
+
+def spectrum_log_likelihood(spectr, fields=None, settings=LIKELIHOOD_DEFAULTS):
+    """Calculate log-likelihood from a spectrum file. Missing file = -inf."""
+    if not os.path.isfile(spectr):
+        return -np.inf
+    fields = fields or get_likelihood_fields()
+    constraints, results = analyse_scans.read_nmssmtools_spectrum(spectr, fields)
+    if constraints is None:
+        return -np.inf
+    return log_likelihood(results, constraints, settings)
+
+
+class ChainState(object):
+    """Everything needed to carry on a chain after a restart.
+
+    n_dims: int
+        Number of parameters.
+    rng: numpy.random.RandomState
+        Random stream for this chain.
+    """
+    def __init__(self, n_dims, rng):
+        self.step = 0
+        self.u = None  # current position in unit hypercube
+        self.llh = -np.inf  # current log-likelihood
+        self.index = None  # point index of current position
+        self.n_accepted = 0
+        self.log_scale = 0.
+        # running mean & sum of squares of positions, for adapting widths
+        self.n_seen = 0
+        self.mean = np.zeros(n_dims)
+        self.m2 = np.zeros(n_dims)
+        self.rng = rng
+
+    def widths(self):
+        """Current proposal width for each parameter"""
+        if self.n_seen < ADAPT_START:
+            base = np.full_like(self.mean, INIT_WIDTH)
+        else:
+            # 2.38/sqrt(d) is the optimal scaling for a Gaussian target
+            base = 2.38 / math.sqrt(len(self.mean)) * np.sqrt(self.m2 / (self.n_seen - 1))
+            base = np.clip(base, 1E-4, 0.5)
+        return base * math.exp(self.log_scale)
+
+    def update(self, accepted, adapt=True):
+        """Update adaptation after a step. With adapt False (e.g. still
+        looking for a point with a finite likelihood), only count the step."""
+        self.step += 1
+        if accepted:
+            self.n_accepted += 1
+        if not adapt:
+            return
+        # Robbins-Monro update of the overall scale
+        self.log_scale += (float(accepted) - TARGET_ACCEPTANCE) / math.sqrt(self.step)
+        if self.u is not None:
+            self.n_seen += 1
+            delta = self.u - self.mean
+            self.mean += delta / self.n_seen
+            self.m2 += delta * (self.u - self.mean)
+
+    def to_dict(self):
+        rng_state = self.rng.get_state()
+        return {
+            'step': self.step,
+            'u': None if self.u is None else self.u.tolist(),
+            'llh': None if np.isinf(self.llh) else self.llh,
+            'index': self.index,
+            'n_accepted': self.n_accepted,
+            'log_scale': self.log_scale,
+            'n_seen': self.n_seen,
+            'mean': self.mean.tolist(),
+            'm2': self.m2.tolist(),
+            'rng': [rng_state[0], rng_state[1].tolist()] + list(rng_state[2:]),
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        rng = np.random.RandomState()
+        rng_state = d['rng']
+        rng.set_state((str(rng_state[0]), np.array(rng_state[1], dtype=np.uint32)) + tuple(rng_state[2:]))
+        state = cls(len(d['mean']), rng)
+        state.step = d['step']
+        state.u = None if d['u'] is None else np.array(d['u'])
+        state.llh = -np.inf if d['llh'] is None else d['llh']
+        state.index = d['index']
+        state.n_accepted = d['n_accepted']
+        state.log_scale = d['log_scale']
+        state.n_seen = d['n_seen']
+        state.mean = np.array(d['mean'])
+        state.m2 = np.array(d['m2'])
+        return state
+
+    def save(self, filename):
+        """Write checkpoint. Done via a temp file so it's never half-written."""
+        tmp_filename = filename + '.tmp'
+        with open(tmp_filename, 'w') as f:
+            json.dump(self.to_dict(), f)
+        os.rename(tmp_filename, filename)
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename) as f:
+            return cls.from_dict(json.load(f))
+
+
+def propose(u, widths, rng):
+    """Gaussian step from u, reflected back into [0, 1)"""
+    new_u = u + widths * rng.standard_normal(len(u))
+    new_u = np.abs(new_u)  # reflect at 0
+    new_u = np.where(new_u >= 1, 2 - new_u, new_u)  # reflect at 1
+    return np.clip(new_u, 0, np.nextafter(1, 0))
+
+
+def truncate_chain(chain_file, n_steps):
+    """Cut a chain CSV back to its header and the first n_steps rows, e.g.
+    to drop a row written just before a crash, whose step wasn't checkpointed"""
+    with open(chain_file) as f:
+        lines = f.readlines()
+    if len(lines) <= n_steps + 1:
+        return
+    log.info('Dropping %d rows after step %d from %s', len(lines) - n_steps - 1,
+             n_steps, chain_file)
+    tmp_filename = chain_file + '.tmp'
+    with open(tmp_filename, 'w') as f:
+        f.writelines(lines[:n_steps + 1])
+    os.rename(tmp_filename, chain_file)
+
+
+def backup_file(filename, backup_dir):
+    """Copy a file into backup_dir, via a temp file so the copy is never
+    half-written"""
+    backup = os.path.join(backup_dir, os.path.basename(filename))
+    tmp_backup = backup + '.tmp'
+    shutil.copy2(filename, tmp_backup)
+    os.rename(tmp_backup, backup)
+
+
+def run_chain(params, indices, u_start, rng, evaluate, checkpoint_file, chain_file,
+              settings=LIKELIHOOD_DEFAULTS, backup_dir=None):
+    """Run one Markov chain.
+
+    params: list of sampling.Parameter
+        Parameters to scan.
+    indices: list of int
+        Point index to use for each step, in order.
+    u_start: numpy.array
+        Starting position in the unit hypercube. Until a point with a finite
+        log-likelihood is found, each step instead draws a new uniform
+        position, and the proposal widths aren't adapted.
+    rng: numpy.random.RandomState
+        Random stream for this chain (ignored when resuming).
+    evaluate: callable
+        Called as evaluate(index, values_dict); must run the tools and return
+        the spectrum filepath.
+    checkpoint_file: str
+        JSON file for the chain state. If it exists, the chain is resumed.
+    chain_file: str
+        CSV file the chain is written to: each step's point index, whether it
+        was accepted, its log-likelihood, and the parameter values. When
+        resuming, any rows after the checkpointed step are dropped, as those
+        steps are redone.
+    backup_dir: str, optional
+        Directory to copy the chain CSV & checkpoint to after every step.
+        To resume from there, copy them back to chain_file & checkpoint_file.
+
+    Returns the final ChainState.
+    """
+    fields = get_likelihood_fields()
+
+    if os.path.isfile(checkpoint_file):
+        state = ChainState.load(checkpoint_file)
+        log.info('Resuming chain from %s at step %d', checkpoint_file, state.step)
+        truncate_chain(chain_file, state.step)
+    else:
+        state = ChainState(len(params), rng)
+        with open(chain_file, 'w') as f:
+            f.write(','.join(['index', 'accepted', 'llh'] + [p.name for p in params]) + '\n')
+
+    for ind in indices[state.step:]:
+        # no finite likelihood yet: don't adapt, and jump anywhere rather than
+        # wander around a point with no likelihood
+        finite = not np.isinf(state.llh)
+        if state.u is None:
+            new_u = np.asarray(u_start)
+        elif not finite:
+            new_u = state.rng.random_sample(len(params))
+        else:
+            new_u = propose(state.u, state.widths(), state.rng)
+        values = {p.name: p.transform(np.array([x]))[0] for p, x in zip(params, new_u)}
+
+        spectr = evaluate(ind, values)
+        llh = spectrum_log_likelihood(spectr, fields, settings)
+
+        if state.u is None:
+            accepted = True
+        elif np.isinf(llh):
+            accepted = False
+        else:
+            accepted = math.log(state.rng.random_sample()) < llh - state.llh
+
+        if accepted:
+            state.u, state.llh, state.index = new_u, llh, ind
+        state.update(accepted, adapt=finite)
+
+        with open(chain_file, 'a') as f:
+            f.write(','.join([str(ind), str(int(accepted)), str(llh)] +
+                             [str(values[p.name]) for p in params]) + '\n')
+        state.save(checkpoint_file)
+        if backup_dir:
+            # chain first: on resuming, rows past the checkpoint are dropped,
+            # but missing rows couldn't be recovered
+            backup_file(chain_file, backup_dir)
+            backup_file(checkpoint_file, backup_dir)
+
+        if state.step % 100 == 0:
+            log.info('Chain step %d, acceptance %.3f, current log-likelihood %g',
+                     state.step, state.n_accepted / float(state.step), state.llh)
+
+    return state
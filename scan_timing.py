@@ -0,0 +1,91 @@
+"""
+Per-point, per-stage timing of the scan tool chain.
+
+Each stage (card rendering, NMSSMTools, ...) gets a wall-clock time and a CPU
+time. The CPU time includes that of any programs run during the stage, so
+for the external tools it's mostly theirs.
+
+Timings are written as one CSV row per point to a sidecar file as points
+finish, and a summary with a histogram of wall times for each stage can be
+logged at the end.
+"""
+
+
+import os
+import time
+import logging
+from contextlib import contextmanager
+import numpy as np
+
+
+log = logging.getLogger(__name__)
+
+
+# Stages in the order they happen, as used for the sidecar columns
+STAGES = ['render', 'NT', 'DMASS', 'HB', 'HS', 'sushi', 'analyse']
+
+# Histogram bin edges for wall times (seconds)
+HIST_EDGES = [0, 0.01, 0.03, 0.1, 0.3, 1, 3, 10, 30, 100, 300, 1000, np.inf]
+
+
+def cpu_time():
+    """CPU time (user + system) of this process and its finished children"""
+    return sum(os.times()[:4])
+
+
+@contextmanager
+def stage_timer(timings, stage):
+    """Context manager to time a stage, storing (wall, cpu) in timings[stage].
+    Time is added on if the stage is already there, e.g. for a retry."""
+    wall_start, cpu_start = time.time(), cpu_time()
+    try:
+        yield
+    finally:
+        wall, cpu = time.time() - wall_start, cpu_time() - cpu_start
+        old_wall, old_cpu = timings.get(stage, (0., 0.))
+        timings[stage] = (old_wall + wall, old_cpu + cpu)
+
+
+class TimingLog(object):
+    """Writes per-point stage timings to a CSV, and keeps them for the summary.
+
+    filename: str
+        CSV file. Appended to if it exists, e.g. when resuming a scan.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.timings = {}
+        if not os.path.isfile(filename):
+            with open(filename, 'w') as f:
+                f.write(','.join(['index'] + ['%s_%s' % (s, t) for s in STAGES
+                                              for t in ['wall', 'cpu']]) + '\n')
+
+    def record(self, ind, timings):
+        """Store & write out the timings dict (stage: (wall, cpu)) for a point"""
+        self.timings[ind] = timings
+        row = [str(ind)]
+        for stage in STAGES:
+            if stage in timings:
+                row.extend('%.3f' % t for t in timings[stage])
+            else:
+                row.extend(['', ''])
+        with open(self.filename, 'a') as f:
+            f.write(','.join(row) + '\n')
+
+    def summary(self):
+        """Log total/mean/max times per stage, and a histogram of wall times"""
+        if not self.timings:
+            return
+        log.info('Timing summary for %d points (wall time in s):', len(self.timings))
+        for stage in STAGES:
+            times = np.array([t[stage] for t in self.timings.itervalues() if stage in t])
+            if not len(times):
+                continue
+            wall, cpu = times[:, 0], times[:, 1]
+            log.info('  %-6s total %9.1f  mean %8.3f  median %8.3f  max %8.3f  (cpu total %9.1f)',
+                     stage, wall.sum(), wall.mean(), np.median(wall), wall.max(), cpu.sum())
+            counts, _ = np.histogram(wall, HIST_EDGES)
+            scale = 40. / counts.max()
+            for low, high, n in zip(HIST_EDGES[:-1], HIST_EDGES[1:], counts):
+                if n:
+                    log.info('         %6g - %-6g %6d %s', low, high, n, '#' * max(1, int(n * scale)))
@@ -0,0 +1,203 @@
+"""
+Helpers to run the scan tool chain over many points in parallel on one node.
+
+Each worker gets its own copy of the NMSSMTools/HiggsBounds/HiggsSignals
+directories, since the tools write temporary files into their own directory
+(e.g. NMSSMTools writes 'spectr' & 'omega' into its top dir before moving
+them), so two points cannot be run from the same directory at once.
+Executables, libraries and experimental/theory tables, which the tools only
+read, are hardlinked where possible, so copies are cheap in both time and
+disk; everything else (e.g. Fortran work files, which are rewritten in place
+and so would be shared through a hardlink) is copied.
+
+Workers pull point indices from a shared queue, so a slow point does not hold
+up the others. Output filenames depend only on the point index, so results do
+not depend on which worker ran which point.
+"""
+
+
+import os
+import shutil
+import logging
+import multiprocessing
+
+
+log = logging.getLogger(__name__)
+
+
+# Directories of data tables the tools only read, so can be shared
+SHARED_DIRS = {'Expt_tables', 'Theory_tables', 'EXPCON'}
+# Directories where files are written while running, so are never shared
+WORK_DIRS = {'work'}
+# Extensions of libraries & object files
+LIBRARY_EXTS = ('.a', '.so', '.o', '.mod')
+
+
+def can_share(path, rel_dir):
+    """Check if a file in a tool directory is only read while the tools run,
+    so can be hardlinked into a worker's copy: executables, libraries, and
+    data tables, except in work directories.
+
+    path: str
+        Filepath.
+    rel_dir: str
+        Its directory, relative to the top of the tool directory.
+    """
+    parts = set(rel_dir.split(os.sep))
+    if parts & WORK_DIRS:
+        return False
+    if parts & SHARED_DIRS:
+        return True
+    return path.endswith(LIBRARY_EXTS) or os.access(path, os.X_OK)
+
+
+def clone_tree(src, dst, hardlink=True):
+    """Make a copy of directory tree `src` at `dst`.
+
+    If hardlink=True, files that are only read (see can_share()) are
+    hardlinked (falling back to a real copy if that fails, e.g. across
+    filesystems), and the rest copied. Otherwise all files are copied.
+    Symlinks are recreated as symlinks.
+    """
+    src = os.path.abspath(src)
+    for dirpath, dirnames, filenames in os.walk(src):
+        rel = os.path.relpath(dirpath, src)
+        new_dir = os.path.normpath(os.path.join(dst, rel))
+        if not os.path.isdir(new_dir):
+            os.makedirs(new_dir)
+        # os.walk doesn't recurse into symlinked dirs, so deal with them here
+        for name in filenames + [d for d in dirnames if os.path.islink(os.path.join(dirpath, d))]:
+            src_file = os.path.join(dirpath, name)
+            dst_file = os.path.join(new_dir, name)
+            if os.path.lexists(dst_file):
+                continue
+            if os.path.islink(src_file):
+                os.symlink(os.readlink(src_file), dst_file)
+                continue
+            if hardlink and can_share(src_file, rel):
+                try:
+                    os.link(src_file, dst_file)
+                    continue
+                except OSError:
+                    log.debug('Cannot hardlink %s, copying instead', src_file)
+            shutil.copy2(src_file, dst_file)
+
+
+def setup_worker_dirs(tool_dirs, work_dir, n_workers, hardlink=True):
+    """Make a set of tool directories for each worker.
+
+    Worker 0 uses the original directories, the others get clones under
+    work_dir/worker_<N>/.
+
+    tool_dirs: dict
+        Map of tool name to directory, e.g. {'NT': 'NMSSMTools_4.9.3', 'HB': None}.
+        Entries that are None are left as None for all workers.
+    work_dir: str
+        Directory to put the worker clones in.
+    n_workers: int
+        Number of workers.
+    hardlink: bool
+        Hardlink files instead of copying them.
+
+    Returns a list of dicts, one per worker, with the same keys as tool_dirs.
+    """
+    worker_dirs = [{k: os.path.abspath(v) if v else None
+                    for k, v in tool_dirs.iteritems()}]
+    for wid in xrange(1, n_workers):
+        this_dirs = {}
+        for k, v in tool_dirs.iteritems():
+            if not v:
+                this_dirs[k] = None
+                continue
+            src = os.path.abspath(v)
+            dst = os.path.join(os.path.abspath(work_dir), 'worker_%d' % wid,
+                               os.path.basename(src.rstrip('/')))
+            log.info('Setting up %s for worker %d in %s', k, wid, dst)
+            clone_tree(src, dst, hardlink=hardlink)
+            this_dirs[k] = dst
+        worker_dirs.append(this_dirs)
+    return worker_dirs
+
+
+def _worker(wid, tool_dirs, point_func, index_queue, result_queue):
+    """Process point indices from index_queue until a None is received."""
+    while True:
+        ind = index_queue.get()
+        if ind is None:
+            break
+        try:
+            result = point_func(ind, tool_dirs)
+        except Exception as e:
+            log.exception('Worker %d failed on point %d', wid, ind)
+            result = {'error': str(e)}
+        result_queue.put((ind, result))
+    result_queue.put(None)
+
+
+def run_pool(indices, worker_dirs, point_func, callback=None):
+    """Run point_func over all indices, using one process per entry in worker_dirs.
+
+    indices: iterable of int
+        Point indices to process.
+    worker_dirs: list of dict
+        Tool directories for each worker, from setup_worker_dirs().
+    point_func: callable
+        Called as point_func(index, tool_dirs), must return a picklable result.
+    callback: callable, optional
+        Called as callback(index, result) in the main process as each point
+        finishes.
+
+    Returns a dict of {index: result}.
+    """
+    index_queue = multiprocessing.Queue()
+    result_queue = multiprocessing.Queue()
+    indices = list(indices)
+    for ind in indices:
+        index_queue.put(ind)
+    for _ in worker_dirs:
+        index_queue.put(None)
+
+    workers = [multiprocessing.Process(target=_worker,
+                                       args=(wid, tool_dirs, point_func,
+                                             index_queue, result_queue))
+               for wid, tool_dirs in enumerate(worker_dirs)]
+    for w in workers:
+        w.start()
+
+    results = {}
+    n_running = len(workers)
+    while n_running > 0:
+        item = result_queue.get()
+        if item is None:
+            n_running -= 1
+            continue
+        ind, result = item
+        results[ind] = result
+        if callback:
+            callback(ind, result)
+
+    for w in workers:
+        w.join()
+
+    return results
+
+
+def run_points(indices, point_func, worker_dirs, callback=None):
+    """Run point_func over indices: in parallel with run_pool() if there are
+    several sets of worker directories, otherwise in this process.
+
+    Arguments & return value as for run_pool(). As there, if point_func
+    raises, the result is {'error': message}.
+    """
+    if len(worker_dirs) > 1:
+        return run_pool(indices, worker_dirs, point_func, callback)
+    results = {}
+    for ind in indices:
+        try:
+            results[ind] = point_func(ind, worker_dirs[0])
+        except Exception as e:
+            log.exception('Failed on point %d', ind)
+            results[ind] = {'error': str(e)}
+        if callback:
+            callback(ind, results[ind])
+    return results
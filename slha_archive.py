@@ -0,0 +1,433 @@
+#!/usr/bin/env python
+
+"""
+Long-format archive of everything in a set of SLHA spectrum files, so that
+a new field can be added without re-parsing the raw spectra.
+
+Every line with a number on it, in every BLOCK (including the DECAY
+entries, which NMSSMTools puts after BLOCK DCINFO), is stored as a row of
+one pandas table in an HDF5 file:
+
+- point: id of the spectrum file, see the POINTS_KEY table for its filename
+- block: id of the BLOCK name, see the BLOCKS_KEY table
+- line: position of the line in the spectrum file
+- comment: id of the text after the # (as on the line, as Field comments
+  may start with a space), see the COMMENTS_KEY table
+- k0 ... k<MAX_TOKENS-1>: the integer tokens on the line, by position,
+  KEY_NONE where a token isn't an integer (or there is no token). Words
+  (e.g. DECAY) are interned too, see the WORDS_KEY table & word_key().
+- vpos: position of the value token
+- value: the value, as a float
+
+The value is the first token that is a number but not an integer (e.g.
+the BR in "4.9E-02 2 21 21"), or if they are all integers, the last one
+(e.g. "16 12 # IMAX"). Any further non-integer numbers on a line get a row
+each, with the same keys (e.g. HiggsBoundsInputHiggsCouplingsFermions).
+
+A Field can then be materialised as a column by looking up its block,
+key tokens, value position and comment, just as slha_parser.FieldTable does
+on the raw text, see materialise(). DecayFields are looked up by their
+parent & daughter PDGIDs instead, using the DECAY line before each entry.
+Fields that the table parser can't handle (i.e. that need a regex) can't be
+materialised.
+
+Usage:
+
+    ./slha_archive.py <dir of spectr*.dat, or spectr*.tgz> ... -o <archive.h5>
+
+e.g. to make a column for a new field in a notebook:
+
+    df = slha_archive.materialise('archive.h5', [new_field])
+"""
+
+
+import os
+import sys
+import glob
+import argparse
+import logging
+import contextlib
+from collections import defaultdict
+import numpy as np
+import pandas as pd
+import slha_parser
+from analyse_scans import is_archive, iter_archive_members
+
+
+logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.INFO)
+log = logging.getLogger(__name__)
+
+
+# Table names in the archive
+ENTRIES_KEY = 'entries'
+POINTS_KEY = 'points'
+BLOCKS_KEY = 'blocks'
+COMMENTS_KEY = 'comments'
+WORDS_KEY = 'words'
+
+# Number of token positions stored per line; later tokens are dropped
+MAX_TOKENS = 8
+
+# Key for a token that isn't an integer
+KEY_NONE = np.iinfo(np.int32).min
+# Keys for words start here, well away from any PDGID
+KEY_WORD = KEY_NONE + 1
+
+KEY_COLUMNS = ['k%d' % i for i in xrange(MAX_TOKENS)]
+ENTRY_COLUMNS = ['point', 'block', 'line', 'comment'] + KEY_COLUMNS + ['vpos', 'value']
+
+# Number of spectrum files to buffer before appending to the archive
+ARCHIVE_CHUNK = 200
+
+# Max length of filenames stored in POINTS_KEY
+NAME_SIZE = 256
+
+
+def parse_token(token):
+    """Get (key, value) for a token: (int, None) for an integer,
+    (KEY_NONE, float) for any other number, (token, None) for a word, or
+    (KEY_NONE, None) for anything else"""
+    if '.' not in token:
+        try:
+            return int(token), None
+        except ValueError:
+            pass
+    try:
+        return KEY_NONE, float(token)
+    except ValueError:
+        return (token, None) if slha_parser.p_word_token.match(token) else (KEY_NONE, None)
+
+
+def word_key(word_id):
+    """Get the key stored for the word with this id in WORDS_KEY"""
+    return KEY_WORD + word_id
+
+
+def iter_slha_entries(text, parse=parse_token):
+    """Get (block, line number, comment, keys, value position, value) for
+    every entry in the text of an SLHA file, see the module docstring.
+    Lines before the first BLOCK are ignored.
+
+    parse: callable
+        Gets (key, value) for a token, as parse_token() does, where the
+        key of a word is the word itself.
+    """
+    block = None
+    for i, line in enumerate(text.splitlines()):
+        data, _, comment = line.partition('#')
+        tokens = data.split()
+        if not tokens:
+            continue
+        if tokens[0] in ('BLOCK', 'Block'):
+            block = tokens[1] if len(tokens) > 1 else None
+            continue
+        if block is None:
+            continue
+        parsed = [parse(t) for t in tokens[:MAX_TOKENS]]
+        keys = tuple(k for k, _ in parsed) + (KEY_NONE,) * (MAX_TOKENS - len(parsed))
+        values = [(pos, v) for pos, (_, v) in enumerate(parsed) if v is not None]
+        if not values:
+            # the last token is the value if it's an integer; going by the
+            # token itself, as parse() gives words integer keys too
+            last, _ = parse_token(tokens[len(parsed) - 1])
+            if not isinstance(last, int) or last == KEY_NONE:
+                continue
+            values = [(len(parsed) - 1, float(last))]
+        for vpos, value in values:
+            yield block, i, comment.rstrip(), keys, vpos, value
+
+
+class Interner(object):
+    """Assigns each new string the next integer id.
+
+    names: list of str, optional
+        Strings already assigned ids 0, 1, ...
+    """
+    def __init__(self, names=None):
+        self.names = [] if names is None else list(names)
+        self.ids = {name: i for i, name in enumerate(self.names)}
+
+    def __getitem__(self, name):
+        try:
+            return self.ids[name]
+        except KeyError:
+            self.ids[name] = len(self.names)
+            self.names.append(name)
+            return self.ids[name]
+
+    def frame(self):
+        """Get the ids & strings as a DataFrame, indexed by id"""
+        return pd.DataFrame({'name': self.names}, columns=['name'])
+
+
+class SLHAArchive(object):
+    """Write spectrum files to an archive. Use as a context manager, or call
+    close() at the end.
+
+    filename: str
+        HDF5 file to write.
+    append: bool
+        Add to an existing archive, otherwise it is overwritten.
+    """
+    def __init__(self, filename, append=False):
+        self.filename = filename
+        self.store = pd.HDFStore(filename, mode='a' if append else 'w',
+                                 complevel=9, complib='blosc')
+        self.blocks, self.comments, self.words = Interner(), Interner(), Interner()
+        self.n_points, self.n_entries = 0, 0
+        if append and ENTRIES_KEY in self.store:
+            self.blocks = Interner(self.store[BLOCKS_KEY]['name'])
+            self.comments = Interner(self.store[COMMENTS_KEY]['name'])
+            self.words = Interner(self.store[WORDS_KEY]['name'])
+            self.n_points = self.store.get_storer(POINTS_KEY).nrows
+            self.n_entries = self.store.get_storer(ENTRIES_KEY).nrows
+        # parse_key() results for the integers & words seen so far, which
+        # are mostly the same few keys in every file
+        self.key_tokens = {}
+        self.rows = []
+        self.points = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def parse_key(self, token):
+        """parse_token(), with the key for a word from word_key()"""
+        try:
+            return self.key_tokens[token]
+        except KeyError:
+            key, value = parse_token(token)
+            if value is None:
+                if isinstance(key, str):
+                    key = word_key(self.words[key])
+                self.key_tokens[token] = key, value
+            return key, value
+
+    def add(self, input_name, filename, text):
+        """Add the entries in the text of a spectrum file, from filename in
+        input_name (a directory or archive). Returns the point id."""
+        point = self.n_points + len(self.points)
+        self.points.append((input_name, filename))
+        for block, line, comment, keys, vpos, value in iter_slha_entries(text, self.parse_key):
+            self.rows.append((point, self.blocks[block], line, self.comments[comment]) +
+                             keys + (vpos, value))
+        if len(self.points) >= ARCHIVE_CHUNK:
+            self.flush()
+        return point
+
+    def flush(self):
+        """Append the buffered points to the archive"""
+        if not self.points:
+            return
+        dtypes = defaultdict(lambda: np.int32, line=np.int32, block=np.int16,
+                             vpos=np.int8, value=np.float64)
+        values = np.array(self.rows, dtype=np.float64)
+        data = {c: values[:, i].astype(dtypes[c]) for i, c in enumerate(ENTRY_COLUMNS)}
+        n = len(self.rows)
+        entries = pd.DataFrame(data, columns=ENTRY_COLUMNS,
+                               index=np.arange(self.n_entries, self.n_entries + n))
+        self.store.append(ENTRIES_KEY, entries, format='table',
+                          data_columns=True, index=False)
+
+        inputs, filenames = zip(*self.points)
+        points = pd.DataFrame({'input': [s[:NAME_SIZE] for s in inputs],
+                               'file': [s[:NAME_SIZE] for s in filenames]},
+                              columns=['input', 'file'],
+                              index=np.arange(self.n_points, self.n_points + len(self.points)))
+        self.store.append(POINTS_KEY, points, format='table',
+                          min_itemsize={'input': NAME_SIZE, 'file': NAME_SIZE}, index=False)
+
+        # the lookup tables are small, so just rewrite them
+        self.store.put(BLOCKS_KEY, self.blocks.frame())
+        self.store.put(COMMENTS_KEY, self.comments.frame())
+        self.store.put(WORDS_KEY, self.words.frame())
+        self.store.flush()
+
+        self.n_entries += n
+        self.n_points += len(self.points)
+        self.rows = []
+        self.points = []
+
+    def close(self):
+        self.flush()
+        if ENTRIES_KEY in self.store:
+            # for fast lookups of a block's entries, and the DECAY lines,
+            # in materialise()
+            self.store.create_table_index(ENTRIES_KEY, columns=['block', 'point', 'k0'],
+                                          optlevel=9, kind='full')
+        self.store.close()
+
+
+def iter_spectra(path):
+    """Get (filename, text) for each spectrum file in a directory (in
+    filename order) or spectr*.tgz archive (in archive order)."""
+    if is_archive(path):
+        for name, text in iter_archive_members([path]):
+            basename = os.path.basename(name)
+            if basename.startswith('spectr') and basename.endswith('.dat'):
+                yield name, text
+    else:
+        for filename in sorted(glob.glob(os.path.join(path, 'spectr*.dat'))):
+            with open(filename) as f:
+                yield os.path.basename(filename), f.read()
+
+
+def field_layout(field):
+    """Get ([(token position, key)], value position) to look up a Field in
+    an archive, where each key is an int, or a word. Returns None if it can't
+    be looked up, i.e. if the table parser can't handle it (see
+    slha_parser.compile_field()), or it needs tokens past the first
+    MAX_TOKENS. DecayFields are looked up differently, see materialise()."""
+    if slha_parser.decay_key(field) is not None:
+        return None
+    compiled = slha_parser.compile_field(field)
+    if compiled is None:
+        return None
+    positions, keys, value_pos = compiled
+    if max(positions + (value_pos,)) >= MAX_TOKENS:
+        return None
+    keys = [k if slha_parser.p_word_token.match(k) else int(k) for k in keys]
+    return zip(positions, keys), value_pos
+
+
+def can_materialise(field):
+    """Check if a Field can be materialised from an archive"""
+    decay = slha_parser.decay_key(field)
+    if decay is not None:
+        return len(decay[1] or ()) <= MAX_TOKENS - 2
+    return field_layout(field) is not None
+
+
+def first_values(entries, mask, index, type_):
+    """Get a column of the value of the first entry matching mask for each
+    point in index (NaN if none), as type_ if there are no NaNs."""
+    matches = entries[mask].drop_duplicates('point')
+    column = matches.set_index('point')['value'].reindex(index)
+    if type_ is int and column.notnull().all():
+        column = column.astype(int)
+    return column
+
+
+def decay_entries(store, decay_key):
+    """Get the entries in the DECAY tables (in the blocks they come after),
+    sorted by point & line, with the parent PDGID of each table in a
+    'parent' column, and 'header' True for the DECAY lines themselves.
+
+    decay_key: int
+        Key of the word DECAY.
+    """
+    headers = store.select(ENTRIES_KEY, where='k0 == %d' % decay_key, columns=['block'])
+    blocks = sorted(headers['block'].unique())
+    if not blocks:
+        return None
+    entries = store.select(ENTRIES_KEY, where='block == %r' % [int(b) for b in blocks])
+    entries.sort_values(['point', 'line'], inplace=True)
+    entries['header'] = entries['k0'] == decay_key
+    # each line belongs to the table of the last DECAY line before it
+    entries['parent'] = entries['k1'].where(entries['header'])
+    entries['parent'] = entries.groupby(['point', 'block'])['parent'].ffill()
+    return entries
+
+
+def materialise(filename, fields):
+    """Make a column for each Field from an archive.
+
+    The first matching line of a point is used, as in the parsers in
+    analyse_scans.py. Points without a match get NaN.
+
+    filename: str
+        Archive from SLHAArchive.
+    fields: list of Field objects/namedtuples
+        Each must pass can_materialise().
+
+    Returns a DataFrame indexed by point id, with 'input' & 'file' columns
+    for the spectrum file, and one column per field.
+    """
+    layouts, decay_fields = [], []
+    for f in fields:
+        if not can_materialise(f):
+            raise ValueError("Can't materialise %s from an archive, "
+                             "it needs the raw spectra" % f.name)
+        decay = slha_parser.decay_key(f)
+        if decay is not None:
+            decay_fields.append((f,) + decay)
+        else:
+            layouts.append((f,) + field_layout(f))
+
+    with contextlib.closing(pd.HDFStore(filename, mode='r')) as store:
+        df = store[POINTS_KEY]
+        block_ids = {name: i for i, name in store[BLOCKS_KEY]['name'].iteritems()}
+        comments = store[COMMENTS_KEY]['name']
+        word_ids = {name: i for i, name in store[WORDS_KEY]['name'].iteritems()}
+
+        by_block = defaultdict(list)
+        for layout in layouts:
+            by_block[layout[0].block].append(layout)
+
+        for block, block_layouts in by_block.iteritems():
+            if block in block_ids:
+                entries = store.select(ENTRIES_KEY, where='block == %d' % block_ids[block])
+                entries.sort_values(['point', 'line'], inplace=True)
+            else:
+                entries = None
+
+            for f, keys, value_pos in block_layouts:
+                if entries is None:
+                    df[f.name] = np.nan
+                    continue
+                comment = slha_parser.field_comment(f)
+                comment_ids = [i for i, c in comments.iteritems() if comment in c]
+                mask = (entries['vpos'] == value_pos) & entries['comment'].isin(comment_ids)
+                for pos, key in keys:
+                    if not isinstance(key, int):
+                        # a word that isn't in any spectrum matches nothing
+                        key = word_key(word_ids[key]) if key in word_ids else KEY_NONE
+                    mask &= entries['k%d' % pos] == key
+                df[f.name] = first_values(entries, mask, df.index, f.type)
+
+        entries = None
+        if decay_fields and 'DECAY' in word_ids:
+            entries = decay_entries(store, word_key(word_ids['DECAY']))
+        for f, parent, daughters in decay_fields:
+            if entries is None:
+                df[f.name] = np.nan
+                continue
+            mask = entries['parent'] == parent
+            if daughters is None:
+                mask &= entries['header'] & (entries['vpos'] == 2)
+            else:
+                n = len(daughters)
+                mask &= ~entries['header'] & (entries['vpos'] == 0) & (entries['k1'] == n)
+                tokens = np.sort(entries[KEY_COLUMNS[2:2 + n]].values, axis=1)
+                mask &= (tokens == np.array(daughters)).all(axis=1)
+            df[f.name] = first_values(entries, mask, df.index, f.type)
+    return df
+
+
+def main(in_args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('inputs', nargs='+',
+                        help='Directories of spectr*.dat files, or spectr*.tgz archives')
+    parser.add_argument('-o', '--output', help='Archive file to write',
+                        default='slha_archive.h5')
+    parser.add_argument('--append', help='Add to the archive instead of overwriting it',
+                        action='store_true')
+    args = parser.parse_args(in_args)
+
+    with SLHAArchive(args.output, append=args.append) as archive:
+        for path in args.inputs:
+            name = os.path.basename(os.path.normpath(path))
+            n_before = archive.n_points + len(archive.points)
+            for filename, text in iter_spectra(path):
+                archive.add(name, filename, text)
+            log.info('Added %d spectra from %s',
+                     archive.n_points + len(archive.points) - n_before, path)
+        log.info('Writing %s', args.output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
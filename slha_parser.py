@@ -0,0 +1,327 @@
+"""
+Table-driven parser to pull Field values out of SLHA files.
+
+Rather than trying every Field's regex against every line of a block, each
+Field is compiled once into an entry in a lookup table: its block, the
+positions and values of the integer keys on its line (e.g. PDGID 25 in
+BLOCK MASS, or "2 21 21" for a BR), and which token holds the value.
+Each line of the file is then split into tokens once, and the entry is
+found with a dict lookup on (block, key tokens).
+
+The key alone isn't always enough, as some Fields have wildcard keys. So the
+Field's comment must also be on the line, just as in the regex parser.
+Fields whose regex can't be turned into a table entry, e.g. ones matching a
+commented-out line, fall back to regex matching, but only within their own
+block.
+
+Branching ratios & widths are different: each DECAY table (which NMSSMTools
+puts after BLOCK DCINFO) is parsed once into a sparse map of
+(parent PDGID, daughter PDGIDs) -> BR, see parse_decays(), and Fields with a
+parent PDGID (NMSSMToolsFields.DecayField) are looked up in that, rather
+than matched by comment.
+
+Blocks without any Fields are skipped over without looking at their lines.
+As with the regex parser, the first line matching a Field is used, and
+blocks are case-sensitive.
+
+Cuts on field values can be passed to FieldTable.parse(), so that a point
+failing them is thrown away as soon as the field is read (e.g. ma1 in
+BLOCK MASS, near the top), rather than after parsing the whole file.
+"""
+
+
+import re
+from collections import defaultdict
+from itertools import izip
+from operator import itemgetter
+
+
+# A regex token capturing the value, e.g. ([E\d\.\-\+]+)
+p_value_token = re.compile(r'^\(.*\)$')
+# A literal integer key, e.g. 25 or \-13
+p_int_token = re.compile(r'^(\\?-)?\d+$')
+# A literal word key, e.g. DECAY
+p_word_token = re.compile(r'^[A-Za-z]+$')
+# A wildcard matching any single token, e.g. \d or [E\d\.\-\+]+
+p_wildcard_token = re.compile(r'^(\\d\+?|\[[^\] ]+\]\+?)$')
+# Separators between tokens in Field regexes
+p_separator = re.compile(r' \+| +')
+# Beyond this many different key tokens at a position, filter_regex() doesn't
+# check them, as the regex alternation would be slower than the dict lookup
+MAX_ALTERNATIVES = 32
+# Start of a block, with its name
+p_block = re.compile(r'\n(?:BLOCK|Block)[ \t]+(\S+)')
+# Start of a block or DECAY table
+p_table = re.compile(r'\n(BLOCK|Block|DECAY)\b')
+# A line in a DECAY table: BR, number of daughters, and the rest up to any #
+p_br = re.compile(r'\n[ \t]*([^\s#]\S*)[ \t]+(\d+)[ \t]+([^#\n]*)')
+
+
+def field_pattern(field):
+    """Get the regex pattern string of a Field"""
+    return getattr(field.regex, 'pattern', field.regex)
+
+
+def field_comment(field):
+    """Get the comment phrase of a Field, which must be on a matching line.
+    Made from the regex pattern if the Field doesn't have one."""
+    comment = getattr(field, 'comment', None)
+    if not comment:
+        comment = field_pattern(field).split('#')[1].replace('\\', '')
+    return comment
+
+
+def decay_key(field):
+    """Get (parent PDGID, sorted daughter PDGIDs) for a Field from the DECAY
+    tables, with daughters None for the total width, or None for any other
+    Field."""
+    parent = getattr(field, 'parent', None)
+    if parent is None:
+        return None
+    daughters = getattr(field, 'daughters', None)
+    return parent, None if daughters is None else tuple(sorted(daughters))
+
+
+class Decays(object):
+    """The DECAY tables of an SLHA file: the total width of each parent, and
+    the BR of every channel listed, keyed by (parent PDGID, daughter PDGIDs),
+    with the daughters sorted. Made by parse_decays()."""
+    def __init__(self):
+        self.widths = {}
+        self.brs = {}
+
+    def get(self, parent, daughters=None):
+        """Get the BR for parent -> daughters (in any order), or the total
+        width of parent if daughters is None. None if it isn't listed."""
+        if daughters is None:
+            return self.widths.get(parent)
+        return self.brs.get((parent, tuple(sorted(daughters))))
+
+
+# Sorted daughter PDGIDs for the (number of daughters, rest of line) of the
+# lines seen so far, which are mostly the same in every file
+_daughters = {}
+
+
+def get_daughters(n_daughters, rest):
+    """Get the sorted daughter PDGIDs from the groups of a p_br match"""
+    try:
+        return _daughters[n_daughters, rest]
+    except KeyError:
+        daughters = tuple(sorted(int(t) for t in rest.split()[:int(n_daughters)]))
+        _daughters[n_daughters, rest] = daughters
+        return daughters
+
+
+def parse_decays(text, parents=None):
+    """Parse the DECAY tables in the text of an SLHA file into a Decays.
+    As with Fields, the first table & line for a parent/channel is used.
+
+    parents: set of int, optional
+        Only parse the tables of these parent PDGIDs.
+    """
+    decays = Decays()
+    if not text.startswith('\n'):
+        text = '\n' + text
+    first = text.find('\nDECAY')
+    if first < 0:
+        return decays
+    starts = list(p_table.finditer(text, first))
+    ends = [m.start() for m in starts[1:]] + [len(text)]
+    brs = decays.brs
+    for m, end in izip(starts, ends):
+        if m.group(1) != 'DECAY':
+            continue
+        header_end = text.find('\n', m.end(), end)
+        if header_end < 0:
+            header_end = end
+        header = text[m.end():header_end].split('#', 1)[0].split()
+        parent = int(header[0])
+        if parent in decays.widths or (parents is not None and parent not in parents):
+            continue
+        decays.widths[parent] = float(header[1])
+        for br, n_daughters, rest in p_br.findall(text, header_end, end):
+            key = (parent, get_daughters(n_daughters, rest))
+            if key not in brs:
+                brs[key] = float(br)
+    return decays
+
+
+def compile_field(field):
+    """Work out where a Field's keys & value are on its SLHA line.
+
+    Returns (key positions, key tokens, value position), or None if the
+    Field's regex can't be expressed that way.
+    """
+    data = re.split(r'\\?#', field_pattern(field), 1)[0]
+    positions, keys, value_pos = [], [], None
+    for i, token in enumerate(t for t in p_separator.split(data) if t):
+        if p_value_token.match(token):
+            if value_pos is not None:
+                return None
+            value_pos = i
+        elif p_int_token.match(token) or p_word_token.match(token):
+            positions.append(i)
+            keys.append(token.replace('\\', ''))
+        elif not p_wildcard_token.match(token):
+            return None
+    if value_pos is None:
+        return None
+    return tuple(positions), tuple(keys), value_pos
+
+
+def filter_regex(positions, keys, n_min):
+    """Make a regex to pick out the lines in a block that might match a
+    layout, i.e. those with one of the wanted key tokens at each key position
+    (unless there are too many, then any token will do). Matches whole lines.
+
+    positions: tuple of int
+        Key token positions.
+    keys: list of tuple of str
+        Key tokens of each entry in the layout.
+    n_min: int
+        Minimum number of tokens on the line.
+    """
+    parts = []
+    for pos in xrange(n_min):
+        token = r'[^\s#]\S*' if pos == 0 else r'\S+'
+        if pos in positions:
+            values = set(k[positions.index(pos)] for k in keys)
+            if len(values) <= MAX_ALTERNATIVES:
+                token = '(?:%s)' % '|'.join(re.escape(v) for v in values)
+        parts.append(token)
+    # starting with a literal newline (rather than ^ in multiline mode) lets
+    # the regex engine skip quickly from line to line
+    return re.compile(r'\n[ \t]*' + r'[ \t]+'.join(parts) + r'(?=\s|#|$)[^\n]*')
+
+
+class FieldTable(object):
+    """Lookup table for a list of Fields, used to parse SLHA files.
+
+    fields: list of Field objects/namedtuples
+        Fields to parse, see analyse_scans.get_slha_dict().
+    """
+    def __init__(self, fields):
+        self.names = [f.name for f in fields]
+        # [(name, type, parent, daughters)] for Fields from the DECAY tables
+        self.decay_fields = []
+        # {block: {(key positions, value position): {key tokens: [(name, type, comment)]}}}
+        layouts = defaultdict(lambda: defaultdict(lambda: defaultdict(list)))
+        # {block: [(name, type, compiled regex)]} for regex fallback
+        self.regex_fields = defaultdict(list)
+        for f in fields:
+            decay = decay_key(f)
+            if decay is not None:
+                self.decay_fields.append((f.name, f.type) + decay)
+                continue
+            compiled = compile_field(f)
+            if compiled is None:
+                regex = f.regex if hasattr(f.regex, 'pattern') else re.compile(f.regex)
+                self.regex_fields[f.block].append((f.name, f.type, regex))
+                continue
+            positions, keys, value_pos = compiled
+            entry = (f.name, f.type, field_comment(f))
+            layouts[f.block][(positions, value_pos)][keys].append(entry)
+
+        # For each block, a list of (line filter, key getter, min tokens,
+        # value position, {keys: entries})
+        self.layouts = {}
+        for block, block_layouts in layouts.iteritems():
+            self.layouts[block] = []
+            for (positions, value_pos), table in block_layouts.iteritems():
+                n_min = max(positions + (value_pos,)) + 1
+                line_filter = filter_regex(positions, table.keys(), n_min)
+                if len(positions) == 1:
+                    # itemgetter gives a bare item, not a 1-tuple
+                    getter = itemgetter(positions[0])
+                    table = {keys[0]: entries for keys, entries in table.iteritems()}
+                elif positions:
+                    getter = itemgetter(*positions)
+                else:
+                    getter = lambda tokens: ()
+                self.layouts[block].append((line_filter, getter, n_min, value_pos, dict(table)))
+        self.blocks = set(self.layouts) | set(self.regex_fields)
+        self.decay_parents = set(d[2] for d in self.decay_fields)
+
+    def parse(self, text, results=None, cuts=None):
+        """Parse the text of an SLHA file, filling in the results dict with
+        {field name: value}. Stops once all fields are found.
+
+        cuts: dict, optional
+            {field name: predicate}. Each predicate is called on its field's
+            value as soon as that is parsed, and if it returns False, parsing
+            stops there. A field that isn't found at all fails its cut.
+
+        Returns the results dict, or None if it failed a cut.
+        """
+        if results is None:
+            results = {}
+        cuts = cuts or {}
+        n_left = len(set(self.names) - set(d[0] for d in self.decay_fields))
+        found = set()
+        # only look at the blocks we want
+        text = '\n' + text
+        matches = list(p_block.finditer(text))
+        ends = [m.start() for m in matches[1:]] + [len(text)]
+        for m, end in izip(matches, ends):
+            block = m.group(1)
+            if block not in self.blocks:
+                continue
+            # skip the rest of the BLOCK line itself
+            start = text.find('\n', m.end(), end)
+            if start < 0:
+                continue
+            block_text = text[start:end]
+
+            for line_filter, getter, n_min, value_pos, table in self.layouts.get(block, []):
+                for line in line_filter.findall(block_text):
+                    tokens = line.split('#', 1)[0].split()
+                    if len(tokens) < n_min:
+                        continue
+                    for name, type_, comment in table.get(getter(tokens), []):
+                        if name not in found and comment in line:
+                            results[name] = type_(tokens[value_pos])
+                            if name in cuts and not cuts[name](results[name]):
+                                return None
+                            found.add(name)
+                            n_left -= 1
+                            break
+
+            for name, type_, regex in self.regex_fields.get(block, []):
+                if name not in found:
+                    match = regex.search(block_text)
+                    if match:
+                        results[name] = type_(match.group(1))
+                        if name in cuts and not cuts[name](results[name]):
+                            return None
+                        found.add(name)
+                        n_left -= 1
+
+            if n_left == 0:
+                break
+
+        if self.decay_fields:
+            decays = parse_decays(text, self.decay_parents)
+            for name, type_, parent, daughters in self.decay_fields:
+                value = decays.get(parent, daughters)
+                if value is not None and name not in found:
+                    results[name] = type_(value)
+                    if name in cuts and not cuts[name](results[name]):
+                        return None
+                    found.add(name)
+
+        if any(name not in found for name in cuts if name in self.names):
+            return None
+        return results
+
+
+# Compiled tables, keyed by the tuple of Fields
+_tables = {}
+
+
+def get_field_table(fields):
+    """Get the (cached) FieldTable for a list of Fields"""
+    key = tuple(fields)
+    if key not in _tables:
+        _tables[key] = FieldTable(fields)
+    return _tables[key]
@@ -12,6 +12,9 @@ Usage:
     ./submit_analysis_condor_new.py <jobs_A_B_C> <jobs_D_E_F> ...
 
 where <jobs_X_Y_Z> are local dir names that have a corresponding dir on /hdfs
+
+Only archives that haven't already been analysed with the current fields &
+settings get a job, see analysis_manifest.py.
 """
 
 
@@ -20,6 +23,8 @@ import sys
 from glob import iglob
 import htcondenser as ht
 import logging
+from analyse_scans import AnalysisParser, analysis_settings
+from analysis_manifest import AnalysisManifest, analysis_hash
 
 
 logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.INFO)
@@ -30,6 +35,13 @@ ODIR = '/hdfs/user/%s/NMSSM-Scan/' % os.environ['LOGNAME']
 
 STORAGE_DIR = "/storage/%s/NMSSM-Scan/" % (os.environ['LOGNAME'])
 
+# Output format for analyse_scans.py: 'csv', or 'hdf5' for one typed table
+# per job, with good/ma1Lt11 flag columns (make_hdf5.py reads either)
+OUTPUT_FORMAT = 'csv'
+
+# Options passed to analyse_scans.py for every archive
+ANALYSIS_ARGS = ['--format', OUTPUT_FORMAT, '--manifest']
+
 
 def submit_all_analyses(job_dirs, storage_dir, hdfs_dir):
     """Submit all CSV-making jobs, with a DAG for each entry in job_dirs.
@@ -38,7 +50,8 @@ def submit_all_analyses(job_dirs, storage_dir, hdfs_dir):
     Probably could be designed better. Paths rely on many assumptions.
     """
 
-    common_input_files = ['analyse_scans.py', 'NMSSMToolsFields.py',
+    common_input_files = ['analyse_scans.py', 'slha_parser.py', 'analysis_manifest.py',
+                          'NMSSMToolsFields.py',
                           'HiggsBoundsSignalsFields.py',
                           'SuperIsoFields.py', 'NMSSMCalcFields.py']
 
@@ -46,6 +59,10 @@ def submit_all_analyses(job_dirs, storage_dir, hdfs_dir):
 
     status_files = []
 
+    # the input filename is only a placeholder, it doesn't change the settings
+    settings_hash = analysis_hash(analysis_settings(
+        AnalysisParser().parse_args(['spectr.tgz'] + ANALYSIS_ARGS)))
+
     for jdir in job_dirs:
         if not os.path.isdir(jdir):
             raise IOError('No such directory %s' % jdir)
@@ -74,14 +91,23 @@ def submit_all_analyses(job_dirs, storage_dir, hdfs_dir):
         analysis_dag = ht.DAGMan(filename=os.path.join(storage_dir, jdir, 'analysis.dag'),
                                  status_file=os.path.join(storage_dir, jdir, 'analysis.status'))
 
-        # add a job to analyse each spectr*.tgz
-        for ind, s_tar in enumerate(iglob(os.path.join(hdfs_dir, jdir, 'spectr*tgz'))):
+        # add a job to analyse each spectr*.tgz that needs it
+        manifest = AnalysisManifest(os.path.join(hdfs_dir, jdir))
+        s_tars = sorted(iglob(os.path.join(hdfs_dir, jdir, 'spectr*tgz')))
+        todo = [s for s in s_tars if manifest.needs_analysis(s, settings_hash)]
+        log.info('%s: %d of %d archives already analysed', jdir,
+                 len(s_tars) - len(todo), len(s_tars))
+        manifest.save()
+
+        for ind, s_tar in enumerate(todo):
             pid = os.path.basename(s_tar).replace('spectr', '').split('.')[0]
             job = ht.Job(name='%d_%s_analysis' % (ind, jdir.strip('/')),
-                         args=[jdir, pid],
+                         args=[jdir, pid] + ANALYSIS_ARGS,
                          hdfs_mirror_dir=os.path.join(hdfs_dir, jdir))
             analysis_jobset.add_job(job)
             analysis_dag.add_job(job)
+        if not todo:
+            continue
         analysis_dag.submit(submit_per_interval=25)
         status_files.append(analysis_dag.status_file)
 
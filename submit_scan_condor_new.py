@@ -13,6 +13,7 @@ Requires htcondenser: https://github.com/raggleton/htcondenser
 
 import os
 import sys
+import random
 from time import strftime
 import htcondenser as ht
 import logging
@@ -28,6 +29,19 @@ NUM_JOBS = 500
 # Number of points to scan per job
 NUM_POINTS = 5000
 
+# Random seed for the whole set of jobs. Each job gets its own stream from
+# (SEED, job number), so points can be regenerated later. None = pick one now.
+SEED = None
+
+# How to fill parameter space: random, sobol or lhs (see sampling.py)
+SAMPLER = "random"
+
+# Any extra options for NMSSMScan.py, e.g. "--mcmc"
+SCAN_OPTS = ""
+
+# Number of cores per job - points within a job are run in parallel
+NUM_CPUS = 1
+
 # Shorthand description for this batch of jobs
 # JOB_DESC = "MICRO_SCAN_NTv491_HBv431_HSv140_all_smallAlambdaMuEff_largeTanBeta"
 # JOB_DESC = "MICRO_SCAN_NTv493_HBv431_HSv140_largeRange_DMass2_fixAssignMass"
@@ -52,7 +66,8 @@ ODIR = "/hdfs/user/%s/NMSSM-Scan/" % (os.environ['LOGNAME'])
 STORAGE_DIR = "/storage/%s/NMSSM-Scan/" % (os.environ['LOGNAME'])
 
 
-def submit_scans(num_jobs, num_points, job_description, card, param_range, storage_dir, hdfs_dir):
+def submit_scans(num_jobs, num_points, job_description, card, param_range, storage_dir, hdfs_dir,
+                 num_cpus=1, seed=None, sampler='random', scan_opts=''):
     """Submit a set of scan jobs to HTCondor as a DAG, that run NMSSMScan.py.
 
     Parameters
@@ -71,7 +86,20 @@ def submit_scans(num_jobs, num_points, job_description, card, param_range, stora
         Location on /storage for logs, and condor/DAG files
     hdfs_dir : str
         Location on /hdfs for storing output of scans
+    num_cpus : int
+        Number of cores per job. Each job runs this many points in parallel.
+    seed : int
+        Random seed for the whole set of jobs. If None, one is generated.
+    sampler : str
+        Sampler for NMSSMScan.py. For sobol & lhs, each job takes a
+        separate part of one set of points across all jobs.
+    scan_opts : str
+        Any extra options for NMSSMScan.py.
     """
+    if seed is None:
+        seed = random.randint(0, 2**31 - 1)
+    log.info('Using random seed %d', seed)
+
     # Setup some directories:
     date_str = strftime("%d_%b_%y_%H%M")
     job_dir = 'jobs_%d_%s_%s' % (num_jobs, job_description, date_str)
@@ -84,14 +112,21 @@ def submit_scans(num_jobs, num_points, job_description, card, param_range, stora
 
     hdfs_store = os.path.join(hdfs_dir, job_dir)
 
-    common_input_files = [param_range, 'NMSSMScan.py', 'common_utils.py', card,
+    common_input_files = [param_range, 'NMSSMScan.py', 'common_utils.py',
+                          'card_template.py', 'scan_workers.py', 'sampling.py',
+                          'scan_mcmc.py', 'tree_level.py', 'hbhs_batch.py',
+                          'nmssmtools_scan.py', 'scan_journal.py', 'scan_timing.py',
+                          'result_cache.py', 'analyse_scans.py', 'slha_parser.py',
+                          'NMSSMToolsFields.py',
+                          'HiggsBoundsSignalsFields.py', 'SuperIsoFields.py',
+                          'NMSSMCalcFields.py', card, 'HTCondor/toolBundles.sh',
                           'patches/NT.patch', 'patches/NT_clean.patch',
                           'patches/HB.patch', 'patches/HS_datatables.patch',
                           'patches/HS_subroutines.patch', 'patches/HS_assignmass.patch']
 
     scan_jobset = ht.JobSet(exe='HTCondor/runScan_condor.sh',
                             copy_exe=True,
-                            setup_script=None,
+                            setup_script='HTCondor/setupPyEnv.sh',
                             filename=os.path.join(storage_dir, job_dir, 'scan.condor'),
                             out_dir=log_dir, out_file=log_stem + '.out',
                             err_dir=log_dir, err_file=log_stem + '.err',
@@ -100,17 +135,36 @@ def submit_scans(num_jobs, num_points, job_description, card, param_range, stora
                             common_input_files=common_input_files,
                             transfer_hdfs_input=False,
                             hdfs_store=hdfs_store,
-                            memory='1GB', disk='7GB')
+                            cpus=num_cpus, memory='1GB', disk='7GB')
+
+    # Build the tools once and save them as bundles for the scan jobs to
+    # unpack (does nothing if the bundles already exist)
+    build_jobset = ht.JobSet(exe='HTCondor/buildToolBundles.sh',
+                             copy_exe=True,
+                             setup_script='HTCondor/setupPyEnv.sh',
+                             filename=os.path.join(storage_dir, job_dir, 'build.condor'),
+                             out_dir=log_dir, out_file='build.$(cluster).out',
+                             err_dir=log_dir, err_file='build.$(cluster).err',
+                             log_dir=log_dir, log_file='build.$(cluster).log',
+                             share_exe_setup=True,
+                             common_input_files=common_input_files,
+                             transfer_hdfs_input=False,
+                             hdfs_store=hdfs_store,
+                             cpus=1, memory='1GB', disk='7GB')
+    build_job = ht.Job(name='build_tools', args=[], hdfs_mirror_dir=hdfs_store)
+    build_jobset.add_job(build_job)
 
     scan_dag = ht.DAGMan(filename=os.path.join(storage_dir, job_dir, 'scan.dag'),
                          status_file=os.path.join(storage_dir, job_dir, 'scan.status'))
+    scan_dag.add_job(build_job)
 
     for ind in xrange(num_jobs):
         scan_job = ht.Job(name='%d_scan' % ind,
-                          args=[hdfs_store, str(ind), str(num_points)],
+                          args=[hdfs_store, str(ind), str(num_points), str(num_cpus), str(seed),
+                                sampler, str(num_jobs), scan_opts],
                           hdfs_mirror_dir=hdfs_store)
         scan_jobset.add_job(scan_job)
-        scan_dag.add_job(scan_job)
+        scan_dag.add_job(scan_job, requires=[build_job])
 
     scan_dag.submit(submit_per_interval=25)
 
@@ -121,4 +175,5 @@ def submit_scans(num_jobs, num_points, job_description, card, param_range, stora
 
 
 if __name__ == "__main__":
-    sys.exit(submit_scans(NUM_JOBS, NUM_POINTS, JOB_DESC, CARD, PARAM_RANGE, STORAGE_DIR, ODIR))
+    sys.exit(submit_scans(NUM_JOBS, NUM_POINTS, JOB_DESC, CARD, PARAM_RANGE, STORAGE_DIR, ODIR,
+                          NUM_CPUS, SEED, SAMPLER, SCAN_OPTS))
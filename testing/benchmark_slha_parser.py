@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+
+"""
+Check the table-driven SLHA parser gives the same results as the original
+regex parser, and time them both.
+
+Usage:
+
+    ./benchmark_slha_parser.py [spectrum files] [--repeat N]
+
+By default, runs over the spectr*.dat files in this directory.
+
+The only expected differences are in HBresult for files with several
+HiggsBoundsResults channel types: the table parser takes the first (channel
+type 1, the overall result), whereas the regex parser ended up with the last.
+
+On typical NMSSMTools spectra (~36 kB, ~60 of the fields present) the table
+parser is 3-4x faster than the regex parser. Profiling shows no single hot
+spot left: of ~0.5 ms per file, about 0.05 ms goes on finding the blocks,
+0.15 ms on the DECAY tables, 0.15 ms on the regex filters picking out the
+wanted lines, and the rest on converting the ~60 values, so going much
+further would need a parser that isn't written in Python.
+"""
+
+
+import os
+import re
+import sys
+import glob
+import time
+import argparse
+from collections import defaultdict
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import NMSSMToolsFields
+import HiggsBoundsSignalsFields
+import slha_parser
+from analyse_scans import get_slha_dict
+
+
+FIELDS = (NMSSMToolsFields.nmssmtools_fields +
+          HiggsBoundsSignalsFields.higgsbounds_fields +
+          HiggsBoundsSignalsFields.higgssignals_fields)
+
+
+def get_slha_dict_regex(filename, fields):
+    """Pull information from SLHA file and store in a dict, by trying each
+    Field's regex on each line of its block.
+
+    This is the original parser from analyse_scans.py, kept here as a
+    reference for checking & timing get_slha_dict().
+
+    filename: str
+        Filepath to analyse
+    fields: list of Field objects/namedtuples
+        List of Fields to scan for. Each Field has properties:
+        - a block e.g. 'EXTPAR', to define which BLOCK to search in.
+          This is case-sensitive.
+        - a name e.g. 'mh1', to be used as the dict key.
+        - a type e.g. float, to convert from a string.
+        - a regex pattern, to be used when trying to match lines.
+          This is case-sensitive.
+
+        A Field looks like:
+
+        Field(block='MINPAR', name="tgbeta", type=float,
+              regex=re.compile(r' +3 +([E\d\.\-\+]+) +\# TANBETA\(MZ\)'))
+    """
+    # For each BLOCK, we assign a list of pairs of field name + compiled regex pattern
+    # Means we can only go through the patterns pertinent to that block
+    scan_dict = defaultdict(list)
+    decay_fields = []
+    for f in fields:
+        if slha_parser.decay_key(f) is not None:
+            # no regex, looked up by PDGID
+            decay_fields.append(f)
+        elif isinstance(f.regex, re._pattern_type):
+            scan_dict[f.block].append(f)
+        else:
+            new_field = NMSSMToolsFields.Field(name=f.name,
+                                               block=f.block,
+                                               type=f.type,
+                                               regex=re.compile(f.regex),
+                                               comment=f.regex.pattern.split('#')[1].replace('\\', ''))
+            scan_dict[f.block].append(new_field)
+
+    results = defaultdict(str)
+    # ensures all dicts have the same keys
+    for f in fields:
+        results[f.name] = ''
+
+    results['file'] = filename
+
+    p_block = re.compile(r'BLOCK +(\w+)', re.I)
+
+    # Now go through the file, line by line. If we encounter a BLOCK line,
+    # then we loop through the block contents, checking each line against all
+    # of the user's regexes. If there is a match, it is stored in the results
+    # dict.
+    # Note that we cannot use 'for line in f' as it skips alternate 'BLOCK' lines
+    with open(filename) as f:
+        try:
+            line = f.next()
+            while True:
+                if line.startswith('#'):
+                    line = f.next()
+                    continue
+
+                if is_block_line(line):
+                    # block = p_block.search(line).group(1).strip()
+                    block = line.split('#')[0].replace('BLOCK ', '').replace("Block ", '').strip().split(' ')[0]
+                    # log.debug(block)
+
+                    line = f.next()
+                    if block in scan_dict.keys():
+                        # Now loop over contents of this block and try matching
+                        # against the regexes
+                        while not is_block_line(line):
+                            # tmp_list = scan_dict[block]
+                            found_field = None
+                            for ind, field in enumerate(scan_dict[block]):
+                                if field.comment in line:
+                                    result = field.regex.search(line)
+                                    if result:
+                                        results[field.name] = field.type(result.group(1))
+                                        found_field = ind
+                                        break
+                            if found_field:
+                                del scan_dict[block][found_field]
+                            line = f.next()
+                    else:
+                        line = f.next()
+                else:
+                    line = f.next()
+        except StopIteration:
+            pass
+
+    if decay_fields:
+        with open(filename) as f:
+            decays = slha_parser.parse_decays(f.read())
+        for field in decay_fields:
+            value = decays.get(*slha_parser.decay_key(field))
+            if value is not None:
+                results[field.name] = field.type(value)
+
+    return results
+
+
+def is_block_line(line):
+    return line.startswith('BLOCK') or line.startswith('Block')
+
+
+def time_parser(parser, filenames, repeat):
+    """Get the mean time per file to parse all the files"""
+    start = time.time()
+    for _ in xrange(repeat):
+        for filename in filenames:
+            parser(filename, FIELDS)
+    return (time.time() - start) / (repeat * len(filenames))
+
+
+def main(in_args=sys.argv[1:]):
+    here = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('spectra', nargs='*',
+                        default=sorted(glob.glob(os.path.join(here, 'spectr*.dat'))))
+    parser.add_argument('--repeat', help='Number of times to parse each file',
+                        type=int, default=20)
+    args = parser.parse_args(in_args)
+
+    n_diff = 0
+    for filename in args.spectra:
+        new, old = get_slha_dict(filename, FIELDS), get_slha_dict_regex(filename, FIELDS)
+        diffs = [k for k in sorted(set(new) | set(old)) if new.get(k) != old.get(k)]
+        for k in diffs:
+            print '%s: %s: table %r, regex %r' % (filename, k, new.get(k), old.get(k))
+        n_diff += len(diffs)
+    print 'Fields differing: %d (%d files, %d fields)' % (n_diff, len(args.spectra), len(FIELDS))
+
+    t_old = time_parser(get_slha_dict_regex, args.spectra, args.repeat)
+    t_new = time_parser(get_slha_dict, args.spectra, args.repeat)
+    print 'Regex parser: %.2f ms / file' % (t_old * 1000)
+    print 'Table parser: %.2f ms / file' % (t_new * 1000)
+    print 'Speedup: %.1fx' % (t_old / t_new)
+    return 1 if n_diff else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
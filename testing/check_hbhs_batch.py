@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+
+"""
+Check that running HiggsBounds & HiggsSignals over a spectrum with their
+multi-point effC input (hbhs_batch.py, NMSSMScan.py --hbhsBatch) gives the
+same HBresult, HSchi2 and HSprob as running them on the spectrum file itself
+in SLHA mode (as NMSSMScan.py does by default).
+
+Usage:
+
+    ./check_hbhs_batch.py --HB <HiggsBounds dir> --HS <HiggsSignals dir> [spectrum file]
+
+By default, uses spectr_good_new.dat. Any HiggsBounds/HiggsSignals results
+(and DMASS) blocks already in the spectrum are removed first.
+"""
+
+
+import os
+import re
+import sys
+import shutil
+import argparse
+import tempfile
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import hbhs_batch
+from NMSSMScan import run_hbhs_slha
+from analyse_scans import get_slha_dict, fields_by_name
+
+
+# Blocks written by HiggsBounds/HiggsSignals, or for them
+OUTPUT_BLOCKS = re.compile(r'^(HIGGSBOUNDSRESULTS|HIGGSSIGNALS|DMASS$)')
+
+COMPARE_FIELDS = ['HBresult', 'HSchi2', 'HSprob']
+
+
+def strip_output_blocks(spectrum, out_filename):
+    """Copy a spectrum file, leaving out the blocks matching OUTPUT_BLOCKS"""
+    skip = False
+    with open(spectrum) as f, open(out_filename, 'w') as out:
+        for line in f:
+            parts = line.split()
+            if parts and parts[0].upper() in ['BLOCK', 'DECAY']:
+                skip = (parts[0].upper() == 'BLOCK' and len(parts) > 1 and
+                        bool(OUTPUT_BLOCKS.match(parts[1].upper())))
+            if not skip:
+                out.write(line)
+
+
+def main(in_args=sys.argv[1:]):
+    here = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('spectrum', nargs='?', default=os.path.join(here, 'spectr_good_new.dat'))
+    parser.add_argument('--HB', help='HiggsBounds directory', required=True)
+    parser.add_argument('--HS', help='HiggsSignals directory', required=True)
+    args = parser.parse_args(in_args)
+
+    tmp_dir = tempfile.mkdtemp(prefix='check_hbhs_batch_')
+    tool_dirs = {'HB': os.path.abspath(args.HB), 'HS': os.path.abspath(args.HS)}
+    slha_spectr = os.path.join(tmp_dir, 'spectr_slha.dat')
+    strip_output_blocks(args.spectrum, slha_spectr)
+    batch_spectr = os.path.join(tmp_dir, 'spectr_batch.dat')
+    shutil.copy(slha_spectr, batch_spectr)
+
+    for mode in ['SLHA', 'effC']:
+        return_codes = {}
+        if mode == 'SLHA':
+            run_hbhs_slha(slha_spectr, tool_dirs, return_codes)
+        else:
+            return_codes = hbhs_batch.run_batch([batch_spectr], tool_dirs['HB'], tool_dirs['HS'],
+                                                os.path.join(tmp_dir, 'batch'))
+        print '%s mode return codes: %s' % (mode, {k: v for k, v in return_codes.iteritems()
+                                                   if k != 'timings'})
+
+    fields = fields_by_name(COMPARE_FIELDS)
+    slha = get_slha_dict(slha_spectr, fields)
+    batch = get_slha_dict(batch_spectr, fields)
+
+    n_diff = 0
+    for name in COMPARE_FIELDS:
+        # the two modes print different numbers of significant figures
+        if (slha[name] == '' or batch[name] == '' or
+                abs(slha[name] - batch[name]) > 1E-6 * abs(slha[name])):
+            n_diff += 1
+        print '%-8s SLHA %-20r effC %r' % (name, slha[name], batch[name])
+    print 'Fields differing: %d (of %d)' % (n_diff, len(COMPARE_FIELDS))
+    if n_diff:
+        print 'Spectra left in', tmp_dir
+    else:
+        shutil.rmtree(tmp_dir)
+    return 1 if n_diff else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+
+"""
+Check the column layout in nmssmtools_scan.SCAN_COLUMNS against real
+NMSSMTools output: reading a scan output file with
+nmssmtools_scan.read_scan_table() must give the same field values as the
+spectrum file of the same point.
+
+Usage:
+
+    ./check_nt_scan_table.py <scan output file> <spectrum file> [--row N]
+
+The scan output file should be an out*.dat from a real NMSSMScan.py --ntScan
+run (in <oDir>/ntscan/), and the spectrum file that of row N of it (counting
+from 0), made by running NMSSMTools in single-point mode on a card with that
+row's parameters. Until this passes, --ntScan is experimental.
+"""
+
+
+import os
+import sys
+import argparse
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import nmssmtools_scan
+from analyse_scans import get_slha_dict, fields_by_name
+
+
+def main(in_args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('table', help='NMSSMTools scan output file (out*.dat)')
+    parser.add_argument('spectrum', help='Spectrum file for the same point')
+    parser.add_argument('--row', help='Row of the point in the table', type=int, default=0)
+    args = parser.parse_args(in_args)
+
+    points = nmssmtools_scan.read_scan_table(args.table)
+    if args.row >= len(points):
+        print 'No row %d in %s, only %d points' % (args.row, args.table, len(points))
+        return 1
+    point = points[args.row]
+    fields = fields_by_name(nmssmtools_scan.SCAN_COLUMNS)
+    if len(fields) != len(nmssmtools_scan.SCAN_COLUMNS):
+        print 'Scan columns without a field: %s' % ', '.join(
+            set(nmssmtools_scan.SCAN_COLUMNS) - set(f.name for f in fields))
+        return 1
+    expected = get_slha_dict(args.spectrum, fields)
+
+    n_diff = 0
+    for name in nmssmtools_scan.SCAN_COLUMNS:
+        # the table has 7 significant figures
+        if abs(point[name] - expected[name]) > 1E-6 * abs(expected[name]):
+            print '%s: table %r, spectrum %r' % (name, point[name], expected[name])
+            n_diff += 1
+    print 'Fields differing: %d (of %d)' % (n_diff, len(nmssmtools_scan.SCAN_COLUMNS))
+    return 1 if n_diff else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
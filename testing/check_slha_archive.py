@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+"""
+Check that fields materialised from a long-format SLHA archive are the same
+as those from parsing the spectrum files directly, and time them both.
+
+Usage:
+
+    ./check_slha_archive.py [spectrum files]
+
+By default, runs over the spectr*.dat files in this directory.
+"""
+
+
+import os
+import sys
+import glob
+import time
+import shutil
+import argparse
+import tempfile
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import analysis_manifest
+from analyse_scans import get_slha_dict
+from slha_archive import SLHAArchive, can_materialise, materialise
+
+
+def main(in_args=sys.argv[1:]):
+    here = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('spectra', nargs='*',
+                        default=sorted(glob.glob(os.path.join(here, 'spectr*.dat'))))
+    args = parser.parse_args(in_args)
+
+    fields = [f for f in analysis_manifest.registry_fields() if can_materialise(f)]
+    skipped = [f.name for f in analysis_manifest.registry_fields() if not can_materialise(f)]
+    print 'Fields that need the raw spectra:', ', '.join(skipped)
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmp_dir, 'archive.h5')
+        start = time.time()
+        with SLHAArchive(filename) as archive:
+            for spectrum in args.spectra:
+                with open(spectrum) as f:
+                    archive.add('', spectrum, f.read())
+        t_archive = time.time() - start
+
+        start = time.time()
+        df = materialise(filename, fields)
+        t_materialise = time.time() - start
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    start = time.time()
+    parsed = [get_slha_dict(spectrum, fields) for spectrum in df['file']]
+    t_parse = time.time() - start
+
+    n_diff = 0
+    for (_, row), results in zip(df.iterrows(), parsed):
+        for f in fields:
+            old, new = results.get(f.name, ''), row[f.name]
+            if old == '' and new != new:
+                continue
+            if old == '' or new != new or abs(new - old) > 1E-12 * abs(old):
+                print '%s: %s: archive %r, parser %r' % (row['file'], f.name, new, old)
+                n_diff += 1
+    print 'Fields differing: %d (%d files, %d fields)' % (n_diff, len(df), len(fields))
+
+    n = float(len(args.spectra))
+    print 'Archiving: %.2f ms / file' % (t_archive * 1000 / n)
+    print 'Materialising: %.2f ms / file' % (t_materialise * 1000 / n)
+    print 'Parsing: %.2f ms / file' % (t_parse * 1000 / n)
+    return 1 if n_diff else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,116 @@
+"""
+Vectorised tree-level NMSSM Higgs masses, to throw away obviously tachyonic
+points before running NMSSMTools on them.
+
+Uses the Z3-invariant NMSSM Higgs mass matrices as in Ellwanger, Hugonie &
+Teixeira, Phys. Rept. 496 (2010) 1 [arXiv:0910.1785], eqs. 2.22-2.27,
+with v = sqrt(vu^2 + vd^2) ~ 174 GeV, and the NMSSMTools input parameters
+lambda, kappa, Alambda, Akappa, mueff & tan(beta).
+
+Loop corrections can shift the squared masses a lot (particularly for the
+SM-like CP-even state), so points are only rejected if a tree-level squared
+mass is below -margin^2, where the margin (in GeV) is configurable.
+"""
+
+
+import logging
+import numpy as np
+
+
+log = logging.getLogger(__name__)
+
+
+# SM inputs, as in NMSSMTools
+MZ = 91.187
+MW = 80.42
+GF = 1.16639E-5
+
+# Higgs vev, normalised as v ~ 174 GeV
+V_HIGGS = 1. / np.sqrt(2. * np.sqrt(2.) * GF)
+
+# Parameter names in the paramRange JSON/card template that we need
+PARAM_NAMES = ['LAMBDA', 'KAPPA', 'ALAMBDA', 'AKAPPA', 'MUEFF', 'TANB']
+
+# Default margin in GeV
+DEFAULT_MARGIN = 50.
+
+
+def higgs_mass_matrices(lam, kap, alam, akap, mueff, tanb):
+    """Make the tree-level Higgs squared-mass matrices for arrays of points.
+
+    Returns (CP-even matrices (N, 3, 3) in basis (Hu, Hd, S),
+             CP-odd matrices (N, 2, 2) in basis (A, S_I) with the Goldstone removed,
+             charged Higgs squared masses (N,))
+    """
+    # allow for a mix of arrays & single values
+    lam, kap, alam, akap, mueff, tanb = np.broadcast_arrays(
+        *[np.asarray(x, dtype=float).ravel() for x in (lam, kap, alam, akap, mueff, tanb)])
+    n = lam.size
+    beta = np.arctan(tanb)
+    vu = V_HIGGS * np.sin(beta)
+    vd = V_HIGGS * np.cos(beta)
+    g2 = MZ**2 / V_HIGGS**2  # (g1^2 + g2^2) / 2
+    s = mueff / lam
+    b_eff = alam + kap * s
+    sin2b = np.sin(2 * beta)
+
+    even = np.empty((n, 3, 3))
+    even[:, 0, 0] = g2 * vu**2 + mueff * b_eff / tanb
+    even[:, 1, 1] = g2 * vd**2 + mueff * b_eff * tanb
+    even[:, 2, 2] = lam * alam * vu * vd / s + kap * s * (akap + 4 * kap * s)
+    even[:, 0, 1] = even[:, 1, 0] = (2 * lam**2 - g2) * vu * vd - mueff * b_eff
+    even[:, 0, 2] = even[:, 2, 0] = lam * (2 * mueff * vu - (b_eff + kap * s) * vd)
+    even[:, 1, 2] = even[:, 2, 1] = lam * (2 * mueff * vd - (b_eff + kap * s) * vu)
+
+    odd = np.empty((n, 2, 2))
+    odd[:, 0, 0] = 2 * mueff * b_eff / sin2b
+    odd[:, 1, 1] = lam * (b_eff + 3 * kap * s) * vu * vd / s - 3 * kap * akap * s
+    odd[:, 0, 1] = odd[:, 1, 0] = lam * (alam - 2 * kap * s) * V_HIGGS
+
+    charged = 2 * mueff * b_eff / sin2b + MW**2 - lam**2 * V_HIGGS**2
+
+    return even, odd, charged
+
+
+def tree_level_masses_sq(lam, kap, alam, akap, mueff, tanb):
+    """Get the tree-level squared masses (GeV^2) for arrays of points.
+
+    Returns a dict with entries (each sorted in increasing order):
+    'h': (N, 3) CP-even, 'a': (N, 2) CP-odd, 'hc': (N,) charged.
+    """
+    even, odd, charged = higgs_mass_matrices(lam, kap, alam, akap, mueff, tanb)
+    return {'h': np.linalg.eigvalsh(even),
+            'a': np.linalg.eigvalsh(odd),
+            'hc': charged}
+
+
+def prescreen(values, margin=DEFAULT_MARGIN):
+    """Find which points are not obviously tachyonic at tree level.
+
+    values: dict
+        Map of parameter name (PARAM_NAMES) to array of values.
+    margin: float
+        Points are only rejected if a squared mass is < -margin^2 (GeV^2).
+
+    Returns (boolean array, True if point passes,
+             dict of number of points failing for each of 'h', 'a', 'hc')
+    """
+    masses_sq = tree_level_masses_sq(*[values[k] for k in PARAM_NAMES])
+    cut = -float(margin)**2
+    fail = {}
+    for k, m in masses_sq.iteritems():
+        lightest = m if m.ndim == 1 else m[:, 0]
+        # written this way so NaNs (e.g. from lambda = 0) also fail
+        fail[k] = ~(lightest >= cut)
+    passed = ~(fail['h'] | fail['a'] | fail['hc'])
+    return passed, {k: int(v.sum()) for k, v in fail.iteritems()}
+
+
+def report(passed, n_fail):
+    """Log a summary of the prescreen"""
+    n = len(passed)
+    log.info('Tree-level prescreen: %d / %d points rejected (%.1f%%)',
+             n - passed.sum(), n, 100. * (n - passed.sum()) / max(n, 1))
+    names = {'h': 'M_H1^2', 'a': 'M_A1^2', 'hc': 'M_HC^2'}
+    for k in ['h', 'a', 'hc']:
+        log.info('    %s < -margin^2: %d', names[k], n_fail[k])